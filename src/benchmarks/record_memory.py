@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+record_memory.py
+
+Measure the memory used by a large number of HistoriaSession records, as if
+they had been read from the database. Run from the src directory:
+
+    python3 -m benchmarks.record_memory [count]
+
+No database connection is needed.
+
+Created by Aaron Crosman on 2015-03-17.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import uuid
+import datetime
+import tracemalloc
+
+from database import core_data_objects
+from database import session
+
+
+def build_rows(count):
+    """Return count rows like the ones load() reads from the session table."""
+    now = datetime.datetime.now()
+    return [{'sessionid': str(uuid.UUID(int=i)),
+             'userid':    i % 1000,
+             'created':   now,
+             'last_seen': now,
+             'ip':        '10.0.{0}.{1}'.format(i // 256 % 256, i % 256)} for i in range(count)]
+
+def main(count=100000):
+    database = core_data_objects.HistoriaDatabase('benchmark')
+    rows = build_rows(count)
+    sessions = [None] * count
+
+    # Only the records are counted, the rows and list already exist.
+    tracemalloc.start()
+    for i, row in enumerate(rows):
+        sessions[i] = session.HistoriaSession(database)
+        sessions[i]._hydrate(row)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("{0} sessions: {1:.1f} MB, {2} bytes per session".format(count, used / 1048576, used // count))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+connection_pool.py
+
+A pool of MySQL connections shared by all the threads using a
+HistoriaDatabase.
+
+Created by Aaron Crosman on 2015-03-10.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import logging
+import threading
+import collections
+
+import mysql.connector
+
+from .exceptions import *
+
+
+class HistoriaConnectionPool(object):
+    """Keeps up to size connections open for reuse. When all of them are in
+    use up to overflow extra connections are opened, and closed again when
+    returned. Beyond that callers wait up to timeout seconds for a connection
+    to be returned. Connections idle for more than idle_timeout seconds are
+    closed, and every connection is checked before it is handed out."""
+
+    def __init__(self, connection_settings, size=5, overflow=10,
+                 idle_timeout=300, timeout=30):
+        self._logger = logging.getLogger("historia.db")
+        self.connection_settings = dict(connection_settings)
+        self.size = int(size)
+        self.overflow = int(overflow)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._lock = threading.Condition()
+        self._idle = collections.deque()  # (connection, time returned)
+        self._open = 0  # Connections open or being opened, idle or in use.
+        self._closed = False
+        self._stats = {
+            'checkouts':             0,
+            'created':               0,
+            'discarded':             0,
+            'waits':                 0,
+            'timeouts':              0,
+            'failed_health_checks':  0
+        }
+
+    def acquire(self):
+        """Return a working connection, opening one if needed. Raises
+        DataConnectionError if none can be had within timeout seconds."""
+        while True:
+            connection = self._checkout()
+            if connection is None:
+                connection = self._create()
+                break
+
+            if self._healthy(connection):
+                break
+
+            with self._lock:
+                self._stats['failed_health_checks'] += 1
+            self._discard(connection)
+
+        # Counted once per connection handed out, however it was found
+        with self._lock:
+            self._stats['checkouts'] += 1
+        return connection
+
+    def release(self, connection):
+        """Return a connection to the pool. Any transaction still open on it
+        is rolled back."""
+        try:
+            if connection.unread_result:
+                connection.consume_results()
+            if connection.in_transaction:
+                connection.rollback()
+        except mysql.connector.Error as err:
+            self._discard(connection)
+            return
+
+        with self._lock:
+            if self._closed or len(self._idle) >= self.size:
+                keep = False
+            else:
+                self._idle.append((connection, time.monotonic()))
+                keep = True
+            self._lock.notify()
+
+        if not keep:
+            self._discard(connection)
+
+    def close(self):
+        """Close every idle connection. Connections in use are closed when
+        returned."""
+        with self._lock:
+            self._closed = True
+            idle = [c for c, returned in self._idle]
+            self._idle.clear()
+            self._lock.notify_all()
+
+        for connection in idle:
+            self._discard(connection)
+
+    def pool_stats(self):
+        """Return a dict describing the pool's current state and history."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['overflow'] = self.overflow
+            stats['open'] = self._open
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._open - len(self._idle)
+        return stats
+
+    def _checkout(self):
+        """Take an idle connection, or reserve room for a new one (returns
+        None), waiting if the pool is exhausted."""
+        deadline = time.monotonic() + self.timeout
+        stale = []
+        try:
+            with self._lock:
+                waited = False
+                while True:
+                    if self._closed:
+                        raise DataConnectionError("Connection pool has been closed")
+
+                    now = time.monotonic()
+                    while self._idle:
+                        connection, returned = self._idle.pop()  # Most recently used first
+                        if now - returned > self.idle_timeout:
+                            stale.append(connection)
+                            self._open -= 1
+                            self._stats['discarded'] += 1
+                        else:
+                            return connection
+
+                    if self._open < self.size + self.overflow:
+                        self._open += 1
+                        return None
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise DataConnectionError("Timed out waiting for a database connection")
+
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    self._lock.wait(remaining)
+        finally:
+            for connection in stale:
+                self._close(connection)
+
+    def _create(self):
+        try:
+            connection = mysql.connector.connect(**self.connection_settings)
+        except mysql.connector.Error as err:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            self._logger.error("Unable to establish pooled database connection: {0}".format(str(err)))
+            raise DataConnectionError("Unable to establish pooled database connection: {0}".format(str(err)))
+
+        with self._lock:
+            self._stats['created'] += 1
+        return connection
+
+    def _discard(self, connection):
+        self._close(connection)
+        with self._lock:
+            self._open -= 1
+            self._stats['discarded'] += 1
+            self._lock.notify()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except mysql.connector.Error as err:
+            pass
+
+    @staticmethod
+    def _healthy(connection):
+        try:
+            return connection.is_connected()
+        except mysql.connector.Error as err:
+            return False
@@ -31,25 +31,35 @@ import sys, os
 import logging
 import datetime
 import json, string
+import base64
+import threading
+import functools
+import contextlib
+import time
 
 import mysql.connector
 
 from .exceptions import *
+from .connection_pool import *
+from .prepared_statements import *
+from .query_diagnostics import *
+from .search_cache import *
 
 
 class HistoriaDataObject(object):
 
     type_label = "HistoriaDataObject"
     machine_type = "HistoriaDataObject"
+    _logger = logging.getLogger("historia.db") # Shared by all data objects
+
+    __slots__ = ('_id',)
 
     def __new__(cls, *args):
         """
-        The __new__ override provides the logger object for all child data
-        objects in the system and forces a few shared assumptions about
-        attributes.
+        The __new__ override forces a few shared assumptions about attributes
+        on all child data objects in the system.
         """
         obj = super(HistoriaDataObject, cls).__new__(cls)
-        obj._logger = logging.getLogger("historia.db")
         obj._id = -1
 
         return obj
@@ -65,6 +75,7 @@ class HistoriaDatabase(HistoriaDataObject):
     machine_type = "historia_database"
 
     def __init__(self, database_name):
+        self._local = threading.local() # Per thread connections, see connect_thread()
         self.name = database_name
         self._id = None
         self.connection_settings = {
@@ -79,6 +90,13 @@ class HistoriaDatabase(HistoriaDataObject):
             'charset': 'utf8'
         }
         self.connection = None
+        self.pool_settings = None # Keyword arguments for HistoriaConnectionPool, None for no pool
+        self._pool = None
+        self.prepared_statements = False # Run member classes' hot queries as prepared statements
+        self._prepared = HistoriaPreparedStatements()
+        self.query_diagnostics = None # A HistoriaQueryDiagnostics to check searches against, None for no checks
+        self.search_cache = None # A HistoriaSearchCache for search results, None for no caching
+        self._consecutive_ids = None # See consecutive_insert_ids
 
     def __setattr__(self, name, value):
         # Don't allow a database name that would be invalide to MySQL
@@ -95,21 +113,304 @@ class HistoriaDatabase(HistoriaDataObject):
     def connect(self):
         try:
             self.connection = mysql.connector.connect(**self.connection_settings)
-            return True
         except mysql.connector.Error as err:
              self._logger.error("Unable to establish database connection: {0}".format(str(err)))
              raise DataConnectionError("Unable to establish database connection: {0}".format(str(err)))
 
+        self._consecutive_ids = None
+
+        if self.pool_settings is not None:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = HistoriaConnectionPool(self.connection_settings, **self.pool_settings)
+
+        if self.prepared_statements:
+            for member in self.member_classes:
+                for statement in member._prepared_SQL():
+                    self.prepare(statement)
+
+        return True
+
     def disconnect(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
         if self.connected:
             self.connection.close()
             return True
 
+    @property
+    def pooled(self):
+        return self._pool is not None
+
+    def pool_stats(self):
+        """Return the connection pool's statistics, or None without a pool."""
+        if self._pool is None:
+            return None
+        return self._pool.pool_stats()
+
+    def prepare(self, statement):
+        """Run statement as a prepared statement from now on, if prepared
+        statements are turned on."""
+        if self.prepared_statements and not self._prepared.registered(statement):
+            self._prepared.register(statement)
+
+    def prepared_stats(self):
+        """Return the prepared statement counters, see
+        HistoriaPreparedStatements.stats()."""
+        return self._prepared.stats()
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """Context manager that takes a connection from the pool and uses it for
+        everything the calling thread does with this database until the block
+        exits. Nested calls share the outer block's connection. Without a pool
+        the thread's current connection is used.
+
+            with database.borrow() as connection:
+                ...
+        """
+        depth = getattr(self._local, 'borrowed', 0)
+        if depth > 0 or self._pool is None:
+            self._local.borrowed = depth + 1
+            try:
+                yield self.connection
+            finally:
+                self._local.borrowed = depth
+            return
+
+        previous = getattr(self._local, 'connection', None)
+        connection = self._pool.acquire()
+        self._local.connection = connection
+        self._local.borrowed = 1
+        try:
+            yield connection
+        finally:
+            self._local.borrowed = 0
+            self._local.connection = previous
+            self._pool.release(connection)
+
+    def connect_thread(self):
+        """Open a connection used only by the calling thread. Until
+        disconnect_thread() is called all queries issued from this thread use
+        that connection instead of the shared one created by connect()."""
+        try:
+            self._local.connection = mysql.connector.connect(**self.connection_settings)
+            return True
+        except mysql.connector.Error as err:
+             self._logger.error("Unable to establish thread database connection: {0}".format(str(err)))
+             raise DataConnectionError("Unable to establish thread database connection: {0}".format(str(err)))
+
+    def disconnect_thread(self):
+        """Close the calling thread's connection and fall back to the shared
+        connection."""
+        thread_connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if thread_connection is not None and thread_connection.is_connected():
+            thread_connection.close()
+            return True
+
     def commit(self):
+        if self.in_transaction:
+            return True # Deferred until the outermost transaction() block exits
         if self.connected:
             self.connection.commit()
             return True
 
+    @property
+    def in_transaction(self):
+        """True while the calling thread is inside a transaction() block."""
+        return getattr(self._local, 'transaction_depth', 0) > 0
+
+    @contextlib.contextmanager
+    def transaction(self, savepoint=True):
+        """Context manager grouping every statement the calling thread runs
+        against this database into one transaction. Commits are deferred until
+        the outermost block exits, and everything is rolled back if an
+        exception escapes it. Nested blocks use savepoints, so an exception
+        caught outside a nested block only undoes that block's work; with
+        savepoint=False a nested block simply joins the outer transaction.
+
+            with database.transaction():
+                record.save()
+                other_record.save()
+        """
+        with self.borrow():
+            if not self.connected:
+                raise DataConnectionError("Cannot start a transaction, no active connection")
+
+            depth = getattr(self._local, 'transaction_depth', 0)
+            if depth > 0 and not savepoint:
+                yield self
+                return
+
+            savepoint = "historia_savepoint_{0}".format(depth)
+            if depth > 0:
+                self._execute_transaction_statement("SAVEPOINT `{0}`".format(savepoint))
+
+            if depth == 0:
+                self._local.rollback_hooks = []
+            mark = len(self._local.rollback_hooks)
+
+            self._local.transaction_depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                self._local.transaction_depth = depth
+                try:
+                    if depth == 0:
+                        self.connection.rollback()
+                    else:
+                        self._execute_transaction_statement("ROLLBACK TO SAVEPOINT `{0}`".format(savepoint))
+                except (mysql.connector.Error, DataConnectionError) as err:
+                    self._logger.error("Unable to roll back transaction: {0}".format(err))
+                finally:
+                    self._rolled_back(mark)
+                    if depth == 0:
+                        self._transaction_written()
+                raise
+            else:
+                self._local.transaction_depth = depth
+                try:
+                    if depth == 0:
+                        self.connection.commit()
+                    else:
+                        self._execute_transaction_statement("RELEASE SAVEPOINT `{0}`".format(savepoint))
+                except mysql.connector.Error as err:
+                    self._logger.error("Unable to commit transaction: {0}".format(err))
+                    if depth == 0:
+                        self._rolled_back(mark)
+                    raise DataSaveError("Unable to commit transaction: {0}".format(err))
+                finally:
+                    if depth == 0:
+                        self._local.rollback_hooks = []
+                        self._transaction_written()
+
+    def on_rollback(self, callback):
+        """Have callback() called if the work the calling thread has just done
+        is rolled back: when the transaction() block (or savepoint) it's in
+        fails, or an outer one does later. Outside a transaction the work has
+        already been committed, so callback is never called."""
+        if self.in_transaction:
+            self._local.rollback_hooks.append(callback)
+
+    def _rolled_back(self, mark):
+        """Call, newest first, the rollback hooks added since there were mark
+        of them."""
+        hooks = self._local.rollback_hooks
+        undone = hooks[mark:]
+        del hooks[mark:]
+        for callback in reversed(undone):
+            try:
+                callback()
+            except Exception as err:
+                self._logger.error("Rollback hook failed: {0}".format(err))
+
+    @property
+    def identity_map(self):
+        """The calling thread's identity map ({(machine_type, id): record})
+        while inside unit_of_work(), otherwise None."""
+        return getattr(self._local, 'identity_map', None)
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """Context manager scoping an identity map to the calling thread: inside
+        the block HistoriaRecord.get() loads each record once and hands back
+        the same object every time it's asked for again. Records fetched that
+        way and changed in the block are saved together by flush(), which is
+        called when the block exits unless an exception escapes it. Callers
+        that answer someone before the block ends (like the controller's
+        requests) should flush() first, so a failed save can still be
+        reported. Nested blocks share the outer block's map.
+
+            with database.unit_of_work():
+                user = HistoriaUser.get(database, 1)
+                user.name = "New name"  # Saved at the end of the block
+        """
+        if self.identity_map is not None:
+            yield self.identity_map
+            return
+
+        identity_map = {}
+        self._local.identity_map = identity_map
+        try:
+            yield identity_map
+            self.flush()
+        finally:
+            self._local.identity_map = None
+
+    def discard(self):
+        """Drop every record from the calling thread's identity map without
+        saving it, so changes made by work that failed aren't saved when
+        unit_of_work() ends. Does nothing outside unit_of_work()."""
+        identity_map = self.identity_map
+        if identity_map is not None:
+            identity_map.clear()
+
+    def flush(self):
+        """Save the records in the calling thread's identity map that have
+        changed, with save_many(). Records that fail to save are dropped from
+        the map, so they aren't tried again when the unit of work ends. Does
+        nothing outside unit_of_work()."""
+        identity_map = self.identity_map
+        if identity_map is None:
+            return
+
+        dirty = [record for record in identity_map.values() if record.id != -1 and record._dirty]
+        if not dirty:
+            return
+
+        try:
+            HistoriaRecord.save_many(dirty)
+        except Exception:
+            for record in dirty:
+                record._forget()
+            raise
+
+    @property
+    def consecutive_insert_ids(self):
+        """True if a multi-row INSERT is sure to get consecutive auto-increment
+        ids, so they can be worked out from the first. That needs an
+        auto_increment_increment of 1 and an innodb_autoinc_lock_mode of 0 or
+        1; with mode 2 (the default from MySQL 8) concurrent inserts can take
+        ids from the middle of the range. Checked once per connect()."""
+        if self._consecutive_ids is None:
+            try:
+                settings = self.execute_select(("SELECT @@auto_increment_increment AS `increment`, "
+                                                "@@innodb_autoinc_lock_mode AS `lock_mode`", {}))[0]
+                self._consecutive_ids = int(settings['increment']) == 1 and int(settings['lock_mode']) <= 1
+            except (HistoriaDataException, KeyError, IndexError, TypeError, ValueError) as err:
+                self._logger.warning("Unable to check auto-increment settings, inserting rows one at a time: {0}".format(err))
+                self._consecutive_ids = False
+        return self._consecutive_ids
+
+    def _written(self, statement):
+        """Tell the search cache a write has been committed, or will be when
+        the calling thread's transaction ends."""
+        if self.search_cache is None:
+            return
+        if self.in_transaction:
+            if getattr(self._local, 'written', None) is None:
+                self._local.written = set()
+            self._local.written.add(statement)
+        else:
+            self.search_cache.written(statement)
+
+    def _transaction_written(self):
+        """Pass the writes made in the calling thread's transaction, which has
+        just ended, to the search cache."""
+        written = getattr(self._local, 'written', None)
+        self._local.written = None
+        if written and self.search_cache is not None:
+            for statement in written:
+                self.search_cache.written(statement)
+
+    def _execute_transaction_statement(self, statement):
+        cur = self.cursor()
+        cur.execute(statement)
+        cur.close()
+
     def cursor(self):
         """Return a cursor connected to this record's database."""
         try:
@@ -120,6 +421,19 @@ class HistoriaDatabase(HistoriaDataObject):
 
         return self.connection.cursor(dictionary=True)
 
+    @property
+    def connection(self):
+        """The connection used by the calling thread: its own connection if
+        connect_thread() was used, otherwise the shared connection."""
+        thread_connection = getattr(self._local, 'connection', None)
+        if thread_connection is not None:
+            return thread_connection
+        return self._connection
+
+    @connection.setter
+    def connection(self, value):
+        self._connection = value
+
     @property
     def connected(self):
         if self.connection == None:
@@ -155,58 +469,181 @@ class HistoriaDatabase(HistoriaDataObject):
     # ================= Database Helpers ================
     def execute_insert(self, prepared_statement):
 
-        if not self.connected:
-            raise DataConnectionError("Cannot insert into database, no active connection")
+        with self.borrow():
+            if not self.connected:
+                raise DataConnectionError("Cannot insert into database, no active connection")
 
-        try:
-            cur = self.cursor()
-            cur.execute(prepared_statement[0], prepared_statement[1])
-            self.commit()
-            newId = cur.lastrowid
-            cur.close()
-            self._logger.debug("Inserted Data: {0}, values {1}".format(*prepared_statement))
-            return newId
-        except mysql.connector.Error as err:
-            raise DataSaveError("Unable to add record to database: {0}, values {1}".format(*prepared_statement))
+            try:
+                cur = self.cursor()
+                cur.execute(prepared_statement[0], prepared_statement[1])
+                self.commit()
+                self._written(prepared_statement[0])
+                newId = cur.lastrowid
+                cur.close()
+                self._logger.debug("Inserted Data: {0}, values {1}".format(*prepared_statement))
+                return newId
+            except mysql.connector.Error as err:
+                raise DataSaveError("Unable to add record to database: {0}, values {1}".format(*prepared_statement))
 
 
     def execute_select(self, prepared_statement):
 
-        if not self.connected:
-            raise DataConnectionError("Cannot insert into database, no active connection")
+        with self.borrow():
+            if not self.connected:
+                raise DataConnectionError("Cannot insert into database, no active connection")
 
+            try:
+                cur = self._execute_prepared(prepared_statement)
+                if cur is not None:
+                    result = [dict(zip(cur.column_names, row)) for row in cur.fetchall()]
+                else:
+                    cur = self.cursor()
+                    cur.execute(prepared_statement[0], prepared_statement[1])
+                    result = cur.fetchall()
+                    cur.close()
+                self._logger.debug("Selected Data: {0}, values {1}".format(*prepared_statement))
+                return result
+            except mysql.connector.Error as err:
+                self._logger.error('Unable to execute SQL statement {0}, values {1}'.format(*prepared_statement))
+                raise DataLoadError("Unable to load data from database.{0}, values {1}".format(*prepared_statement))
+
+    def iter_select(self, prepared_statement, batch_size=1000):
+        """Generator version of execute_select() for results too large to hold
+        in memory. Rows are read from the server batch_size at a time with an
+        unbuffered cursor and yielded one by one. With a pool, and outside a
+        transaction, a connection is taken from the pool for as long as the
+        rows are being read, so the thread can keep using its own meanwhile.
+        Otherwise the thread's connection is used and can't run anything
+        else until the generator is exhausted or closed."""
+
+        pool = self._pool if not self.in_transaction else None
+        if pool is not None:
+            connection = pool.acquire()
+        elif self.connected:
+            connection = self.connection
+        else:
+            raise DataConnectionError("Cannot select from database, no active connection")
 
         try:
-            cur = self.cursor()
-            cur.execute(prepared_statement[0], prepared_statement[1])
-            result = cur.fetchall()
-            self._logger.debug("Selected Data: {0}, values {1}".format(*prepared_statement))
-            cur.close()
-            return result
+            cur = connection.cursor(dictionary=True, buffered=False)
+            try:
+                cur.execute(prepared_statement[0], prepared_statement[1])
+                self._logger.debug("Streaming Data: {0}, values {1}".format(*prepared_statement))
+                rows = cur.fetchmany(batch_size)
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(batch_size)
+            finally:
+                # Rows left unread when iteration stops early block the connection
+                if connection.unread_result:
+                    connection.consume_results()
+                cur.close()
         except mysql.connector.Error as err:
             self._logger.error('Unable to execute SQL statement {0}, values {1}'.format(*prepared_statement))
             raise DataLoadError("Unable to load data from database.{0}, values {1}".format(*prepared_statement))
+        finally:
+            if pool is not None:
+                pool.release(connection)
 
     def execute_update(self, prepared_statement):
 
-        if not self.connected:
-            raise DataConnectionError("Cannot insert into database, no active connection")
+        with self.borrow():
+            if not self.connected:
+                raise DataConnectionError("Cannot insert into database, no active connection")
+
+            try:
+                cur = self._execute_prepared(prepared_statement)
+                if cur is not None:
+                    rows = cur.rowcount
+                else:
+                    cur = self.cursor()
+                    cur.execute(prepared_statement[0], prepared_statement[1])
+                    rows = cur.rowcount
+                    cur.close()
+                self.commit()
+                self._written(prepared_statement[0])
+                self._logger.debug("Updated {0} rows using: {1}, values {2}".format(rows,*prepared_statement))
+                return rows
+            except mysql.connector.Error as err:
+                self._logger.error('Unable to execute SQL statement {0}, values {1}'.format(*prepared_statement))
+                raise DataSaveError("Unable to load data from database.{0}, values {1}".format(*prepared_statement))
+
+    def execute_many(self, prepared_statement):
+        """Run one statement for each set of values in prepared_statement[1].
+        Returns the number of rows affected."""
+
+        with self.borrow():
+            if not self.connected:
+                raise DataConnectionError("Cannot update database, no active connection")
+
+            try:
+                cur = self.cursor()
+                cur.executemany(prepared_statement[0], prepared_statement[1])
+                self.commit()
+                self._written(prepared_statement[0])
+                rows = cur.rowcount
+                self._logger.debug("Updated {0} rows using: {1}, values {2}".format(rows,*prepared_statement))
+                cur.close()
+                return rows
+            except mysql.connector.Error as err:
+                self._logger.error('Unable to execute SQL statement {0}, values {1}'.format(*prepared_statement))
+                raise DataSaveError("Unable to save data to database.{0}, values {1}".format(*prepared_statement))
+
+    def _execute_prepared(self, prepared_statement):
+        """Run a registered statement as a prepared statement. Returns the
+        cursor used, or None if the statement should go through a regular
+        cursor instead."""
+        if not self.prepared_statements or not self._prepared.registered(prepared_statement[0]):
+            return None
 
         try:
-            cur = self.cursor()
-            cur.execute(prepared_statement[0], prepared_statement[1])
-            self.commit()
-            rows = cur.rowcount
-            self._logger.debug("Updated {0} rows using: {1}, values {2}".format(rows,*prepared_statement))
-            cur.close()
-            return rows
+            return self._prepared.execute(self.connection, prepared_statement)
         except mysql.connector.Error as err:
-            self._logger.error('Unable to execute SQL statement {0}, values {1}'.format(*prepared_statement))
-            raise DataSaveError("Unable to load data from database.{0}, values {1}".format(*prepared_statement))
+            self._logger.warning("Prepared statement failed, using a regular cursor: {0} ({1})".format(prepared_statement[0], err))
+            return None
+
+
+_unset = object() # Stands in for a field that has never been set
+_unchanged = frozenset() # _dirty_fields of every clean record
+
+
+class HistoriaRecordType(type):
+    """Metaclass for HistoriaRecord. Gives each record class __slots__ for its
+    fields and compiles its SQL when the class is created."""
+
+    def __new__(mcs, name, bases, namespace):
+        if '__slots__' not in namespace:
+            namespace['__slots__'] = mcs._generate_slots(bases, namespace)
+        return super().__new__(mcs, name, bases, namespace)
+
+    @staticmethod
+    def _generate_slots(bases, namespace):
+        """Slots for the fields a record class defines (and the record state
+        kept by HistoriaRecord) that its bases don't already have. Records
+        still get a __dict__ for the odd extra attribute, like
+        HistoriaSession._user, but it's only created when something is put
+        in it."""
+
+        taken = set()
+        for base in bases:
+            for klass in base.__mro__:
+                taken.update(klass.__dict__.get('__slots__', ()))
+
+        slots = ['database', '_dirty_fields']
+        slots += sorted(f for f in namespace.get('_table_fields', {}) if f != 'id')
+        slots = [s for s in slots if s not in taken]
+        if not any(base.__dictoffset__ for base in bases):
+            slots.append('__dict__')
 
+        return tuple(slots)
 
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls._compile_SQL()
+        cls._compile_validators()
 
-class HistoriaRecord(HistoriaDataObject):
+
+class HistoriaRecord(HistoriaDataObject, metaclass=HistoriaRecordType):
 
     type_label        = "Historia Generic Record"
     machine_type      = "historia_generic"
@@ -244,13 +681,21 @@ class HistoriaRecord(HistoriaDataObject):
     #                                           'fields': [List, of, fields]},
     #                                'order' : [order it should be added to the table]
     #                }}
+    _primary_key = None # Field used to find a record, None to use the field with a PRIMARY index
+    _prepare = () # Statements from _sql run often enough to be prepared on the server: select, update, delete
+
+    def __new__(cls, *args):
+        obj = super().__new__(cls, *args)
+        obj._dirty_fields = _unchanged # Fields changed since the record was loaded or saved, see _dirty
+        return obj
 
     def __init__(self, database):
 
-        # Assign all the attributes for the class list of fields
+        # Assign all the attributes for the class list of fields. None is
+        # always valid so there's no need to go through __setattr__.
         for field in type(self)._table_fields:
-            if field is not 'id':
-                setattr(self, field, None)
+            if field != 'id':
+                HistoriaDataObject.__setattr__(self, field, None)
 
         self.database = database # Links back to the database that owns this record
         self._dirty = False # Updated whenever there are unsaved changes around, but we're clean by definition when created
@@ -271,24 +716,35 @@ class HistoriaRecord(HistoriaDataObject):
         we'll allow the objects in front of it be inflexible as well.
         """
 
-        if name[:1] is not "_" and name is not 'database' and name not in type(self)._table_fields:
+        validators = type(self)._validators
+        if name in validators:
+            # Check the type on things to be mapped to SQL fields. None is allows permitted through.
+            validator = validators[name]
+            if value is not None and validator is not None and not isinstance(value, validator[0]):
+                raise ValueError(validator[1].format(name, type(value)))
+
+            current = getattr(self, name, _unset)
+            if (current is _unset or current != value) and name not in self._dirty_fields:
+                self._dirty_fields = self._dirty_fields | {name}
+        elif name[:1] != "_" and name != 'database':
             raise AttributeError('Cannot set attribute {0} because there is no matching field on this record type'.format(name))
 
-        # Check the type on things to be mapped to SQL fields. None is allows permitted through.
-        if name in type(self)._table_fields and value is not None:
-            attr_type = type(self)._table_fields[name]['type']
-            if self._is_type_int(attr_type) and not isinstance(value, int):
-                raise ValueError("{0} should be an int but {1} provided".format(name, type(value)))
-            elif self._is_type_text(attr_type) and not isinstance(value, str):
-                raise ValueError("{0} should be a text type (str) but {1} provided".format(name, type(value)))
-            elif self._is_type_float(attr_type) and not isinstance(value, float):
-                raise ValueError("{0} should be a float type  but {1} provided".format(name, type(value)))
-            elif self._is_type_datetime(attr_type) and not isinstance(value, datetime.datetime):
-                raise ValueError("{0} should be a datetime type but {1} provided".format(name, type(value)))
-
         HistoriaDataObject.__setattr__(self, name, value)
-        if name != '_dirty':
-            HistoriaDataObject.__setattr__(self, '_dirty', True)
+
+    @property
+    def _dirty(self):
+        """True if any field has changed since the record was loaded or
+        saved. The changed fields are kept in a frozenset that's replaced
+        when it changes, so all clean records share the empty one rather
+        than each holding a set."""
+        return len(self._dirty_fields) > 0
+
+    @_dirty.setter
+    def _dirty(self, value):
+        if value:
+            self._dirty_fields = frozenset(type(self)._table_fields)
+        else:
+            self._dirty_fields = _unchanged
 
     def __eq__(self, other):
         if self.id == -1:
@@ -326,7 +782,7 @@ class HistoriaRecord(HistoriaDataObject):
 
         for field in type(self)._table_fields:
             value = getattr(self, field)
-            if value is not None and field is not 'id':
+            if value is not None and field != 'id':
                 if self._is_type_datetime(type(self)._table_fields[field]['type']):
                     obj_dict['fields'][field] = value.strftime('%Y-%M-%d %H:%M:%S')
                 else:
@@ -336,24 +792,158 @@ class HistoriaRecord(HistoriaDataObject):
 
     # ============== CRUD methods ==================
     def save(self):
-        """Save this record to the database."""
+        """Save this record to the database, unless it has been saved before and
+        hasn't changed since. Inside database.transaction() the write is
+        committed with the rest of the transaction."""
 
         if not self.database.connected:
             raise DataConnectionError("Cannot save without an active database connection")
 
-        if self.id == -1:
-            self._id = self.database.execute_insert(self._generate_insert_SQL())
-        else:
-            self.database.execute_update(self._generate_update_SQL())
+        if self.id != -1 and not self._dirty:
+            return # Nothing has changed since the record was loaded or saved
+
+        self._before_save()
+        try:
+            with self.database.transaction(savepoint=False):
+                inserted = self.id == -1
+                if inserted:
+                    self._id = self.database.execute_insert(self._generate_insert_SQL())
+                else:
+                    self.database.execute_update(self._generate_update_SQL())
+                self.database.on_rollback(functools.partial(self._undo_save, self._dirty_fields, inserted))
+        finally:
+            self._after_save()
         self._dirty = False
 
+    def _undo_save(self, dirty_fields, inserted):
+        """Rollback hook for save(): the fields it wrote are unsaved again, and
+        a record it inserted no longer has an id."""
+        if inserted:
+            self._id = -1
+            self._dirty = True
+        else:
+            self._dirty_fields = self._dirty_fields | dirty_fields
+
     def delete(self):
-        """Save this record to the database."""
+        """Delete this record from the database. Inside database.transaction()
+        the delete is committed with the rest of the transaction."""
 
         if self.id != -1:
-            self.database.execute_update(self._generate_delete_SQL())
+            with self.database.transaction(savepoint=False):
+                self.database.execute_update(self._generate_delete_SQL())
+            self._forget()
             self._id = -1
 
+    def _before_save(self):
+        """Called just before the record is written by save() or save_many().
+        Subclasses override this to adjust values on the way to the database."""
+        pass
+
+    def _after_save(self):
+        """Called after the record has been written (or the write failed) by
+        save() or save_many(), to undo anything done by _before_save()."""
+        pass
+
+    # ============== Bulk CRUD methods ==================
+    bulk_chunk_size = 500 # Default number of rows per statement for save_many() and delete_many()
+
+    @staticmethod
+    def save_many(records, chunk_size=None):
+        """Save a list of records, which may be of different types, using as
+        few statements as possible: new records of each type are inserted with
+        multi-row INSERTs, existing ones updated with executemany(). Each
+        database's writes are made in one transaction, and the records are
+        given their ids and marked clean as they are written; if the
+        transaction is rolled back, then or by an outer transaction later,
+        they are left unsaved again. If the database can't promise
+        consecutive ids (see consecutive_insert_ids) new records are inserted
+        one at a time."""
+
+        databases = {}
+        for (cls, database), group in HistoriaRecord._group_records(records).items():
+            databases.setdefault(database, []).append((cls, group))
+
+        for database, groups in databases.items():
+            if not database.connected:
+                raise DataConnectionError("Cannot save without an active database connection")
+
+            with database.transaction(savepoint=False):
+                for cls, group in groups:
+                    cls._save_group(database, group, chunk_size or cls.bulk_chunk_size)
+
+    @classmethod
+    def _save_group(cls, database, group, size):
+        """Write save_many()'s records of this class, inside a transaction on
+        database."""
+        group = [r for r in group if r.id == -1 or r._dirty]
+        new_ids = []
+        for record in group:
+            record._before_save()
+        try:
+            inserts = [r for r in group if r.id == -1]
+            if inserts and cls._sql['auto_increment'] and not database.consecutive_insert_ids:
+                for record in inserts:
+                    new_ids.append((record, database.execute_insert(record._generate_insert_SQL())))
+                inserts = []
+            for start in range(0, len(inserts), size):
+                chunk = inserts[start:start + size]
+                first_id = database.execute_insert(cls._generate_bulk_insert_SQL(chunk))
+                new_ids += cls._bulk_insert_ids(chunk, first_id)
+
+            updates = {}
+            for record in group:
+                if record.id != -1:
+                    statement, values = record._generate_update_SQL()
+                    updates.setdefault(statement, []).append(values)
+            for statement, value_list in updates.items():
+                for start in range(0, len(value_list), size):
+                    database.execute_many((statement, value_list[start:start + size]))
+        finally:
+            for record in group:
+                record._after_save()
+
+        inserted = set(id(record) for record, new_id in new_ids)
+        for record, new_id in new_ids:
+            record._id = new_id
+        for record in group:
+            database.on_rollback(functools.partial(record._undo_save, record._dirty_fields, id(record) in inserted))
+            record._dirty = False
+
+    @staticmethod
+    def delete_many(records, chunk_size=None):
+        """Delete a list of records, which may be of different types, with one
+        DELETE ... WHERE key IN (...) per chunk of each type. Records that were
+        never saved are skipped."""
+
+        saved = [r for r in records if r.id != -1]
+        for (cls, database), group in HistoriaRecord._group_records(saved).items():
+            size = chunk_size or cls.bulk_chunk_size
+            with database.transaction(savepoint=False):
+                for start in range(0, len(group), size):
+                    database.execute_update(cls._generate_bulk_delete_SQL(group[start:start + size]))
+
+        for record in saved:
+            record._forget()
+            record._id = -1
+
+    @staticmethod
+    def _group_records(records):
+        """Group records by class and database, keeping their order."""
+        groups = {}
+        for record in records:
+            groups.setdefault((type(record), record.database), []).append(record)
+        return groups
+
+    @classmethod
+    def _bulk_insert_ids(cls, records, first_id):
+        """Pair each record from a multi-row INSERT with its new id. Only used
+        when database.consecutive_insert_ids is True: InnoDB then hands out
+        consecutive auto-increment values to a multi-row INSERT (the row count
+        is known up front), and reports the first one."""
+        if not cls._sql['auto_increment']:
+            return [(r, first_id) for r in records] # Matches what save() records
+        return [(r, first_id + i) for i, r in enumerate(records)]
+
     def load(self, recordID):
         """Load a record from the database into this object."""
 
@@ -366,18 +956,105 @@ class HistoriaRecord(HistoriaDataObject):
             raise DataLoadError("No records found with matching ID {0}".format(recordID))
 
         if len(data) > 1:
-            self.logger.error("Duplicate records found with matching ID{0}".format(recordID))
+            self._logger.error("Duplicate records found with matching ID{0}".format(recordID))
             raise DataLoadError("Duplicate records found with matching ID{0}".format(recordID))
 
-        data = data[0]
+        self._hydrate(data[0])
 
-        for field in data:
-            if field == 'id':
-                self._id = data[field]
+    @classmethod
+    def load_many(cls, database, recordIDs, chunk_size=None):
+        """Return the records with the ids in recordIDs, in the same order,
+        reading chunk_size of them at a time with one SELECT ... WHERE key IN
+        (...). Ids that don't match a record are left out. Inside
+        database.unit_of_work() records already in the identity map aren't
+        read again, and the others are added to it."""
+
+        identity_map = database.identity_map
+        if identity_map is None:
+            identity_map = {}
+
+        recordIDs = [cls._normalize_id(recordID) for recordID in recordIDs]
+        found = {}
+        missing = []
+        for recordID in dict.fromkeys(recordIDs):
+            if (cls.machine_type, recordID) in identity_map:
+                found[recordID] = identity_map[(cls.machine_type, recordID)]
             else:
-                setattr(self, field, data[field])
+                missing.append(recordID)
 
-        self._dirty = False
+        size = chunk_size or cls.bulk_chunk_size
+        for start in range(0, len(missing), size):
+            rows = database.execute_select(cls._generate_bulk_select_SQL(missing[start:start + size]))
+            for row in rows:
+                found[row[cls._primary_key]] = cls._from_row(database, row)
+
+        return [found[recordID] for recordID in recordIDs if recordID in found]
+
+    @classmethod
+    def _from_row(cls, database, row, remember=True):
+        """Return a record built from a row read from this class's table, or
+        the copy already in the database's identity map. With remember=False
+        the identity map is left out."""
+        record = cls(database)
+        record._hydrate(row)
+        if remember:
+            return record._remember()
+        return record
+
+    def _hydrate(self, row):
+        """Fill in this record from a row read from its table. The values came
+        from MySQL, so they skip the checks made by __setattr__, and the
+        record is left clean."""
+        fields = type(self)._table_fields
+        for field, value in row.items():
+            if field == 'id':
+                self._id = value
+            elif field in fields:
+                HistoriaDataObject.__setattr__(self, field, value)
+
+        self._dirty_fields = _unchanged
+
+    @classmethod
+    def get(cls, database, recordID):
+        """Return the record with recordID. Inside database.unit_of_work() it is
+        only loaded the first time, after that the same object is returned."""
+
+        recordID = cls._normalize_id(recordID)
+        identity_map = database.identity_map
+        if identity_map is not None and (cls.machine_type, recordID) in identity_map:
+            return identity_map[(cls.machine_type, recordID)]
+
+        record = cls(database)
+        record.load(recordID)
+        return record._remember()
+
+    @classmethod
+    def _normalize_id(cls, recordID):
+        """Return recordID as the type of the id field, so ids given as strings
+        (e.g. request parameters) find records in the identity map."""
+        validator = cls._validators.get('id')
+        if validator is not None and validator[0] is int and not isinstance(recordID, int):
+            try:
+                return int(recordID)
+            except (TypeError, ValueError) as err:
+                raise DataLoadError("Invalid ID {0}".format(recordID))
+        return recordID
+
+    def _remember(self):
+        """Add this record to its database's identity map, if it's in a unit of
+        work and the map doesn't already hold the record. Returns the object
+        the map holds."""
+        identity_map = self.database.identity_map
+        if identity_map is None or self.id == -1:
+            return self
+        return identity_map.setdefault((self.machine_type, self.id), self)
+
+    def _forget(self):
+        """Drop this record from its database's identity map, i.e. it's been
+        deleted."""
+        identity_map = self.database.identity_map
+        if identity_map is not None and identity_map.get((self.machine_type, self.id)) is self:
+            del identity_map[(self.machine_type, self.id)]
 
     # ============== Database Generation Methods ==================
     @classmethod
@@ -486,100 +1163,234 @@ class HistoriaRecord(HistoriaDataObject):
         return line
 
     #  =============== CRUD Helpers ===================
-    def _generate_insert_SQL(self):
-        #INSERT INTO `Users` (`id`, `name`, `email`, `pass`, `modified`, `created`, `last_access`, `enabled`, `admin`) VALUES (NULL, 'aaron', 'acrosman@gmail.com', 'bcrypt_hash', CURRENT_TIMESTAMP, NOW(), NULL, '1', '0');
+    @classmethod
+    def _compile_SQL(cls):
+        """Build the statements used to save, load and delete records of this
+        class from _table_fields. Called once for each class as it is created
+        (see HistoriaRecordType) so each save only binds its values."""
+
+        # The key can be set directly for tables without a PRIMARY index.
+        key = cls.__dict__.get('_primary_key')
+        if key is None:
+            for field in cls._table_fields:
+                if 'index' in cls._table_fields[field]:
+                    if cls._table_fields[field]['index']['type'] == 'PRIMARY':
+                        key = field
+        cls._primary_key = key
+
+        sql = {'auto_increment': False,
+               'insert_fields': [],
+               'insert': {},
+               'insert_row': {},
+               'update': None,
+               'partial_update': {},
+               'select': None,
+               'delete': None}
+
+        update_fields = []
+        for field in sorted(cls._table_fields):
+            settings = cls._table_fields[field]
+            # Subclasses often share field dicts, so a missing default is read
+            # as None rather than written back
+            default = settings.get('default')
+            if default == 'AUTO_INCREMENT':
+                sql['auto_increment'] = True
+                continue # Don't touch auto fields
+            if settings['type'] == 'timestamp':
+                continue # timestamps should be set to care for themselves.
 
-        fields = {}
+            update_fields.append(field)
+            sql['insert_fields'].append((field,
+                                         default,
+                                         settings['type'] == 'datetime' and not settings['allow_null'],
+                                         not settings['allow_null'] and default == None and \
+                                         settings['type'] != 'datetime'))
 
-        statement = "INSERT INTO `{0}` ( ".format(self.machine_type)
-        value_placeholders = ""
-        for field in self._table_fields:
-            # A little error checking and cleanup to make sure there is a default
-            if 'default' not in self._table_fields[field]:
-                self._table_fields[field]['default'] = None
+        sql['insert_columns'] = ",".join("`{0}`".format(f[0]) for f in sql['insert_fields'])
 
-            if self._table_fields[field]['type'] == 'timestamp':
-                continue # timestamps should be set to care for themselves.
+        if key is not None:
+            sql['select'] = "SELECT * FROM `{0}` WHERE `{1}` = %({1})s".format(cls.machine_type, key)
+            sql['update'] = ("UPDATE `{0}` SET {1} WHERE `{2}` = %({2})s".format(
+                                cls.machine_type,
+                                ",".join("`{0}` = %({0})s".format(f) for f in update_fields),
+                                key),
+                             tuple(update_fields))
+            sql['delete'] = "DELETE FROM `{0}` WHERE `{1}` = %({1})s".format(cls.machine_type, key)
 
-            if not self._table_fields[field]['allow_null'] and \
-                    getattr(self, field) == None and \
-                    self._table_fields[field]['default'] == None and \
-                    self._table_fields[field]['type'] != 'datetime':
-                raise DataSaveError("{0} cannot be Null".format(field))
-
-            if self._table_fields[field]['default'] =='AUTO_INCREMENT':
-                fields[field] = None
-            elif self._table_fields[field]['type'] == 'datetime' and \
-                    not self._table_fields[field]['allow_null'] and \
-                    getattr(self, field) == None:
-                statement += "`{0}`,".format(field)
-                value_placeholders += "NOW(),"
-            else:
-                fields[field] = getattr(self, field)
-                if fields[field] == None and self._table_fields[field]['default'] != None:
-                    fields[field] =self._table_fields[field]['default']
-                statement += "`{0}`,".format(field)
-                value_placeholders += "%({0})s,".format(field)
+        cls._sql = sql
 
-        statement = statement[:-1] + " ) VALUES ( " + value_placeholders[:-1] + ")"
+    @classmethod
+    def _compile_validators(cls):
+        """Build the table __setattr__ uses to check values: for each field
+        either None (any value) or a tuple of the python type its values must
+        be and the error message. Called once for each class as it is created
+        (see HistoriaRecordType) so the field's SQL type isn't looked up on
+        every set."""
+
+        checks = ((cls._is_type_int, int, "{0} should be an int but {1} provided"),
+                  (cls._is_type_text, str, "{0} should be a text type (str) but {1} provided"),
+                  (cls._is_type_float, float, "{0} should be a float type  but {1} provided"),
+                  (cls._is_type_datetime, datetime.datetime, "{0} should be a datetime type but {1} provided"))
+
+        cls._validators = {}
+        for field, settings in cls._table_fields.items():
+            cls._validators[field] = None
+            for is_type, python_type, message in checks:
+                if is_type(settings['type']):
+                    cls._validators[field] = (python_type, message)
+                    break
 
-        return (statement, fields)
+    @classmethod
+    def _prepared_SQL(cls):
+        """The statements a database should prepare for this class, see
+        _prepare."""
+        statements = []
+        for name in cls._prepare:
+            statement = cls._sql[name]
+            if name == 'update':
+                statement = statement[0]
+            if statement is not None:
+                statements.append(statement)
+        return statements
 
-    def _generate_select_SQL(self, primary_id):
+    def _generate_insert_SQL(self):
+        #INSERT INTO `Users` (`id`, `name`, `email`, `pass`, `modified`, `created`, `last_access`, `enabled`, `admin`) VALUES (NULL, 'aaron', 'acrosman@gmail.com', 'bcrypt_hash', CURRENT_TIMESTAMP, NOW(), NULL, '1', '0');
+
+        now_fields, values = self._insert_values()
+        sql = type(self)._sql
 
         fields = {}
-        statement = "SELECT * FROM `{0}` ".format(self.machine_type)
+        for field, value in zip(sql['insert_fields'], values):
+            if not field[0] in now_fields:
+                fields[field[0]] = value
+
+        # One version of the statement for each set of fields left to NOW()
+        statement = sql['insert'].get(now_fields)
+        if statement is None:
+            placeholders = ["NOW()" if f[0] in now_fields else "%({0})s".format(f[0])
+                            for f in sql['insert_fields']]
+            statement = "INSERT INTO `{0}` ( {1} ) VALUES ( {2})".format(self.machine_type,
+                                                                         sql['insert_columns'],
+                                                                         ",".join(placeholders))
+            sql['insert'][now_fields] = statement
 
-        for field in self._table_fields:
-            if 'index' in self._table_fields[field]:
-                if self._table_fields[field]['index']['type'] == 'PRIMARY':
-                    statement += "WHERE `{0}` = %({1})s".format(field,field)
-                    fields[field] = primary_id
+        return (statement, fields)
+
+    @classmethod
+    def _generate_bulk_insert_SQL(cls, records):
+        """Generate one multi-row INSERT for a list of new records of this
+        class."""
+
+        sql = cls._sql
+        rows = []
+        fields = []
+        for record in records:
+            now_fields, values = record._insert_values()
+            row = sql['insert_row'].get(now_fields)
+            if row is None:
+                row = "( {0})".format(",".join("NOW()" if f[0] in now_fields else "%s"
+                                               for f in sql['insert_fields']))
+                sql['insert_row'][now_fields] = row
+            rows.append(row)
+            fields += [v for f, v in zip(sql['insert_fields'], values) if not f[0] in now_fields]
+
+        statement = "INSERT INTO `{0}` ( {1} ) VALUES {2}".format(cls.machine_type,
+                                                                  sql['insert_columns'],
+                                                                  ",".join(rows))
 
         return (statement, fields)
 
+    def _insert_values(self):
+        """Returns the fields to be set to NOW() and the value of every field
+        to insert, in the order of _sql['insert_fields']."""
 
-    def _generate_update_SQL(self):
+        now_fields = []
+        values = []
+        for field, default, now, required in type(self)._sql['insert_fields']:
+            value = getattr(self, field)
+            if value == None:
+                if required:
+                    raise DataSaveError("{0} cannot be Null".format(field))
+                if now:
+                    now_fields.append(field)
+                elif default != None:
+                    value = default
+            values.append(value)
 
-        fields = {}
-        primary = ''
+        return (frozenset(now_fields), values)
 
-        statement = "UPDATE `{0}` SET ".format(self.machine_type)
+    def _generate_select_SQL(self, primary_id):
 
-        for field in self._table_fields:
-            if 'default' not in self._table_fields[field]:
-                self._table_fields[field]['default'] = None
+        statement = type(self)._sql['select']
+        if statement is None:
+            raise DataLoadError("{0} has no primary key field".format(self.machine_type))
 
-            if 'index' in self._table_fields[field]:
-                if self._table_fields[field]['index']['type'] == 'PRIMARY':
-                    primary = field
+        return (statement, {self._primary_key: primary_id})
 
-            if self._table_fields[field]['default'] =='AUTO_INCREMENT':
-                continue # Don't touch auto fields
+    @classmethod
+    def _generate_bulk_select_SQL(cls, recordIDs):
+        """Generate one SELECT for the records of this class with the given
+        ids."""
 
-            if self._table_fields[field]['type'] == 'timestamp':
-                continue # timestamps should be set to care for themselves.
+        if cls._primary_key is None:
+            raise DataLoadError("{0} has no primary key field".format(cls.machine_type))
 
-            fields[field] = getattr(self, field)
-            statement += "`{0}` = %({1})s,".format(field, field)
+        statement = "SELECT * FROM `{0}` WHERE `{1}` IN ({2})".format(cls.machine_type, cls._primary_key,
+                                                                     ",".join(["%s"] * len(recordIDs)))
 
+        return (statement, list(recordIDs))
 
-        statement = statement[:-1] + " WHERE `{0}` = %({1})s".format(primary, primary)
-        fields[primary] = getattr(self, primary)
+    def _generate_update_SQL(self):
+        """Generate an UPDATE for the fields that have changed, or every field
+        if none have."""
+
+        sql = type(self)._sql
+        if sql['update'] is None:
+            raise DataSaveError("{0} has no primary key field".format(self.machine_type))
+        statement, update_fields = sql['update']
+
+        changed = tuple(f for f in update_fields if f in self._dirty_fields)
+        if changed and changed != update_fields:
+            # One version of the statement for each set of changed fields
+            statement = sql['partial_update'].get(changed)
+            if statement is None:
+                statement = "UPDATE `{0}` SET {1} WHERE `{2}` = %({2})s".format(
+                                self.machine_type,
+                                ",".join("`{0}` = %({0})s".format(f) for f in changed),
+                                self._primary_key)
+                sql['partial_update'][changed] = statement
+            update_fields = changed
+
+        if 'update' in self._prepare:
+            # Partial statements are only known once they're generated
+            self.database.prepare(statement)
+
+        fields = {}
+        for field in update_fields:
+            fields[field] = getattr(self, field)
+        fields[self._primary_key] = getattr(self, self._primary_key)
 
         return (statement, fields)
 
     def _generate_delete_SQL(self):
 
-        statement = "DELETE FROM `{0}` ".format(self.machine_type)
-        fields = {}
-        for field in self._table_fields:
-            if 'index' in self._table_fields[field]:
-                if self._table_fields[field]['index']['type'] == 'PRIMARY':
-                    statement += " WHERE `{0}` = %({1})s".format(field, field)
-                    fields[field] = getattr(self, field)
+        statement = type(self)._sql['delete']
+        if statement is None:
+            raise DataSaveError("{0} has no primary key field".format(self.machine_type))
 
-        return (statement, fields)
+        return (statement, {self._primary_key: getattr(self, self._primary_key)})
+
+    @classmethod
+    def _generate_bulk_delete_SQL(cls, records):
+        """Generate one DELETE for a list of saved records of this class."""
+
+        if cls._primary_key is None:
+            raise DataSaveError("{0} has no primary key field".format(cls.machine_type))
+
+        statement = "DELETE FROM `{0}` WHERE `{1}` IN ({2})".format(cls.machine_type, cls._primary_key,
+                                                                   ",".join(["%s"] * len(records)))
+
+        return (statement, [getattr(r, cls._primary_key) for r in records])
 
     #================ Other Helpers =====================
     @staticmethod
@@ -669,20 +1480,22 @@ class HistoriaDatabaseSearch(object):
         self._joins[table] = (main_field, table_field, operation)
 
     def add_condition(self, field, value, comparison = "=", scope="AND"):
-        if scope is not "AND" and scope is not "OR":
+        if scope != "AND" and scope != "OR":
             raise ValueError("Scope must be AND or OR")
         self._conditions.append((field, value, comparison, scope))
 
     def add_sort(self, field, direction="ASC"):
-        if direction is not "ASC" and direction is not "DESC":
+        if direction != "ASC" and direction != "DESC":
             raise ValueError("Sort direction must be 'ASC' or 'DESC'")
         self._sorts.append((field, direction))
 
     def add_limit(self, limit=None):
         self._limit = limit
 
-    def _generate_sql(self):
-        """Returns (select_statement, values)"""
+    def _generate_sql(self, after=None, limit=None):
+        """Returns (select_statement, values). after is a list of values, one
+        for each sort, to start the results after (see page_after()) and
+        limit replaces the limit set by add_limit()."""
 
         sql = "SELECT "
         values = {}
@@ -695,52 +1508,202 @@ class HistoriaDatabaseSearch(object):
             else:
                 sql += " `{0}` AS {1},".format(f, self._return_fields[f])
 
+        if len(self._return_fields) == 0:
+            sql += "*,"
+
         sql = sql[:-1] + ' FROM `{0}` '.format(self.search_scope)
 
         for j in self._joins:
             sql += " LEFT JOIN {0} ON {1} {2} {3} ".format(j, self._joins[j][0], self._joins[j][2], self._joins[j][1])
 
-        sql += " WHERE "
-        first = True
+        where = ""
         for c in self._conditions:
-            if not first:
-                sql += c[3]
+            if where:
+                where += c[3]
 
             # Make sure we have a unquie index for the values
-            inc = 0
-            base = c[0]
-            index = base
-            while index in values:
-                index = "{0}_{1}".format(base, inc)
-                inc += 1
-
+            index = self._value_index(c[0], values)
             place_holder = '%({0})s'.format(index)
 
-            sql += " `{0}` {1} {2} ".format(c[0], c[2], place_holder)
+            where += " `{0}` {1} {2} ".format(c[0], c[2], place_holder)
             values[index] = c[1]
-            first = False
+
+        if after is not None:
+            seek = self._generate_seek_sql(after, values)
+            where = "({0}) AND {1}".format(where, seek) if where else seek
+
+        if where:
+            sql += " WHERE " + where
 
         if len(self._sorts) > 0:
-            sql += " ORDER BY "
-            for s in self._sorts:
-                sql += " `{0}` {1}".format(s[0], s[1])
+            sql += " ORDER BY " + ", ".join("`{0}` {1}".format(s[0], s[1]) for s in self._sorts)
 
-        if self._limit is not None:
-            sql += " LIMIT {0}".format(self._limit)
+        if limit is None:
+            limit = self._limit
+        if limit is not None:
+            sql += " LIMIT {0}".format(int(limit))
 
         return (sql, values)
 
-    def execute_search(self):
+    def execute_search(self, hydrate=None, stream=False, batch_size=1000):
+        """Run the search and return the rows found. With hydrate set to a
+        HistoriaRecord class, records of that class built from the rows are
+        returned instead, so the search needs to return the record's fields
+        (if no fields are added, all of them are).
+
+        With stream=True a generator is returned instead of a list, which
+        reads the results batch_size rows at a time (see
+        HistoriaDatabase.iter_select()). Streamed records aren't added to the
+        identity map, and no NoSearchResults is raised, the generator is just
+        empty.
+
+        If the database has a search_cache, results of searches that aren't
+        streamed come from it until the tables searched are written to."""
         if self.search_scope is None:
             raise SearchError("Seach scope not set")
         statement = self._generate_sql()
-        results = self.database.execute_select(statement)
-        if len(results) is 0:
+        if stream:
+            return self._stream(statement, hydrate, batch_size)
+
+        results = self._select(statement)
+        if len(results) == 0:
             raise NoSearchResults("No search results found")
-        else:
-            self.saved_results = results
+
+        if hydrate is not None:
+            results = [hydrate._from_row(self.database, row) for row in results]
+        self.saved_results = results
         return self.saved_results
 
+    def page_after(self, after=None, size=50, hydrate=None):
+        """Return one page of results: up to size rows (or records, see
+        execute_search()) coming after the point given by after, and a token
+        for the page following this one, or None if this is the last page.
+
+        This is keyset pagination: the search must have sorts, the last of
+        which should be on a unique field such as id, and the sorted fields
+        must be returned by the search. after is either None for the first
+        page, a token from the previous page, or a list with a value for each
+        sort. No NoSearchResults is raised, an empty page is returned."""
+        if self.search_scope is None:
+            raise SearchError("Seach scope not set")
+        if len(self._sorts) == 0:
+            raise SearchError("Cannot page through a search without sorts")
+
+        if isinstance(after, str):
+            after = self.decode_token(after)
+        if after is not None and len(after) != len(self._sorts):
+            raise ValueError("Page must start after one value for each sort")
+
+        # One extra row shows whether there is another page
+        results = self._select(self._generate_sql(after, size + 1))
+        if hydrate is not None:
+            results = [hydrate._from_row(self.database, row) for row in results]
+
+        token = None
+        if len(results) > size:
+            results = results[:size]
+            last = results[-1]
+            if hydrate is None:
+                token = self.encode_token([last[s[0]] for s in self._sorts])
+            else:
+                token = self.encode_token([getattr(last, s[0]) for s in self._sorts])
+
+        return (results, token)
+
+    @staticmethod
+    def encode_token(values):
+        """Encode the sort values of a page's last row as a continuation token
+        for page_after(). Dates become strings, which MySQL compares just as
+        well."""
+        data = json.dumps(values, default=str).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @staticmethod
+    def decode_token(token):
+        """Return the list of sort values in a continuation token. Raises
+        ValueError for a token that wasn't made by encode_token()."""
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        except (TypeError, UnicodeError, ValueError) as err:
+            raise ValueError("Invalid page token")
+        if not isinstance(values, list):
+            raise ValueError("Invalid page token")
+        return values
+
+    def _generate_seek_sql(self, after, values):
+        """Generate the condition for rows coming after the given sort values.
+        When all sorts go the same way this is a row comparison such as
+        (`a`, `b`) > (1, 2), otherwise it is spelled out field by field."""
+        place_holders = []
+        for (field, direction), value in zip(self._sorts, after):
+            index = self._value_index("after_" + field, values)
+            values[index] = value
+            place_holders.append('%({0})s'.format(index))
+
+        directions = set(s[1] for s in self._sorts)
+        if len(directions) == 1:
+            return " ({0}) {1} ({2}) ".format(", ".join("`{0}`".format(s[0]) for s in self._sorts),
+                                              ">" if "ASC" in directions else "<",
+                                              ", ".join(place_holders))
+
+        alternatives = []
+        for i, (field, direction) in enumerate(self._sorts):
+            terms = ["`{0}` = {1}".format(self._sorts[j][0], place_holders[j]) for j in range(i)]
+            terms.append("`{0}` {1} {2}".format(field, ">" if direction == "ASC" else "<", place_holders[i]))
+            alternatives.append("({0})".format(" AND ".join(terms)))
+        return " ({0}) ".format(" OR ".join(alternatives))
+
+    @staticmethod
+    def _value_index(base, values):
+        """Return a name for a value, based on base, not already in values."""
+        inc = 0
+        index = base
+        while index in values:
+            index = "{0}_{1}".format(base, inc)
+            inc += 1
+        return index
+
+    def _select(self, statement):
+        # Results read inside a transaction may include its uncommitted writes
+        cache = self.database.search_cache
+        key = None
+        if cache is not None and not self.database.in_transaction:
+            key = cache.key(statement)
+        if key is not None:
+            tables = [self.search_scope] + list(self._joins)
+            results = cache.get(key, tables)
+            if results is not None:
+                return results
+            versions = cache.versions(tables)
+
+        diagnostics = self.database.query_diagnostics
+        start = time.monotonic()
+        results = self.database.execute_select(statement)
+        if diagnostics is not None:
+            diagnostics.observe(self.database, statement, self._searched_columns(), time.monotonic() - start)
+
+        if key is not None:
+            cache.put(key, versions, results)
+        return results
+
+    def _stream(self, statement, hydrate, batch_size):
+        start = time.monotonic()
+        for row in self.database.iter_select(statement, batch_size):
+            if hydrate is None:
+                yield row
+            else:
+                yield hydrate._from_row(self.database, row, remember=False)
+
+        # Only once the rows are all read is the connection free for EXPLAIN
+        diagnostics = self.database.query_diagnostics
+        if diagnostics is not None:
+            diagnostics.observe(self.database, statement, self._searched_columns(), time.monotonic() - start)
+
+    def _searched_columns(self):
+        """The fields the search filters and sorts on."""
+        columns = [c[0] for c in self._conditions] + [s[0] for s in self._sorts]
+        return list(dict.fromkeys(columns))
+
 if __name__ == '__main__':
     import unittest
     import tests.test_core_data
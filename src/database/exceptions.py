@@ -69,3 +69,7 @@ class InvalidDataError(HistoriaDataException):
 class SourceTypeError(HistoriaDataException):
     """Raised when there is a problem with a SourceType object."""
     pass
+
+class PasswordHasherBusy(HistoriaDataException):
+    """Raised when too many passwords are already waiting to be hashed."""
+    pass
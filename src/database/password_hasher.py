@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+password_hasher.py
+
+Password hashing for HistoriaUser, done in a pool of worker processes so
+request threads aren't tied up running bcrypt.
+
+Created by Aaron Crosman on 2015-03-16.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+
+import bcrypt
+
+from .exceptions import *
+
+
+def hash_password(password, rounds):
+    """Return the bcrypt hash of password (bytes) with a new salt."""
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def check_password(password, hashed):
+    """Return True if password (bytes) matches the bcrypt hash."""
+    return bcrypt.checkpw(password, hashed)
+
+
+class HistoriaPasswordHasher(object):
+    """Hashes and checks passwords with bcrypt using rounds as the work factor.
+    The work is sent to a pool of worker processes (one per core if workers
+    is None); with workers=0 it is done in the calling thread instead. At most
+    max_pending hashes may be running or waiting at once, beyond that
+    PasswordHasherBusy is raised rather than letting requests pile up."""
+
+    def __init__(self, workers=None, rounds=12, max_pending=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = int(workers)
+        self.rounds = int(rounds)
+        if max_pending is None:
+            max_pending = max(self.workers, 1) * 4
+        self.max_pending = int(max_pending)
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_pid = None
+        self._stats = {
+            'hashed':   0,
+            'checked':  0,
+            'rejected': 0
+        }
+
+    def hash(self, password):
+        """Return a new hash of password (bytes)."""
+        result = self._run(hash_password, password, self.rounds)
+        with self._lock:
+            self._stats['hashed'] += 1
+        return result
+
+    def check(self, password, hashed):
+        """Return True if password (bytes) matches hashed."""
+        result = self._run(check_password, password, hashed)
+        with self._lock:
+            self._stats['checked'] += 1
+        return result
+
+    def close(self):
+        """Shut down the worker processes."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        """Return a dict of counters: passwords hashed and checked, and
+        requests turned away because the hasher was busy."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['max_pending'] = self.max_pending
+        return stats
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise PasswordHasherBusy("Too many passwords waiting to be hashed")
+
+        try:
+            if self.workers == 0:
+                return function(*args)
+            return self._get_executor().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        # A pool inherited from before a fork belongs to the parent process.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                        mp_context=self._mp_context())
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    @staticmethod
+    def _mp_context():
+        """The pool is started once the server is running threads, and forking
+        a process with threads can leave the child stuck on a lock another
+        thread held. Workers are started by a fork server (or spawned where
+        there isn't one) instead."""
+        try:
+            context = multiprocessing.get_context('forkserver')
+        except ValueError as err:
+            return multiprocessing.get_context('spawn')
+        # Without this the fork server imports the program's __main__ too
+        context.set_forkserver_preload(['database.password_hasher'])
+        return context
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+prepared_statements.py
+
+Server side prepared statements for the queries a HistoriaDatabase runs most
+often.
+
+Created by Aaron Crosman on 2015-03-12.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import threading
+import weakref
+
+import mysql.connector
+
+from .exceptions import *
+
+
+class HistoriaPreparedStatements(object):
+    """A registry of statements to run as prepared statements. Statements are
+    registered with the usual %(name)s parameters and rewritten to MySQL's ?
+    markers. Each connection keeps a prepared cursor for each statement it has
+    run, so the server parses a statement once per connection rather than
+    once per query. Cursors are dropped along with their connection."""
+
+    _parameter = re.compile(r"%\((\w+)\)s")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statements = {}  # statement: (prepared statement, parameter names)
+        self._cursors = weakref.WeakKeyDictionary()  # connection: {statement: cursor}
+        self._stats = {
+            'prepares':   0,
+            'hits':       0,
+            'fallbacks':  0
+        }
+
+    def register(self, statement):
+        """Add a statement to the registry."""
+        names = tuple(self._parameter.findall(statement))
+        with self._lock:
+            self._statements[statement] = (self._parameter.sub("?", statement), names)
+
+    def registered(self, statement):
+        return statement in self._statements
+
+    def execute(self, connection, prepared_statement):
+        """Run a registered statement on connection's prepared cursor for it
+        and return the cursor, which must not be closed. Errors are raised
+        after the cursor is thrown away so the caller can fall back to a
+        regular cursor."""
+        statement, values = prepared_statement
+        sql, names = self._statements[statement]
+
+        with self._lock:
+            cursors = self._cursors.setdefault(connection, {})
+            cur = cursors.get(statement)
+
+        try:
+            if cur is None:
+                cur = connection.cursor(prepared=True)
+                with self._lock:
+                    cursors[statement] = cur
+                    self._stats['prepares'] += 1
+            else:
+                with self._lock:
+                    self._stats['hits'] += 1
+
+            cur.execute(sql, tuple(values[name] for name in names))
+        except mysql.connector.Error as err:
+            with self._lock:
+                cursors.pop(statement, None)
+                self._stats['fallbacks'] += 1
+            self._close(cur)
+            raise
+
+        return cur
+
+    def stats(self):
+        """Return a dict of counters: prepares is the number of statements
+        parsed by the server, hits the number of runs that reused one, and
+        fallbacks the number of runs that failed and went to a regular
+        cursor."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['registered'] = len(self._statements)
+            stats['connections'] = len(self._cursors)
+        return stats
+
+    @staticmethod
+    def _close(cursor):
+        if cursor is None:
+            return
+        try:
+            cursor.close()
+        except mysql.connector.Error as err:
+            pass
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+query_diagnostics.py
+
+Optional diagnostics for the queries generated by HistoriaDatabaseSearch:
+query plans, full table scans and timings, to show which indexes are worth
+declaring in _table_fields.
+
+Created by Aaron Crosman on 2015-03-18.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import logging
+import threading
+
+from .exceptions import *
+
+
+class HistoriaQueryDiagnostics(object):
+    """Collects a plan and timings for each shape of search query run against
+    a database. The first time a shape is seen it is run through EXPLAIN, and
+    a warning is logged if MySQL reads a whole table to answer it. Searches
+    taking slow_query_time seconds or more on average are listed by
+    report()."""
+
+    _limit = re.compile(r"LIMIT \d+")
+
+    def __init__(self, slow_query_time=0.1):
+        self._logger = logging.getLogger("historia.db")
+        self.slow_query_time = slow_query_time
+
+        self._lock = threading.Lock()
+        self._shapes = {}  # shape: {'columns', 'plan', 'full_scans', 'count', 'total_time', 'max_time'}
+
+    @classmethod
+    def shape(cls, statement):
+        """The statement with anything that changes between runs of the same
+        search (the values are already separate) taken out."""
+        return cls._limit.sub("LIMIT ?", statement)
+
+    def observe(self, database, prepared_statement, columns, elapsed):
+        """Record a search that took elapsed seconds. columns are the fields
+        the search filters and sorts on, named in the warning for a full
+        scan."""
+        shape = self.shape(prepared_statement[0])
+        with self._lock:
+            entry = self._shapes.get(shape)
+            new = entry is None
+            if new:
+                entry = self._shapes[shape] = {'columns':    tuple(columns),
+                                               'plan':       None,
+                                               'full_scans': [],
+                                               'count':      0,
+                                               'total_time': 0.0,
+                                               'max_time':   0.0}
+            entry['count'] += 1
+            entry['total_time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
+
+        if new:
+            self._explain(database, prepared_statement, shape, entry)
+
+    def _explain(self, database, prepared_statement, shape, entry):
+        try:
+            plan = database.execute_select(("EXPLAIN " + prepared_statement[0], prepared_statement[1]))
+        except HistoriaDataException as err:
+            self._logger.warning("Unable to explain search {0}: {1}".format(shape, err))
+            return
+
+        # A type of ALL means every row of the table is read
+        full_scans = [(step['table'], step['rows']) for step in plan if step.get('type') == 'ALL']
+        with self._lock:
+            entry['plan'] = plan
+            entry['full_scans'] = full_scans
+
+        for table, rows in full_scans:
+            self._logger.warning("Full scan of `{0}` (about {1} rows) for search on {2}: {3}".format(
+                                     table, rows, ", ".join(entry['columns']) or "no columns", shape))
+
+    def plan(self, statement):
+        """Return the EXPLAIN output for a statement's shape, or None if it
+        hasn't been seen (or couldn't be explained)."""
+        with self._lock:
+            entry = self._shapes.get(self.shape(statement))
+            return entry['plan'] if entry is not None else None
+
+    def report(self):
+        """Return a list of the search shapes that are slow or scan whole
+        tables, slowest in total first. Each is a dict with the shape, the
+        columns searched, the tables scanned, and the number of runs with
+        their total, mean and longest times."""
+        with self._lock:
+            entries = [(shape, dict(entry)) for shape, entry in self._shapes.items()]
+
+        report = []
+        for shape, entry in entries:
+            mean = entry['total_time'] / entry['count']
+            if mean < self.slow_query_time and not entry['full_scans']:
+                continue
+            report.append({'shape':        shape,
+                           'columns':      entry['columns'],
+                           'full_scans':   [table for table, rows in entry['full_scans']],
+                           'count':        entry['count'],
+                           'total_time':   entry['total_time'],
+                           'mean_time':    mean,
+                           'max_time':     entry['max_time']})
+
+        report.sort(key=lambda r: r['total_time'], reverse=True)
+        return report
+
+    def log_report(self):
+        """Log report(), one warning per search shape."""
+        for r in self.report():
+            self._logger.warning("Search run {0} times, {1:.3f}s total, {2:.3f}s mean, {3:.3f}s max{4}: {5}".format(
+                                     r['count'], r['total_time'], r['mean_time'], r['max_time'],
+                                     ", full scan of " + ", ".join(r['full_scans']) if r['full_scans'] else "",
+                                     r['shape']))
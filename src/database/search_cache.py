@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+search_cache.py
+
+An in memory cache of search results, so repeating a search doesn't query
+MySQL again until one of the tables it reads has been written to.
+
+Created by Aaron Crosman on 2015-03-19.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import time
+import threading
+import collections
+
+
+class HistoriaSearchCache(object):
+    """Least recently used cache of search results keyed by statement and
+    values. Each table has a version number, raised whenever the database
+    writes to it, and a result is only used while the tables it was read from
+    are at the versions they had when the search began. Entries also expire
+    ttl seconds after they were stored, to put a limit on how long writes
+    the cache can't see (from other processes) go unnoticed. No more than
+    max_size results are kept."""
+
+    # The table written by an INSERT, UPDATE, DELETE, etc.
+    _written_table = re.compile(r"^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM"
+                                r"|TRUNCATE(?:\s+TABLE)?|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)"
+                                r"\s+`?(\w+)`?", re.IGNORECASE)
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = int(max_size)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key: (rows, versions, expires)
+        self._versions = collections.defaultdict(int)  # table: version
+        self._generation = 0  # Raised for writes to unknown tables, invalidates everything
+        self._stats = {
+            'hits':          0,
+            'misses':        0,
+            'evictions':     0,
+            'invalidations': 0
+        }
+
+    @staticmethod
+    def key(prepared_statement):
+        """Return the cache key for a statement and its values, or None if
+        the values can't be used as a key."""
+        statement, values = prepared_statement
+        if isinstance(values, dict):
+            values = tuple(sorted(values.items()))
+        else:
+            values = tuple(values)
+        try:
+            hash(values)
+        except TypeError as err:
+            return None
+        return (statement, values)
+
+    def versions(self, tables):
+        """Return the current versions of tables, to be passed to put()."""
+        with self._lock:
+            return (self._generation, tuple(self._versions[t] for t in tables))
+
+    def get(self, key, tables):
+        """Return a copy of the cached rows for key, or None if they aren't
+        cached or one of tables has been written since."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                current = (self._generation, tuple(self._versions[t] for t in tables))
+                if entry[1] != current or entry[2] < time.monotonic():
+                    del self._entries[key]
+                    entry = None
+
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+
+        # Callers are free to change the rows they're given
+        return [dict(row) for row in entry[0]]
+
+    def put(self, key, versions, rows):
+        """Cache rows for key, read when the tables were at versions (from
+        versions(), called before the search ran)."""
+        rows = [dict(row) for row in rows]
+        with self._lock:
+            self._entries[key] = (rows, versions, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def written(self, statement):
+        """Note that statement has been committed, raising the version of the
+        table it wrote to (or of every table, if that can't be told)."""
+        match = self._written_table.match(statement)
+        with self._lock:
+            if match is None:
+                self._generation += 1
+            else:
+                self._versions[match.group(1)] += 1
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        """Return a dict of the cache's counters and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
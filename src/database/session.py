@@ -22,10 +22,13 @@ along with historia.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import abc
 import sys
 import os
 import ssl
 import uuid
+import logging
+import threading
 
 from .core_data_objects import *
 from .exceptions import *
@@ -59,6 +62,7 @@ class HistoriaSession(HistoriaRecord):
                                 'type':'datetime',
                                 'allow_null': True,
                                 'default': None,
+                                'index':      { 'type':'BASIC', 'fields': ('last_seen',)},
                                 'order': 5
                             },
                             'ip':{
@@ -69,6 +73,8 @@ class HistoriaSession(HistoriaRecord):
                                 'order':3
                             }
                         }
+    _primary_key = 'sessionid' # Session has no PRIMARY index
+    _prepare = ('select', 'update') # Loaded and saved on every request
     # The table fields here are just present for testing and are not expected to be used
     # Fields are defined as follows (this should get documented someplace better)
     # _table_fields = {'field_name': {'type': [type_name],
@@ -111,54 +117,223 @@ class HistoriaSession(HistoriaRecord):
         return self.sessionid
 
     # Overloaded to make sure we update the last_seen stamp
-    def save(self):
+    def _before_save(self):
         self.last_seen = datetime.datetime.now()
-        super().save()
 
     # Overloaded to make sure we get the right settings without ID in use
-    def load(self, recordID):
-        super().load(recordID)
+    def _hydrate(self, row):
+        super()._hydrate(row)
         self._id = self.sessionid
-        self._dirty = False
 
-    # Overloaded since session doesn't use primary key.
-    def _generate_select_SQL(self, session_id):
+    @classmethod
+    def _generate_last_seen_SQL(cls, touches):
+        """Generate one UPDATE setting last_seen for a list of (sessionid,
+        last_seen) pairs."""
 
-        fields = {'sessionid': session_id}
-        statement = "SELECT * FROM `{0}` WHERE `sessionid` = %({1})s".format(self.machine_type, 'sessionid')
+        cases = " ".join(["WHEN %s THEN %s"] * len(touches))
+        keys = ",".join(["%s"] * len(touches))
+        statement = "UPDATE `{0}` SET `last_seen` = CASE `sessionid` {1} END WHERE `sessionid` IN ({2})".format(
+                        cls.machine_type, cases, keys)
 
-        return (statement, fields)
-
-    # Overloaded since session doesn't use primary key.
-    def _generate_update_SQL(self):
-
-        fields = {}
-        primary = ''
-
-        statement = "UPDATE `{0}` SET ".format(self.machine_type)
-
-        for field in self._table_fields:
-            if 'default' not in self._table_fields[field]:
-                self._table_fields[field]['default'] = None
-
-            if 'index' in self._table_fields[field]:
-                if self._table_fields[field]['index']['type'] == 'PRIMARY':
-                    primary = field
-
-            if self._table_fields[field]['default'] =='AUTO_INCREMENT':
-                continue # Don't touch auto fields
-
-            if self._table_fields[field]['type'] == 'timestamp':
-                continue # timestamps should be set to care for themselves.
-
-            fields[field] = getattr(self, field)
-            statement += "`{0}` = %({1})s,".format(field, field)
-
-        statement = statement[:-1] + " WHERE `sessionid` = %(sessionid)s"
-        fields['sessionid'] = self.sessionid
+        fields = []
+        for sid, last_seen in touches:
+            fields += [sid, last_seen]
+        fields += [sid for sid, last_seen in touches]
 
         return (statement, fields)
 
+    @classmethod
+    def _generate_expired_SQL(cls, cutoff, limit):
+        """Generate a DELETE for up to limit sessions last seen before
+        cutoff."""
+
+        statement = "DELETE FROM `{0}` WHERE `last_seen` < %(cutoff)s LIMIT {1}".format(cls.machine_type, int(limit))
+
+        return (statement, {'cutoff': cutoff})
+
+
+class HistoriaSessionTask(abc.ABC):
+    """Base for work on the session table done every interval seconds by a
+    background thread. Subclasses provide run_once()."""
+
+    def __init__(self, database, interval):
+        self._logger = logging.getLogger("historia.db")
+        self.database = database
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start the background thread, if it isn't already running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="historia-{0}".format(type(self).__name__),
+                                                daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """Stop the background thread, waiting for it to finish."""
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+
+    @abc.abstractmethod
+    def run_once(self):
+        """Do one interval's work, called from the background thread."""
+
+    def _run(self):
+        # Without a pool the shared connection may be in use by a request, so
+        # this thread needs a connection of its own. Cycles are skipped until
+        # it can get one.
+        connected = self.database.pooled
+        try:
+            while not self._stopping.wait(self.interval):
+                if not connected:
+                    try:
+                        connected = self.database.connect_thread()
+                    except DataConnectionError as err:
+                        self._logger.error("{0} unable to connect to database, skipping cycle: {1}".format(type(self).__name__, err))
+                        continue
+                self.run_once()
+        finally:
+            self.database.disconnect_thread()
+
+
+class HistoriaSessionFlusher(HistoriaSessionTask):
+    """Collects last_seen updates for sessions in memory and writes them to the
+    database together, every interval seconds from a background thread and
+    whenever flush() is called. A session seen many times between flushes is
+    only written once, with the latest time."""
+
+    def __init__(self, database, interval=30, batch_size=500):
+        super().__init__(database, interval)
+        self.batch_size = int(batch_size)
+
+        self._pending = {}  # sessionid: last_seen
+        self._stats = {
+            'touches':  0,
+            'written':  0,
+            'batches':  0,
+            'failures': 0
+        }
+
+    def touch(self, session):
+        """Mark a session as seen now."""
+        now = datetime.datetime.now()
+        session.last_seen = now
+        session._dirty_fields -= {'last_seen'} # Written by flush(), not save()
+        with self._lock:
+            self._pending[session.sessionid] = now
+            self._stats['touches'] += 1
+        self.start()
+
+    def discard(self, session_id):
+        """Forget any unwritten update for a session, i.e. it's been deleted."""
+        with self._lock:
+            self._pending.pop(session_id, None)
+
+    def flush(self):
+        """Write all waiting updates, batch_size sessions per statement.
+        Returns the number of sessions written."""
+        with self._lock:
+            touches = list(self._pending.items())
+            self._pending = {}
+
+        written = 0
+        for start in range(0, len(touches), self.batch_size):
+            batch = touches[start:start + self.batch_size]
+            try:
+                self.database.execute_update(HistoriaSession._generate_last_seen_SQL(batch))
+            except HistoriaDataException as err:
+                self._logger.error("Unable to update last_seen for {0} sessions: {1}".format(len(batch), err))
+                with self._lock:
+                    self._stats['failures'] += 1
+                    for sid, last_seen in touches[start:]:
+                        # Newer touches since the flush began take priority.
+                        self._pending.setdefault(sid, last_seen)
+                break
+
+            written += len(batch)
+            with self._lock:
+                self._stats['written'] += len(batch)
+                self._stats['batches'] += 1
+
+        return written
+
+    def run_once(self):
+        self.flush()
+
+    def close(self):
+        """Stop the background thread and write anything still waiting."""
+        super().close()
+        self.flush()
+
+    def stats(self):
+        """Return a dict of counters: touches recorded, sessions written,
+        statements run and failed flushes, plus the number waiting."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+class HistoriaSessionReaper(HistoriaSessionTask):
+    """Deletes sessions not seen for ttl seconds, every interval seconds from
+    a background thread. Rows are deleted batch_size at a time, pausing
+    between batches, so no statement holds locks on the table for long."""
+
+    def __init__(self, database, ttl, interval=60, batch_size=1000, pause=0.1):
+        super().__init__(database, interval)
+        self.ttl = ttl
+        self.batch_size = int(batch_size)
+        self.pause = pause
+
+        self._stats = {
+            'cycles':       0,
+            'reaped':       0,
+            'last_reaped':  0,
+            'failures':     0
+        }
+
+    def reap(self):
+        """Delete every expired session. Returns the number deleted."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)
+        reaped = 0
+        batches = 0
+        while True:
+            try:
+                deleted = self.database.execute_update(HistoriaSession._generate_expired_SQL(cutoff, self.batch_size))
+            except HistoriaDataException as err:
+                self._logger.error("Unable to delete expired sessions: {0}".format(err))
+                with self._lock:
+                    self._stats['failures'] += 1
+                break
+
+            reaped += deleted
+            batches += 1
+            if deleted < self.batch_size or self._stopping.wait(self.pause):
+                break
+
+        with self._lock:
+            self._stats['cycles'] += 1
+            self._stats['reaped'] += reaped
+            self._stats['last_reaped'] = reaped
+
+        if reaped > 0:
+            self._logger.info("Reaped {0} sessions not seen since {1} in {2} batches".format(reaped, cutoff, batches))
+        return reaped
+
+    def run_once(self):
+        self.reap()
+
+    def stats(self):
+        """Return a dict of counters: reaping cycles run, sessions deleted in
+        total and by the last cycle, and failed cycles."""
+        with self._lock:
+            return dict(self._stats)
 
 
 if __name__ == '__main__':
@@ -25,9 +25,8 @@ along with historia.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import os
 
-import bcrypt
-
 from .core_data_objects import *
+from .password_hasher import *
 from .exceptions import *
 
 
@@ -98,6 +97,8 @@ class HistoriaUser(HistoriaRecord):
                                 'order': 9
                             }
                         }
+    _prepare = ('select',) # Loaded with the session on every request
+    password_hasher = HistoriaPasswordHasher(workers=0) # Replaced by the controller with one configured for the server
     # The table fields here are just present for testing and are not expected to be used
     # Fields are defined as follows (this should get documented someplace better)
     # _table_fields = {'field_name': {'type': [type_name],
@@ -123,7 +124,7 @@ class HistoriaUser(HistoriaRecord):
         if name == 'password' and value is not None:
             if not isinstance(value, str):
                 raise ValueError("Password must be strings.")
-            value = bcrypt.hashpw(value.encode('utf-8'), bcrypt.gensalt())
+            value = type(self).password_hasher.hash(value.encode('utf-8'))
 
         # Ban @ from the name column to avoid email addresses appearing there.
         try:
@@ -142,25 +143,13 @@ class HistoriaUser(HistoriaRecord):
 
     def checkPassword(self, testPassword):
         """checkPassword: use bcrypt to test of testPassword matches the password on file."""
-        return bcrypt.hashpw(testPassword.encode('utf-8'), self.password) == self.password
-
-    def load(self, recordID):
-        """Load a user from the database into this object, don't double encrypt the password."""
-
-        if self.id != -1:
-            raise DataLoadError("Cannot load a record into a record object already in new.  Memory is cheap, create a new one.")
-
-        data = self.database.execute_select(self._generate_select_SQL(recordID))[0]
-
-        for field in data:
-            if field == 'id':
-                self._id = data[field]
-            elif field == 'password':
-                self._password = bytes(data[field])
-            else:
-                setattr(self, field, data[field])
+        return type(self).password_hasher.check(testPassword.encode('utf-8'), self.password)
 
-        self._dirty = False
+    def _hydrate(self, row):
+        """Fill in a user from a database row, don't double encrypt the password."""
+        super()._hydrate(row)
+        if self.password is not None:
+            HistoriaDataObject.__setattr__(self, 'password', bytes(self.password))
 
     def to_dict(self):
         """Return a dictionary representing this user's fields that can be
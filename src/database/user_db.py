@@ -140,7 +140,7 @@ class HistoriaUserDatabase(HistoriaDatabase, HistoriaRecord):
     def __setattr__(self, name, value):
         """Override the __setattr__ provided by HistoriaRecord to allow a special case for member_classes."""
         
-        valid_db_names = ['member_classes', 'connection_settings', 'name', 'database_defaults', 'connection', 'database']
+        valid_db_names = ['member_classes', 'connection_settings', 'name', 'database_defaults', 'connection', 'database', 'pool_settings', 'prepared_statements', 'query_diagnostics', 'search_cache']
         
         if name in valid_db_names:
             HistoriaDatabase.__setattr__(self, name, value)
@@ -159,22 +159,24 @@ class HistoriaUserDatabase(HistoriaDatabase, HistoriaRecord):
         password =  cipher.decrypt(secure_text)
         return password.decode('utf-8')
     
-    def save(self):
-        """Save this record to the database."""
-        # encrypt the password before saving, with a new iv
-        iv, en_password = self._encrypt_password(self.db_password)
-        plain_password = self.db_password
-        self.db_password = en_password
-        self.password_aes_iv = iv
-        
-        
-        skip_attrs = ['member_classes', 'connection_settings', 'database_defaults', 'connection']
-        
-        HistoriaRecord.save(self)
+    def _before_save(self):
+        """Encrypt the password on the way to the database, with a new iv. An
+        unchanged password isn't written, so it's left alone."""
+        self._plain_password = None
+        if self.id == -1 or 'db_password' in self._dirty_fields:
+            self._plain_password = self.db_password
+            iv, en_password = self._encrypt_password(self.db_password)
+            self.db_password = en_password
+            self.password_aes_iv = iv
+
+    def _after_save(self):
+        """Put the plain text password back once the record is written, or
+        the write has failed. It's set directly so the field isn't marked
+        changed again; save() marks the record clean if the write worked."""
+        if self._plain_password is not None:
+            HistoriaDataObject.__setattr__(self, 'db_password', self._plain_password)
+        self._plain_password = None
 
-        self.db_password = plain_password
-        self._dirty = False
-    
     def load(self, recordID):
         """Load record from the database."""
         super().load(recordID)
@@ -45,40 +45,47 @@ def historia_version():
     v_string = "{0} maintained by {1}. Status: {2} \n\n".format(__version__, __maintainer__, __status__)
     return v_string
 
-parser = argparse.ArgumentParser(prog="Historia")
-parser.add_argument('-c','--config', help="The path to the configuration files to load for historia. Historia will look for a default.json and a historia.json at the location; only default.json is required.")
-parser.add_argument('-v','--version', help="Print the version information for Historia and the local Python installation.", action="version", version='%(prog)s: ' + historia_version())
-parser.add_argument('--install', help="Install a fresh master database.  *Warning*: all data in the master will be lost! Make a backup if there is anything important in that database.", action="store_true")
-
-args = parser.parse_args()
-
-settingsLocation = '../config'
-
-if args.config is not None:
-    settingsLocation = args.config
-
-master_controller = HistoriaCoreController(settingsLocation)
-
-if args.install:
-    settings = {
-        "user": master_controller.config['database']['user'],
-        "password": master_controller.config['database']["password"],
-        "host": master_controller.config['database']['host'],
-        "raise_on_warnings": False
-    }
-
-    master_controller.database = master_controller.create_database(database_name=master_controller.config['database']['main_database'],
-                                                                    connection_settings=settings,
-                                                                    db_type = "system")
-    master_controller.logger.info("Master Database Created.")
-    master_controller.user_create(session = None,
-                                  parameters={'name':'admin',
-                                         'email':'admin@example.com',
-                                         'password': 'admin',
-                                         'admin': 1,
-                                         'enabled':1
-                                         },
-                                  bypass=True)
-
-master_controller.setup_web_interface()
-master_controller.start_interface()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="Historia")
+    parser.add_argument('-c','--config', help="The path to the configuration files to load for historia. Historia will look for a default.json and a historia.json at the location; only default.json is required.")
+    parser.add_argument('-v','--version', help="Print the version information for Historia and the local Python installation.", action="version", version='%(prog)s: ' + historia_version())
+    parser.add_argument('--engine', help="The web server engine to use: http (the default) or asyncio, which supports keep-alive connections. Overrides server.engine in the configuration.", choices=['http', 'asyncio'])
+    parser.add_argument('--install', help="Install a fresh master database.  *Warning*: all data in the master will be lost! Make a backup if there is anything important in that database.", action="store_true")
+
+    args = parser.parse_args()
+
+    settingsLocation = '../config'
+
+    if args.config is not None:
+        settingsLocation = args.config
+
+    master_controller = HistoriaCoreController(settingsLocation)
+
+    if args.install:
+        settings = {
+            "user": master_controller.config['database']['user'],
+            "password": master_controller.config['database']["password"],
+            "host": master_controller.config['database']['host'],
+            "raise_on_warnings": False
+        }
+
+        master_controller.database = master_controller.create_database(database_name=master_controller.config['database']['main_database'],
+                                                                        connection_settings=settings,
+                                                                        db_type = "system")
+        master_controller.logger.info("Master Database Created.")
+        master_controller.user_create(session = None,
+                                      parameters={'name':'admin',
+                                             'email':'admin@example.com',
+                                             'password': 'admin',
+                                             'admin': 1,
+                                             'enabled':1
+                                             },
+                                      bypass=True)
+
+    master_controller.setup_web_interface(engine=args.engine)
+    try:
+        master_controller.start_interface()
+    except KeyboardInterrupt:
+        master_controller.stop_interface()
+    finally:
+        master_controller.shutdown()
@@ -0,0 +1,289 @@
+'''
+Created on Mar 9, 2015
+
+@author: Aaron Crosman
+
+An alternative web server engine for Historia built on asyncio streams.
+Connections are kept open between requests (HTTP/1.1 keep-alive, including
+pipelined requests) and each request is handled by HistoriaHTTPHandler's
+methods on a worker thread so blocking database calls never stall the event
+loop.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import io
+import ssl
+import logging
+import threading
+import asyncio
+import http.client
+import concurrent.futures
+
+from .exceptions import *
+from .web import *
+
+
+class HistoriaAsyncServer(object):
+    """Drop in replacement for HistoriaServer using asyncio. Accepts the same
+    configuration; server.workers sets the number of threads available for
+    request handling."""
+
+    running = False
+
+    # Largest request head (request line and headers) accepted, in bytes.
+    max_header_size = 65536
+
+    def startup(self, controller):
+        '''Sets everything up and runs the event loop until stopped.'''
+
+        self.controller = controller
+        self.logger = logging.getLogger('historia.web')
+
+        server_config = self.controller.config['server']
+        port = server_config['port']
+        key_file = server_config['cert_file']
+        self.workers = int(server_config.get('workers', 1))
+        self.keepalive_timeout = float(server_config.get('keepalive_timeout', 15))
+        self.body_timeout = float(server_config.get('body_timeout', 30))
+        self.shutdown_timeout = float(server_config.get('shutdown_timeout', 30))
+
+        HistoriaHTTPHandler.set_controller(self.controller)
+
+        context = self._ssl_context(key_file)
+
+        # Blocking work (the database, bcrypt) happens on these threads.
+        self._worker_threads = set()
+        self._worker_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                              initializer=self._worker_started)
+
+        self._tasks = set()  # one per open connection
+        self._idle = set()   # connections waiting for their next request
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+                        asyncio.start_server(self._handle_connection, 'localhost',
+                                             int(port), ssl=context,
+                                             limit=HistoriaAsyncServer.max_header_size))
+
+        self.running = True
+        self.controller.start_session_reaper()
+        try:
+            self.loop.run_forever()
+        finally:
+            if not self.running:
+                # stop() was called from another thread and left the cleanup to us.
+                self._shutdown()
+
+    def status(self, humanReadable=False):
+        """Return the status of the server as a string"""
+
+        if humanReadable:
+            if self.running:
+                return "Server is running on port: %s"\
+                    % self.controller.config['server']['port']
+            else:
+                return "Server offline"
+        else:
+            return self.running
+
+    def stop(self):
+        """Stop accepting connections, let requests in progress finish, and
+        close idle keep-alive connections."""
+
+        self.running = False
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self._shutdown()
+
+    def _shutdown(self):
+        self.server.close()
+        for task in self._idle:
+            task.cancel()
+
+        if self._tasks:
+            self.loop.run_until_complete(asyncio.wait(list(self._tasks),
+                                                      timeout=self.shutdown_timeout))
+
+        self._stop_workers()
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+        print ("Server Shutdown Complete")
+
+    @staticmethod
+    def _ssl_context(key_file):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(key_file)
+        return context
+
+    def _worker_started(self):
+        """Executor initializer: remember the thread so _stop_workers() can
+        tear it down, then let the controller set it up."""
+        with self._worker_lock:
+            self._worker_threads.add(threading.get_ident())
+        self.controller.worker_started()
+
+    def _stop_workers(self):
+        """Run controller.worker_stopped() on every worker thread before the
+        executor is shut down. ThreadPoolExecutor has no hook for a thread
+        exiting, so one teardown is queued per thread and each waits at a
+        barrier, keeping its thread busy until they are all running."""
+        with self._worker_lock:
+            count = len(self._worker_threads)
+        if count == 0:
+            return
+
+        barrier = threading.Barrier(count, timeout=self.shutdown_timeout)
+
+        def teardown():
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError as err:
+                self.logger.error("HTTP Interface: worker still busy at shutdown, teardown may be incomplete")
+            self.controller.worker_stopped()
+
+        for i in range(count):
+            self.executor.submit(teardown)
+
+    async def _handle_connection(self, reader, writer):
+        """Serve requests from one connection, in order, until either side
+        closes it."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        client_address = writer.get_extra_info('peername')
+
+        try:
+            while self.running:
+                raw_request = await self._read_request(reader, writer)
+                if raw_request is None:
+                    break
+
+                response, close = await self.loop.run_in_executor(self.executor,
+                                                                  self._dispatch,
+                                                                  raw_request,
+                                                                  client_address)
+                writer.write(response)
+                await writer.drain()
+
+                if close:
+                    break
+        except HTTPException as err:
+            writer.write(self._error_response(err.response_code, str(err)))
+        except (asyncio.TimeoutError, asyncio.CancelledError,
+                asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except Exception as err:
+            self.logger.error("HTTP Interface({0}): unhandled error on connection: {1}".format(client_address, err))
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        """Read one complete request (head and body) from the stream. Returns
+        None when the client closes the connection between requests. The
+        connection may sit idle for keepalive_timeout waiting for the head,
+        after which the body has body_timeout to arrive."""
+        task = asyncio.current_task()
+        self._idle.add(task)
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+        except asyncio.IncompleteReadError as err:
+            if err.partial.strip() == b"":
+                return None
+            raise
+        except asyncio.LimitOverrunError as err:
+            raise HTTPException("Request header too large", 431)
+        finally:
+            self._idle.discard(task)
+
+        request_line, _, header_block = head.partition(b"\r\n")
+        headers = http.client.parse_headers(io.BytesIO(header_block))
+
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            raise HTTPException("Chunked request bodies are not supported", 411)
+
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            raise HTTPException("Invalid Content-Length", 400)
+
+        if length > 0 and headers.get('Expect', '').lower() == '100-continue':
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+
+        if length <= 0:
+            return head
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), self.body_timeout)
+        except asyncio.TimeoutError as err:
+            raise HTTPException("Request body not received in time", 408)
+        return head + body
+
+    def _dispatch(self, raw_request, client_address):
+        """Run on a worker thread: handle the request and return the response
+        bytes and whether the connection should be closed afterwards."""
+        handler = HistoriaBufferedHandler(raw_request, client_address, self)
+        return handler.respond()
+
+    @staticmethod
+    def _error_response(code, message):
+        body = message.encode('utf-8', 'replace')
+        head = "HTTP/1.1 {0} {1}\r\nContent-Type: text/plain\r\nContent-Length: {2}\r\nConnection: close\r\n\r\n".format(
+                    code, http.client.responses.get(code, ''), len(body))
+        return head.encode('latin-1') + body
+
+
+class HistoriaBufferedHandler(HistoriaHTTPHandler):
+    """HistoriaHTTPHandler run against a request that has already been read
+    from the network, with the response collected in memory for the event
+    loop to send."""
+
+    protocol_version = "HTTP/1.1"
+
+    # Requests reach the handler only once a blank line ends the head, so
+    # they're never HTTP/0.9. Used until the request line has been parsed,
+    # this makes errors in a malformed one go out with a status line.
+    default_request_version = "HTTP/1.0"
+
+    def __init__(self, raw_request, client_address, server):
+        # BaseRequestHandler.__init__ would try to read from a socket; the
+        # request has already been read so just set up the buffers.
+        self.client_address = client_address
+        self.server = server
+        self.connection = None
+        self.rfile = io.BytesIO(raw_request)
+        self.wfile = io.BytesIO()
+
+    def respond(self):
+        """Handle the request and return (response_bytes, close_connection)."""
+        self.close_connection = True
+        self.handle_one_request()
+        response = self.wfile.getvalue()
+
+        # Keep-alive only works if the client can find the end of the body.
+        head = response.partition(b"\r\n\r\n")[0].lower()
+        if b"\r\ncontent-length:" not in head:
+            self.close_connection = True
+
+        return response, self.close_connection
+
+    def handle_expect_100(self):
+        # The event loop already answered the Expect header before reading
+        # the body.
+        return True
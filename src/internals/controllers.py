@@ -32,26 +32,40 @@ import datetime
 import logging
 import logging.config
 import json
-import re
+import threading
+import contextlib
 
 from .exceptions import *
 
 from database import system_db, user, session, user_db
 from database import core_data_objects
+from database import query_diagnostics
+from database import search_cache
 import database.exceptions
 
 
 from .web import *
+from .async_web import *
+from .session_cache import *
+from .router import *
 
 
 class HistoriaCoreController(object):
+
+    user_page_size = 50  # Users on each page from user_list() by default
+    user_page_max = 500  # Largest page user_list() will return
+
     def __init__(self, config_location='../config'):
         config = {}
         self.database = None
         self.interface = None
         self.active_users = {}
         self.active_user_databases = {}
-        self.url_tester = None
+        self.router = None
+        self.session_cache = None
+        self.session_flusher = None
+        self.session_reaper = None
+        self._worker = threading.local()  # Marks workers without a connection of their own
 
         # TODO: Move to a config file.
         self.routers = {
@@ -74,10 +88,15 @@ class HistoriaCoreController(object):
                         'type':         'POST'
                     },
                     'edit': {
-                        'parameters':   ['id', 'name', 'password', 'email', 'enabled', 'admin'],
+                        'parameters':   ['id', 'name', 'email', 'enabled', 'admin'],
                         'function':     self.user_edit,
                         'type':         'POST'
                     },
+                    'password': {
+                        'parameters':   ['id', 'password'],
+                        'function':     self.user_set_password,
+                        'type':         'POST'
+                    },
                     'delete': {
                         'parameters':  ['id'],
                         'function':    self.user_delete,
@@ -87,6 +106,11 @@ class HistoriaCoreController(object):
                         'parameters':  ['id'],
                         'function':    self.user_info,
                         'type':        'GET'
+                    },
+                    'list': {
+                        'parameters':  [], # Optional: after, size
+                        'function':    self.user_list,
+                        'type':        'GET'
                     }
                 },
                 'status': {
@@ -127,6 +151,8 @@ class HistoriaCoreController(object):
         self.request_patterns(reset=True)
 
         self.load_configuration(config_location)
+        self.setup_session_cache()
+        self.setup_password_hasher()
 
         try:
             self.connect_to_master_database()
@@ -176,22 +202,152 @@ class HistoriaCoreController(object):
         else:
             self.logger.warn(override_status['Message'])
 
-    def setup_web_interface(self):
-        self.logger.info("Setting up user interface.")
-        self.interface = HistoriaServer()
+    def setup_session_cache(self):
+        """Create the session cache described by the session section of the
+        configuration. A cache_size of 0 turns it off."""
+        settings = self.config.get('session', {})
+        size = int(settings.get('cache_size', 0))
+        if size <= 0:
+            self.session_cache = None
+            return
+
+        self.session_cache = HistoriaSessionCache(size, settings.get('cache_ttl', 300))
+
+    def setup_password_hasher(self):
+        """Give HistoriaUser a password hasher set up from the passwords
+        section of the configuration."""
+        settings = self.config.get('passwords', {})
+        user.HistoriaUser.password_hasher.close()
+        user.HistoriaUser.password_hasher = user.HistoriaPasswordHasher(settings.get('workers'),
+                                                                        settings.get('rounds', 12),
+                                                                        settings.get('max_pending'))
+
+    def shutdown(self):
+        """Release the controller's resources once the interface has stopped."""
+        if self.session_reaper is not None:
+            self.session_reaper.close()
+
+        if self.session_flusher is not None:
+            self.session_flusher.close()
+
+        user.HistoriaUser.password_hasher.close()
+
+        if self.database is not None:
+            if self.database.query_diagnostics is not None:
+                self.database.query_diagnostics.log_report()
+            self.database.disconnect()
+
+    def setup_web_interface(self, engine=None):
+        """Create the web interface. engine is 'http' (HistoriaServer) or
+        'asyncio' (HistoriaAsyncServer); if not given server.engine from the
+        configuration is used."""
+        engines = {
+            'http':    HistoriaServer,
+            'asyncio': HistoriaAsyncServer
+        }
+
+        if engine is None:
+            engine = self.config['server'].get('engine', 'http')
+
+        if engine not in engines:
+            raise ConfigurationLoadError("Unknown server engine {0}, must be one of {1}".format(engine, sorted(engines)))
+
+        self.logger.info("Setting up user interface using the {0} engine.".format(engine))
+        self.interface = engines[engine]()
 
     def start_interface(self):
         self.logger.info("Starting interface.")
         self.interface.startup(self)
 
+    def start_session_reaper(self):
+        """Start deleting expired sessions in the background, if the
+        configuration gives sessions a ttl. Called by the web interface once
+        any worker processes have been forked, so they aren't forked with the
+        reaper's thread running."""
+        settings = self.config.get('session', {})
+        if self.database is None or not settings.get('ttl'):
+            return
+
+        self.session_reaper = session.HistoriaSessionReaper(self.database,
+                                                            settings['ttl'],
+                                                            settings.get('reap_interval', 60),
+                                                            settings.get('reap_batch_size', 1000))
+        self.session_reaper.start()
+
+    def stop_interface(self):
+        self.logger.info("Stopping interface.")
+        self.interface.stop()
+
+    def worker_started(self):
+        """Called by the web interface from each new worker thread, gives the
+        worker its own connection to the master database unless connections
+        are drawn from a pool for each request. A worker that can't connect
+        answers requests with a 503 until it manages to."""
+        if self.database is None or self.database.pooled:
+            return
+
+        try:
+            self.database.connect_thread()
+        except database.exceptions.DataConnectionError as err:
+            # The shared connection may be in use by another thread, so the
+            # worker refuses requests until it can connect (see request_context)
+            self._worker.unconnected = True
+            self.logger.error("Worker unable to connect to master database: {0}".format(err))
+
+    def worker_stopped(self):
+        """Called by the web interface as a worker thread or process exits."""
+        if self.database is not None:
+            self.database.disconnect_thread()
+
+    def worker_forked(self):
+        """Called by the web interface in a newly forked worker process.
+        Connections inherited from the parent are abandoned, not closed, since
+        closing them would also close them for the parent. The session and
+        search caches are turned off since logouts and other changes in one
+        process couldn't be seen by the others."""
+        self.session_cache = None
+        try:
+            self.connect_to_master_database()
+        except database.exceptions.DataConnectionError as err:
+            self.logger.error("Worker process unable to connect to master database.")
+        if self.database is not None:
+            self.database.search_cache = None
+
+    @contextlib.contextmanager
+    def request_context(self):
+        """Context manager wrapped around the handling of each web request, so
+        the request uses a single master database connection from start to
+        finish, and a record loaded more than once during the request is only
+        read from the database the first time (see
+        HistoriaDatabase.unit_of_work())."""
+        with contextlib.ExitStack() as stack:
+            if self.database is not None:
+                if getattr(self._worker, 'unconnected', False):
+                    try:
+                        self.database.connect_thread()
+                    except database.exceptions.DataConnectionError as err:
+                        raise DatabaseNotReady("Worker has no database connection")
+                    self._worker.unconnected = False
+                try:
+                    stack.enter_context(self.database.borrow())
+                except database.exceptions.DataConnectionError as err:
+                    self.logger.error("No database connection available for request: {0}".format(err))
+                    raise DatabaseNotReady("No database connection available")
+                stack.enter_context(self.database.unit_of_work())
+            yield
+
     def process_request(self, request_handler, session, target, request,
-                        parameters):
-        """Process requests from a request_handler and send back the results"""
+                        parameters, route=None):
+        """Process requests from a request_handler and send back the results.
+        route is the HistoriaRoute for target/request if the handler already
+        matched it."""
 
         self.logger.debug("Processing request handler: {0} for {1}. Target: {2} Request: {3} Parameters: {4}".format(
                                 request_handler, session, target, request, parameters))
 
-        if target not in self.routers:
+        if route is None:
+            route = self.request_patterns(reset=False).match("{0}/{1}".format(target, request))
+        if route is None:
             request_handler.send_error(404, "Requested Resource not found")
             return
 
@@ -200,23 +356,22 @@ class HistoriaCoreController(object):
             return
 
         try:
-            r = request.split('/')
-            result = None
-            if target == 'system':
-                # Check to see we can found the router and if the request type matches router
-                if self.routers[target][r[0]][r[1]]['type'] == request_handler.command:
-                    result = self.routers[target][r[0]][r[1]]['function'](session,
-                                                                    parameters)
-                else:
-                    self.logger.error("Invalid System Request Type: {0} must be a {1}".format(request, request_handler.command))
-                    request_handler.send_error(403, "Invalid System Request Type: {0} must be a {1}".format(request, request_handler.command))
-            elif target == 'database':
-                # we'll need to extract the IDs and use them.
-                db_id = r[0]
-                command = r[1]
-                obj_id = r[2]
+            # Check the request type matches router
+            if route.entry['type'] != request_handler.command:
+                self.logger.error("Invalid System Request Type: {0} must be a {1}".format(request, request_handler.command))
+                request_handler.send_error(403, "Invalid System Request Type: {0} must be a {1}".format(request, request_handler.command))
+                return
+
+            if target == 'database':
+                # route.parameters has the IDs we'll need to use.
                 raise NotImplementedError("Database access doesn't work yet.")
 
+            result = route.entry['function'](session, parameters)
+
+            # Save changed records now, so a failure is reported to the client
+            if self.database is not None:
+                self.database.flush()
+
             if result is None:
                 request_handler.send_error(403, "Request failed")
             elif result is True or result is False:
@@ -225,13 +380,26 @@ class HistoriaCoreController(object):
                 request_handler.send_record(session, result)
 
         except (InvalidPermissionsError, InvalidSessionError) as err:
+            self._abandon_request()
             request_handler.send_error(403, "You do not have the access required to complete this request.")
+        except database.exceptions.PasswordHasherBusy as err:
+            self._abandon_request()
+            self.logger.error("Password hasher busy, turned away request: {0}:{1}".format(target, request))
+            request_handler.send_error(503, "Service temporarily unavailable")
         except InvalidParametersError as err:
+            self._abandon_request()
             request_handler.send_error(404, "Invalid Parameters for this request.")
         except Exception as err:
+            self._abandon_request()
             self.logger.error("Error handling request: {0}:{1} with {2} for {3}. Error: {4}".format(target, request, parameters, session.id, err))
             request_handler.send_error(500, "General Error processing request")
 
+    def _abandon_request(self):
+        """Drop the changes a failed request made to records, so they aren't
+        saved when its unit of work ends."""
+        if self.database is not None:
+            self.database.discard()
+
     def process_login(self, session, parameters):
         if 'user' not in parameters or 'password' not in parameters:
             return False
@@ -260,37 +428,12 @@ class HistoriaCoreController(object):
         }
 
     def request_patterns(self, reset=True):
-        """Return a regular expression that will match all valid URL patterns
-        """
+        """Return a HistoriaRouter that will match all valid URL patterns"""
 
-        if reset or self.url_tester is None:
-            pattern = self._build_pattern(self.routers)
-            self.url_tester = re.compile(pattern)
-
-        return self.url_tester
-
-    def _build_pattern(self, base_dict):
-        """Converter a set of nexted dictionaries for routers into a regular
-        expression."""
-        if 'type' in base_dict:
-            # this is the bottom layer so return
-            return None
-
-        patterns = []
-        for key in base_dict:
-            pat = self._build_pattern(base_dict[key])
-            if key[0] == '@':
-                # This means the key is place holder for an ID
-                key = "(\d+)"
-            if pat is None:
-                patterns.append(key)
-            else:
-                patterns.append("{0}/{1}".format(key, pat))
+        if reset or self.router is None:
+            self.router = HistoriaRouter(self.routers)
 
-        final = patterns[0]
-        for p in patterns[1:]:
-            final = "{0}|{1}".format(final, p)
-        return "({0})".format(final)
+        return self.router
 
     # ====================================
     def create_database(self, database_name, connection_settings,
@@ -309,6 +452,7 @@ class HistoriaCoreController(object):
             db = user_db.HistoriaUserDatabase(self.database, database_name,
                                               self.config['server']['aes_key_file'])
             db.connection_settings = connection_settings
+            db.pool_settings = self.config['database'].get('pool')
             self.database.createDatabase(db)
             return db
         else:
@@ -322,6 +466,16 @@ class HistoriaCoreController(object):
         self.database.connection_settings['user'] = self.config['database']['user']
         self.database.connection_settings['password'] = self.config['database']['password']
         self.database.connection_settings['host'] = self.config['database']['host']
+        self.database.pool_settings = self.config['database'].get('pool')
+        self.database.prepared_statements = self.config['database'].get('prepared_statements', False)
+        diagnostics = self.config['database'].get('diagnostics')
+        if diagnostics is not None:
+            self.database.query_diagnostics = query_diagnostics.HistoriaQueryDiagnostics(**diagnostics)
+        cache = self.config['database'].get('search_cache')
+        if cache is not None and int(cache.get('size', 0)) > 0:
+            self.database.search_cache = search_cache.HistoriaSearchCache(cache['size'], cache.get('ttl', 60))
+        self.session_flusher = session.HistoriaSessionFlusher(self.database,
+                                                              self.config.get('session', {}).get('flush_interval', 30))
 
         self.database.connect()
 
@@ -344,18 +498,17 @@ class HistoriaCoreController(object):
         search = core_data_objects.HistoriaDatabaseSearch(self.database,
                                                           user.HistoriaUser.machine_type)
 
-        search.add_field('id')
         search.add_condition('name', user_name)
         search.add_condition('email', user_name, '=', 'OR')
         search.add_limit(1)
-        test_user = user.HistoriaUser(self.database)
         try:
-            results = search.execute_search()
-            test_user.load(results[0]['id'])
+            test_user = search.execute_search(hydrate=user.HistoriaUser)[0]
             if(test_user.checkPassword(password)):
                 return test_user
             else:
                 return False
+        except database.exceptions.PasswordHasherBusy:
+            raise
         except:
             return False
 
@@ -372,33 +525,65 @@ class HistoriaCoreController(object):
         sess.userid = 0
         sess.save()
 
+        if self.session_cache is not None:
+            self.session_cache.put(sess)
+
         self.logger.info("New session started with ID: {0}".format(sess_id))
 
         return sess
 
     def reload_session(self, session_id, ip):
         """Return a new session object"""
+        sess = None
+        if self.session_cache is not None:
+            sess = self.session_cache.get(session_id)
+
+        if sess is None:
+            sess = self._load_session(session_id, ip)
+
+        if sess.ip != ip:
+            sess.ip = ip
+            sess.save()
+        else:
+            self.session_flusher.touch(sess)  # last_seen is written on the next flush
+
+        return sess
+
+    def _load_session(self, session_id, ip):
+        """Load a session and its user from the database."""
         sess = session.HistoriaSession(self.database)
         try:
             sess.load(session_id)
-            if sess.ip != ip:
-                sess.ip = ip
-            sess.save()  # reset the last_seen value in the database
+
+            ttl = self.config.get('session', {}).get('ttl')
+            if ttl and sess.last_seen is not None and \
+                    sess.last_seen < datetime.datetime.now() - datetime.timedelta(seconds=ttl):
+                self.logger.info("Session expired: {0}".format(session_id))
+                self.end_session(sess, None)
+                raise InvalidSessionError("Expired Session ID: {0}".format(session_id))
 
             self.logger.info("Loaded session with ID: {0}".format(session_id))
 
             if sess.userid > 0:
                 try:
-                    active_user = user.HistoriaUser(self.database)
-                    active_user.load(sess.userid)
-                    sess._user = active_user
+                    if self.session_cache is not None:
+                        # Cached users are shared by every thread, so they
+                        # stay out of the request's identity map where they
+                        # would be saved with the request's changes.
+                        sess._user = user.HistoriaUser(self.database)
+                        sess._user.load(sess.userid)
+                    else:
+                        sess._user = user.HistoriaUser.get(self.database, sess.userid)
                 except database.exceptions.DataLoadError as err:
                     # If there is an error loading the user for this session
                     # then the session is corrupt and should be destoryed and a
                     # new one created.
                     self.logger.notice('Invalid user associated with session. Destorying session: {0}'.format(session_id))
-                    self.end_session(session_id)
-                    sess = session.HistoriaSession(self.database)
+                    self.end_session(sess, None)
+                    return self.start_session(ip)
+
+            if self.session_cache is not None:
+                self.session_cache.put(sess)
         except database.exceptions.DataLoadError as err:
             self.logger.error('Unable to load session: {0}'.format(session_id))
             raise InvalidSessionError("Invalid Session ID: {0}".format(session_id))
@@ -412,6 +597,11 @@ class HistoriaCoreController(object):
         """End a given user's session, and close their database connection to
         free resources. parameters is ignored and only included for consistancy
         with other functions."""
+        if self.session_cache is not None:
+            self.session_cache.invalidate(session.sessionid)
+        if self.session_flusher is not None:
+            self.session_flusher.discard(session.sessionid)
+
         try:
             sid = session.id
             session.delete()
@@ -467,50 +657,88 @@ class HistoriaCoreController(object):
         return self._mod_user(new_user, parameters)
 
     def user_edit(self, session, parameters):
-        """Used for editing users."""
+        """Used for editing users. The password is only changed if a new one is
+        given, see also user_set_password()."""
+
+        edit_user = self._load_user_to_edit(session, parameters, 'edit')
+
+        return self._mod_user(edit_user, parameters)
+
+    def user_set_password(self, session, parameters):
+        """Used for changing a user's password."""
+
+        edit_user = self._load_user_to_edit(session, parameters, 'password')
+
+        if not parameters['password']:
+            raise InvalidParametersError("No password provided when setting password")
+
+        return self._mod_user(edit_user, {'password': parameters['password']})
+
+    def _load_user_to_edit(self, session, parameters, action):
+        """Helper function for user edit and set password. Checks the request
+        and returns the user to be changed."""
 
         # Check for current user
         if not hasattr(session, '_user'):
             self.logger.error('Current session has no assicated user: {0}'.format(session.id))
             raise InvalidSessionError("Current session has no assicated user: {0}".format(session.id))
 
-        for param in self.routers['system']['user']['edit']['parameters']:
+        for param in self.routers['system']['user'][action]['parameters']:
             if param not in parameters:
-                self.logger.info("Attempt to create user without setting {0}".format(param))
-                raise InvalidParametersError("No {0} provided when creating new user".format(param))
+                self.logger.info("Attempt to edit user without setting {0}".format(param))
+                raise InvalidParametersError("No {0} provided when editing user".format(param))
 
         # Verify current user is admin or editing self
         if not session._user.admin and session._user.id != parameters['id']:
             self.logger.notice('User {0} [{1}], attempted to edit another user ({2}).'.format(session._user.name, session._user.id, parameters['id']))
             raise InvalidPermissionsError("User {0} attempted to edit user with ID {1}".format(session._user.name, parameters['id']))
 
-        edit_user = user.HistoriaUser(self.database)
-
         try:
-            edit_user.load(parameters['id'])
+            edit_user = user.HistoriaUser.get(self.database, parameters['id'])
         except database.exceptions.DataLoadError as err:
             self.logger.error('Unable to load user {0}'.format(parameters['id']))
             raise InvalidParametersError('Unable to load user {0}'.format(parameters['id']))
 
-        return self._mod_user(edit_user, parameters)
+        return edit_user
 
     def _mod_user(self, mod_user, parameters):
-        """Helper function for user create and edit."""
+        """Helper function for user create and edit. Only the fields in
+        parameters are changed, and an empty password leaves the current one
+        in place."""
         try:
-            mod_user.name = parameters['name']
-            mod_user.email = parameters['email']
-            mod_user.password = parameters['password']
-            mod_user.admin = bool(int(parameters['admin']))
-            mod_user.enabled = bool(int(parameters['enabled']))
+            if 'name' in parameters:
+                mod_user.name = parameters['name']
+            if 'email' in parameters:
+                mod_user.email = parameters['email']
+            if parameters.get('password'):
+                mod_user.password = parameters['password']
+            if 'admin' in parameters:
+                mod_user.admin = bool(int(parameters['admin']))
+            if 'enabled' in parameters:
+                mod_user.enabled = bool(int(parameters['enabled']))
             mod_user.save()
+            if self.session_cache is not None:
+                self.session_cache.invalidate_user(mod_user.id)
             return mod_user
+        except database.exceptions.PasswordHasherBusy:
+            self._abandon_user_changes(mod_user)
+            raise
         except ValueError as err:
+            self._abandon_user_changes(mod_user)
             self.logger.info("Error creating new user: {0}".format(err))
             raise InvalidParametersError("Error creating new user")
         except database.exceptions.HistoriaDataException as err:
+            self._abandon_user_changes(mod_user)
             self.logger.info("Database error while creating new user: {0}".format(err))
             raise InvalidParametersError("Error creating new user")
 
+    def _abandon_user_changes(self, mod_user):
+        """Make sure a partly changed user that couldn't be saved isn't saved at
+        the end of the request, or reused from the session cache."""
+        mod_user._forget()
+        if self.session_cache is not None and mod_user.id != -1:
+            self.session_cache.invalidate_user(mod_user.id)
+
 
     def user_delete(self, session, parameters):
         """Used for deleting users."""
@@ -532,19 +760,58 @@ class HistoriaCoreController(object):
                 raise InvalidParametersError("No {0} provided when deleting user".format(param))
 
 
-        del_user = user.HistoriaUser(self.database)
-
         try:
-            del_user.load(parameters['id'])
+            del_user = user.HistoriaUser.get(self.database, parameters['id'])
         except database.exceptions.DataLoadError as err:
             self.logger.error('Unable to find user {0} for delete'.format(parameters['id']))
             raise InvalidParametersError('Unable to find user {0} for delete'.format(parameters['id']))
 
+        user_id = del_user.id
         del_user.delete()
+        if self.session_cache is not None:
+            self.session_cache.invalidate_user(user_id)
 
         return del_user.id == -1
 
 
+    def user_list(self, session, parameters):
+        """Used for listing users a page at a time, in order of id. size sets
+        the number of users per page (up to user_page_max) and after is the
+        token returned with the previous page."""
+
+        # Check for user
+        if not hasattr(session, '_user'):
+            self.logger.error('Current session has no assicated user: {0}'.format(session.id))
+            raise InvalidSessionError("Current session has no assicated user: {0}".format(session.id))
+
+        # Verify the user is an admin
+        if not session._user.admin:
+            self.logger.notice('User {0} [{1}], attempted to list users.'.format(session._user.name, session._user.id))
+            raise InvalidPermissionsError("Must have admin rights to list users.")
+
+        # Values from a query string arrive as lists
+        after = parameters.get('after')
+        size = parameters.get('size', self.user_page_size)
+        if isinstance(after, list):
+            after = after[0] if after else None
+        if isinstance(size, list):
+            size = size[0] if size else self.user_page_size
+
+        try:
+            size = min(max(int(size), 1), self.user_page_max)
+        except (TypeError, ValueError) as err:
+            raise InvalidParametersError("Invalid page size when listing users")
+
+        search = core_data_objects.HistoriaDatabaseSearch(self.database,
+                                                          user.HistoriaUser.machine_type)
+        search.add_sort('id')
+        try:
+            users, token = search.page_after(after or None, size, hydrate=user.HistoriaUser)
+        except ValueError as err:
+            raise InvalidParametersError("Invalid page token when listing users")
+
+        return {'users': users, 'next': token}
+
     def user_info(self, session, parameters):
         """Used for getting user info."""
 
@@ -558,19 +825,23 @@ class HistoriaCoreController(object):
             self.logger.error('No ID provided when requesting user information')
             raise InvalidParametersError("No ID provided when requesting user information")
 
-        users = []
-        for uid in parameters['id']:
-            if uid == session._user.id:
-                 users.append(session._user)
-            elif session._user.admin:
-                try:
-                    test_user = user.HistoriaUser(self.database)
-                    test_user.load(uid)
-                    users.append(test_user)
-                except Exception as err:
-                    return None
-            else:
-                self.logger.notice('User {0} [{1}], attempted to get info about another user ({2}).'.format(session._user.name, session._user.id, parameters['id']))
-                raise InvalidPermissionsError("User {0} cannot get information about user with ID {1}".format(session._user.name, parameters['id']))
+        # Ids from a query string arrive as strings
+        try:
+            ids = [int(uid) for uid in parameters['id']]
+        except (TypeError, ValueError) as err:
+            raise InvalidParametersError("Invalid ID provided when requesting user information")
+
+        others = [uid for uid in ids if uid != session._user.id]
+        if others and not session._user.admin:
+            self.logger.notice('User {0} [{1}], attempted to get info about another user ({2}).'.format(session._user.name, session._user.id, parameters['id']))
+            raise InvalidPermissionsError("User {0} cannot get information about user with ID {1}".format(session._user.name, parameters['id']))
+
+        # All the other users are read with one query
+        try:
+            loaded = {u.id: u for u in user.HistoriaUser.load_many(self.database, others)}
+        except Exception as err:
+            return None
+        if any(uid not in loaded for uid in others):
+            return None
 
-        return users
+        return [session._user if uid == session._user.id else loaded[uid] for uid in ids]
@@ -0,0 +1,81 @@
+#!/usr/local/bin/python3
+# encoding: utf-8
+"""
+router.py
+
+Matches request paths against the controller's routers.
+
+
+Created by Aaron Crosman on 2015-03-20
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import collections
+
+
+# target is the first segment of the path and request the rest, entry is the
+# routers entry (with 'type', 'function', etc.) and parameters holds the
+# values of @ segments, by name without the @.
+HistoriaRoute = collections.namedtuple('HistoriaRoute', ['target', 'request', 'entry', 'parameters'])
+
+
+class HistoriaRouter(object):
+    """A tree built once from the controller's nested routers dict, with a
+    node per path segment. Keys starting with @ stand for a numeric (ASCII digits) id, and
+    an entry is any dict with a 'type'. Matching a path is one dict lookup
+    per segment."""
+
+    def __init__(self, routers):
+        self._root = self._build(routers)
+
+    @classmethod
+    def _build(cls, routes):
+        node = {'children':  {},    # segment: node
+                'parameter': None,  # (name, node) for an @ key
+                'entry':     None}
+
+        if 'type' in routes:
+            # this is the bottom layer
+            node['entry'] = routes
+            return node
+
+        for key, value in routes.items():
+            if key[:1] == '@':
+                node['parameter'] = (key[1:], cls._build(value))
+            else:
+                node['children'][key] = cls._build(value)
+        return node
+
+    def match(self, path):
+        """Return the HistoriaRoute for a path such as system/user/login or
+        database/1/fetch/2, or None if it doesn't lead to an entry."""
+        segments = path.split('/')
+        node = self._root
+        parameters = {}
+        for segment in segments:
+            child = node['children'].get(segment)
+            if child is None:
+                if node['parameter'] is None or not (segment.isascii() and segment.isdigit()):
+                    return None
+                name, child = node['parameter']
+                parameters[name] = int(segment)
+            node = child
+
+        if node['entry'] is None:
+            return None
+        return HistoriaRoute(segments[0], '/'.join(segments[1:]), node['entry'], parameters)
@@ -0,0 +1,96 @@
+#!/usr/local/bin/python3
+# encoding: utf-8
+"""
+session_cache.py
+
+An in memory cache of active sessions, so requests from a known session don't
+have to load it (and its user) from the master database every time.
+
+
+Created by Aaron Crosman on 2015-03-14
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import threading
+import collections
+
+
+class HistoriaSessionCache(object):
+    """Least recently used cache of HistoriaSession objects (with their _user)
+    keyed by session id. Entries expire ttl seconds after they were loaded, and
+    no more than max_size are kept. Writing last_seen for cached sessions is
+    left to HistoriaSessionFlusher."""
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = int(max_size)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # sessionid: (session, expires)
+        self._stats = {
+            'hits':       0,
+            'misses':     0,
+            'evictions':  0
+        }
+
+    def get(self, session_id):
+        """Return the cached session, or None if it isn't cached."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[session_id]
+                entry = None
+
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(session_id)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, session):
+        """Add a session to the cache, pushing out the least recently used
+        entries if it's full."""
+        with self._lock:
+            self._entries[session.sessionid] = (session, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session.sessionid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, session_id):
+        """Drop a session from the cache."""
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def invalidate_user(self, user_id):
+        """Drop every cached session belonging to a user, so the next request
+        loads the user again."""
+        with self._lock:
+            stale = [sid for sid, entry in self._entries.items() if entry[0].userid == user_id]
+            for sid in stale:
+                del self._entries[sid]
+
+    def stats(self):
+        """Return a dict of the cache's counters and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
@@ -0,0 +1,211 @@
+#!/usr/local/bin/python3
+# encoding: utf-8
+"""
+static_cache.py
+
+An in memory cache of the static files sent by the web server, with the
+ETags and modification times used to answer conditional requests and gzip
+compressed copies of text files.
+
+
+Created by Aaron Crosman on 2015-03-21
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import gzip
+import hashlib
+import threading
+import collections
+import email.utils
+
+from .exceptions import *
+
+
+class HistoriaStaticFile(collections.namedtuple('HistoriaStaticFile',
+                                                ['path', 'body', 'size', 'mtime', 'mtime_ns', 'etag',
+                                                 'gzip_body'])):
+    """A file as sent by the web server. body is None for files too large to
+    cache, which have to be read from path. gzip_body is the compressed body,
+    or None if the file isn't worth compressing. mtime is in seconds and
+    mtime_ns in nanoseconds, both from stat()."""
+    __slots__ = ()
+
+    @property
+    def gzip_etag(self):
+        """The ETag of the compressed body, which must differ from etag."""
+        return self.etag[:-1] + '-gzip"'
+
+    @property
+    def last_modified(self):
+        """mtime formatted for a Last-Modified header."""
+        return email.utils.formatdate(self.mtime, usegmt=True)
+
+    def not_modified(self, headers, etag=None):
+        """Return True if the request headers (If-None-Match, or failing that
+        If-Modified-Since) show the client already has this version. etag is
+        the ETag of the body that would be sent, etag or gzip_etag, and
+        defaults to etag."""
+        if etag is None:
+            etag = self.etag
+
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag[:2] == 'W/':
+                    tag = tag[2:]
+                if tag == '*' or tag == etag:
+                    return True
+            return False
+
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError) as err:
+                return False
+            if since is None or since.tzinfo is None:
+                return False
+            # Last-Modified only has whole seconds
+            return int(self.mtime) <= since.timestamp()
+
+        return False
+
+    def byte_range(self, headers):
+        """Return the (start, stop) byte offsets asked for by the request's
+        Range header, or None if the whole file should be sent. Only single
+        ranges are supported, others get the whole file. Raises HTTPException
+        with a 416 if the range lies past the end of the file."""
+        value = headers.get('Range')
+        if value is None or value[:6] != 'bytes=' or ',' in value:
+            return None
+
+        # If-Range asks for the range only if the file hasn't changed
+        if_range = headers.get('If-Range')
+        if if_range is not None and if_range != self.etag and if_range != self.last_modified:
+            return None
+
+        first, sep, last = value[6:].strip().partition('-')
+        if sep != '-' or not (first.isdecimal() or first == '') or not (last.isdecimal() or last == ''):
+            return None
+
+        if first == '':
+            # bytes=-n is the last n bytes
+            if last == '' or int(last) == 0:
+                raise HTTPException("Requested range not satisfiable", 416)
+            return (max(self.size - int(last), 0), self.size)
+
+        start = int(first)
+        stop = self.size if last == '' else min(int(last) + 1, self.size)
+        if last != '' and int(last) < start:
+            return None
+        if start >= self.size:
+            raise HTTPException("Requested range not satisfiable", 416)
+        return (start, stop)
+
+
+class HistoriaStaticCache(object):
+    """Least recently used cache of file contents keyed by real path. Every
+    get() checks the file's modification time and size, and reads it again if
+    either has changed, so edits show up on the next request. Files larger
+    than max_file_size are never kept, and the bodies kept add up to no more
+    than max_size bytes. Files get() is asked to compress are gzipped at
+    compress_level when read, if they are at least min_compress_size bytes,
+    and the compressed copy is kept alongside (and counted against max_size)
+    when it's smaller."""
+
+    def __init__(self, max_size=16777216, max_file_size=1048576,
+                 compress_level=6, min_compress_size=1024):
+        self.max_size = int(max_size)
+        self.max_file_size = int(max_file_size)
+        self.compress_level = int(compress_level)
+        self.min_compress_size = int(min_compress_size)
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # path: HistoriaStaticFile
+        self._size = 0
+        self._stats = {
+            'hits':       0,
+            'misses':     0,
+            'evictions':  0
+        }
+
+    @staticmethod
+    def _cost(entry):
+        """Bytes of memory used by an entry's bodies."""
+        return entry.size + (len(entry.gzip_body) if entry.gzip_body is not None else 0)
+
+    def get(self, path, compress=False):
+        """Return the HistoriaStaticFile for path, reading it if it isn't
+        cached or has changed. compress asks for gzip_body, it should be the
+        same every time for a path. Raises OSError if the file can't be
+        read."""
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                self._entries.move_to_end(path)
+                self._stats['hits'] += 1
+                return entry
+            self._stats['misses'] += 1
+
+        if stat.st_size > self.max_file_size or stat.st_size > self.max_size:
+            # The size and modification time will have to do for the tag
+            return HistoriaStaticFile(path, None, stat.st_size, stat.st_mtime, stat.st_mtime_ns,
+                                      '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns), None)
+
+        with open(path, 'rb') as f:
+            # Use the stat of what was read, in case the file changed since
+            stat = os.fstat(f.fileno())
+            body = f.read()
+
+        gzip_body = None
+        if compress and self.compress_level > 0 and len(body) >= self.min_compress_size:
+            # mtime=0 so every process compresses the file to the same bytes
+            gzip_body = gzip.compress(body, self.compress_level, mtime=0)
+            if len(gzip_body) >= len(body):
+                gzip_body = None
+
+        entry = HistoriaStaticFile(path, body, len(body), stat.st_mtime, stat.st_mtime_ns,
+                                   '"{0}"'.format(hashlib.sha1(body).hexdigest()), gzip_body)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._size -= self._cost(old)
+            self._entries[path] = entry
+            self._size += self._cost(entry)
+            while self._size > self.max_size:
+                evicted, old = self._entries.popitem(last=False)
+                self._size -= self._cost(old)
+                self._stats['evictions'] += 1
+        return entry
+
+    def clear(self):
+        """Drop every cached file."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return a dict of the cache's counters, entries and bytes used."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['bytes'] = self._size
+        return stats
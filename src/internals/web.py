@@ -22,52 +22,118 @@ Created on Feb 5, 2015
 
 import urllib.parse
 import threading
+import queue
+import signal
 import os
 import os.path
 import ssl
+import mmap
+import gzip
 import json
+import logging
 import http.server
 import http.cookies
 from cgi import parse_header, parse_multipart
 
+import database.exceptions
+
 from .exceptions import *
 from .controllers import *
 from .historia_json_encoder import *
+from .static_cache import *
 
 
 class HistoriaServer(object):
 
     running = False
 
+    # Supported values for the server.mode setting.
+    modes = ('single', 'threaded', 'prefork')
+
     def startup(self, controller):
         '''Sets everything up'''
 
         # Set up the main Historia controller:
         self.controller = controller
 
-        # Server List
-        # self.Servers = []
-        # self.ServerCount = 5
-
         # Get the port number from the controller's settings.
-        port = self.controller.config['server']['port']
-        key_file = self.controller.config['server']['cert_file']
+        server_config = self.controller.config['server']
+        port = server_config['port']
+        key_file = server_config['cert_file']
+
+        # How requests are served: one at a time (single), by a pool of
+        # threads (threaded), or by a set of forked processes (prefork).
+        self.mode = server_config.get('mode', 'single')
+        self.workers = int(server_config.get('workers', 1))
+        if self.mode not in HistoriaServer.modes:
+            raise ValueError("Server mode must be one of {0}, not {1}".format(HistoriaServer.modes, self.mode))
+        if self.workers < 1:
+            raise ValueError("Server workers must be at least 1, not {0}".format(self.workers))
 
         HistoriaHTTPHandler.set_controller(self.controller)
 
-        self.server = http.server.HTTPServer(('localhost', int(port)),
-                                             HistoriaHTTPHandler)
+        if self.mode == 'threaded':
+            self.server = HistoriaThreadPoolServer(('localhost', int(port)),
+                                                   HistoriaHTTPHandler,
+                                                   workers=self.workers,
+                                                   queue_size=server_config.get('queue_size'),
+                                                   worker_setup=self.controller.worker_started,
+                                                   worker_teardown=self.controller.worker_stopped)
+        else:
+            self.server = http.server.HTTPServer(('localhost', int(port)),
+                                                 HistoriaHTTPHandler)
+
+        # The handshake is left to the first read so a slow client ties up
+        # the worker handling it rather than the accept loop.
         self.server.socket = ssl.wrap_socket(self.server.socket,
                                              server_side=True,
                                              certfile=key_file,
-                                             ssl_version=ssl.PROTOCOL_TLSv1)
-
-        # self.server_thread = threading.Thread(target=self.server.serve_forever)
-        # self.server_thread.setDaemon(True)
-        # self.server_thread.start()
+                                             ssl_version=ssl.PROTOCOL_TLSv1,
+                                             do_handshake_on_connect=False)
 
         self.running = True
-        self.server.serve_forever()
+        if self.mode == 'prefork':
+            self._serve_prefork()
+        else:
+            self.controller.start_session_reaper()
+            if self.mode == 'threaded':
+                self.server.start_workers()
+            self.server.serve_forever()
+
+    def _serve_prefork(self):
+        """Fork one child per worker, each serving requests from the shared
+        listening socket, and wait for them to exit."""
+        self._children = []
+        for i in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self._serve_child()
+                os._exit(0)
+            self._children.append(pid)
+
+        # Only the parent reaps sessions, and only once nothing more is forked
+        self.controller.start_session_reaper()
+
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def _serve_child(self):
+        """Main loop for a forked worker. SIGTERM finishes the current
+        request and exits; SIGINT is left to the parent."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: threading.Thread(target=self.server.shutdown).start())
+
+        # Database connections cannot be shared with the parent process.
+        self.controller.worker_forked()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.controller.worker_stopped()
+            self.controller.shutdown()
 
     def status(self, humanReadable=False):
         """Return the status of the server as a string"""
@@ -83,12 +149,108 @@ class HistoriaServer(object):
 
     # Stop the web server. Should be called by controller or Handler.
     def stop(self):
+        """Stop accepting new connections and wait for in-flight requests to
+        finish."""
 
         self.running = False
-        self.server.shutdown()
+        if self.mode == 'prefork':
+            for pid in self._children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self._children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+        else:
+            self.server.shutdown()
+            if self.mode == 'threaded':
+                self.server.drain()
+
+        self.server.server_close()
         print ("Server Shutdown Complete")
 
 
+class HistoriaThreadPoolServer(http.server.HTTPServer):
+    """HTTPServer that hands accepted connections to a fixed pool of worker
+    threads. Connections wait in a bounded queue; once it is full new
+    connections are answered with a 503 rather than piling up requests or
+    stalling the accept loop."""
+
+    busy_response = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                     b"Content-Length: 0\r\n"
+                     b"Retry-After: 1\r\n"
+                     b"Connection: close\r\n\r\n")
+
+    def __init__(self, server_address, handler_class, workers=5,
+                 queue_size=None, worker_setup=None, worker_teardown=None):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        if queue_size is None:
+            queue_size = workers * 4
+        self._requests = queue.Queue(maxsize=int(queue_size))
+        self._worker_setup = worker_setup
+        self._worker_teardown = worker_teardown
+        self._threads = []
+
+    def start_workers(self):
+        """Start the worker threads. Must be called before serve_forever()."""
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work,
+                                      name="historia-worker-{0}".format(i))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for the next free worker, or turn it away if
+        the queue is full."""
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            logging.getLogger('historia.web').warning("Request queue full, refusing connection from {0}".format(client_address[0]))
+            try:
+                request.sendall(self.busy_response)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _work(self):
+        """Worker loop: handle queued connections until given None."""
+        if self._worker_setup is not None:
+            try:
+                self._worker_setup()
+            except Exception as err:
+                logging.getLogger('historia.web').error("Worker setup failed: {0}".format(err))
+
+        try:
+            while True:
+                item = self._requests.get()
+                if item is None:
+                    break
+                request, client_address = item
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+        finally:
+            if self._worker_teardown is not None:
+                self._worker_teardown()
+
+    def drain(self, timeout=None):
+        """Stop the workers once every queued connection has been handled.
+        Call after shutdown() so nothing new is queued."""
+        for worker in self._threads:
+            self._requests.put(None)
+        for worker in self._threads:
+            worker.join(timeout)
+        self._threads = []
+
+
 class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
 
     # Path Namespace
@@ -106,11 +268,35 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
         'default': 'text/plain'
     }
 
+    # Cache-Control header for static files, by extension like file_types.
+    # Responses set cookies, so nothing should be kept by shared caches.
+    cache_control = {
+        'html': "no-cache",
+        'js': "private, max-age=3600",
+        'css': "private, max-age=3600",
+        'jpg': "private, max-age=86400",
+        'png': "private, max-age=86400",
+        'gif': "private, max-age=86400",
+        'default': "no-cache"
+    }
+
+    # gzip level for responses (0 turns compression off), the smallest
+    # body worth compressing, and the file_types extensions that are.
+    compress_level = 6
+    compress_min_size = 1024
+    compressible_types = ('html', 'json', 'js', 'css', 'default')
+
+    # Contents of recently sent static files
+    static_cache = HistoriaStaticCache()
+
+    # Bytes written at a time when sending files too large for static_cache
+    file_chunk_size = 65536
+
     # Historia Data controller to be used by all server threads
     controller = None
 
-    # A list of valid URL patterns.
-    patterns = []
+    # The controller's HistoriaRouter, matches valid URLs.
+    patterns = None
     special_cases = ['files']
 
     # Location of files directory
@@ -142,14 +328,32 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
     def set_controller(cls, controller):
         cls.controller = controller
         cls.patterns = controller.request_patterns()
+        cls.setup_compression(controller.config.get('server', {}).get('compression', {}))
+        cls.setup_static(controller.config.get('server', {}).get('static', {}))
+
+    @classmethod
+    def setup_compression(cls, settings):
+        """Set the gzip level and minimum size from the server.compression
+        section of the configuration. Call before setup_static()."""
+        cls.compress_level = int(settings.get('level', 6))
+        cls.compress_min_size = int(settings.get('min_size', 1024))
+
+    @classmethod
+    def setup_static(cls, settings):
+        """Set up the static file cache and Cache-Control headers from the
+        server.static section of the configuration."""
+        cls.static_cache = HistoriaStaticCache(settings.get('cache_size', 16777216),
+                                               settings.get('max_file_size', 1048576),
+                                               cls.compress_level,
+                                               cls.compress_min_size)
+        cls.cache_control = dict(HistoriaHTTPHandler.cache_control)
+        cls.cache_control.update(settings.get('cache_control', {}))
 
     def send_home(self, session):
         """Send the historia home page."""
         self.send_file(session, 'html/page.html')
 
     def send_record(self, session, record):
-        self._send_headers(200, 'json', session)
-
         if session.userid > 0:
             user_string = json.dumps(session._user, cls=HistoriaJSONEncoder)[1:-1]
         else:
@@ -169,7 +373,36 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
                        status=json.dumps(data is not False and data is not []),
                        data=data)
 
-        self.wfile.write(response.encode('utf-8'))
+        body = response.encode('utf-8')
+        headers = {'Vary': 'Accept-Encoding'}
+        if HistoriaHTTPHandler.compress_level > 0 and len(body) >= HistoriaHTTPHandler.compress_min_size \
+                and self._accepts_gzip():
+            body = gzip.compress(body, HistoriaHTTPHandler.compress_level)
+            headers['Content-Encoding'] = 'gzip'
+
+        self._send_headers(200, HistoriaHTTPHandler.file_types['json'], session,
+                           len(body), headers)
+        self.wfile.write(body)
+
+    def _accepts_gzip(self):
+        """Return True if the request's Accept-Encoding header allows a gzip
+        compressed response."""
+        accepted = {}
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, sep, parameters = coding.partition(';')
+            quality = 1.0
+            parameters = parameters.strip().replace(' ', '')
+            if parameters[:2] == 'q=':
+                try:
+                    quality = float(parameters[2:])
+                except ValueError as err:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+
+        for name in ('gzip', 'x-gzip', '*'):
+            if name in accepted:
+                return accepted[name] > 0
+        return False
 
     def send_file(self, session, file_path):
         """Send a file. Path must be within file_base_path. If file_base_path
@@ -177,31 +410,113 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
         if HistoriaHTTPHandler.file_base_path == "":
             self.send_error(403,
                             "File base path not configured, all files blocked.")
+            return
 
         real_path = self._check_file(file_path)
 
         if not real_path:
             self.send_error(404, "{0} not found".format(file_path))
+            return
 
         extension = os.path.splitext(real_path)[-1].lower()[1:]
-        content_type = HistoriaHTTPHandler.file_types[extension]
+        # Anything not in file_types is sent as the default type
+        file_type = extension if extension in HistoriaHTTPHandler.file_types else 'default'
+        content_type = HistoriaHTTPHandler.file_types[file_type]
         try:
-            mode = "r"
-            if not content_type.startswith("text"):
-                f = open(real_path, 'rb')
-                self._send_headers(200, content_type, session)
-                self.wfile.write(f.read())
-            else:
-                f = open(real_path, 'r')
-                self._send_headers(200, content_type, session)
-                self.wfile.write(f.read().encode('utf-8'))
+            static_file = HistoriaHTTPHandler.static_cache.get(real_path,
+                                                               file_type in HistoriaHTTPHandler.compressible_types)
+        except IOError as err:
+            self.send_error(404, "File Not Available: {0}".format(file_path))
+            return
 
-            f.close()
+        use_gzip = static_file.gzip_body is not None and self._accepts_gzip()
+        headers = {
+            'ETag': static_file.gzip_etag if use_gzip else static_file.etag,
+            'Last-Modified': static_file.last_modified,
+            'Cache-Control': HistoriaHTTPHandler.cache_control.get(extension,
+                                                                   HistoriaHTTPHandler.cache_control['default']),
+            'Accept-Ranges': 'bytes'
+        }
+        if static_file.gzip_body is not None:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if static_file.not_modified(self.headers, headers['ETag']):
+            # Content-Length is that of the file the client already has
+            if use_gzip:
+                headers['Content-Encoding'] = 'gzip'
+            self._send_headers(304, content_type, session,
+                               len(static_file.gzip_body) if use_gzip else static_file.size, headers)
+            return
+
+        try:
+            byte_range = static_file.byte_range(self.headers)
+        except HTTPException as err:
+            headers['Content-Range'] = "bytes */{0}".format(static_file.size)
+            self._send_headers(err.response_code, content_type, session, 0, headers)
+            return
+
+        if use_gzip and byte_range is None:
+            headers['Content-Encoding'] = 'gzip'
+            self._send_headers(200, content_type, session, len(static_file.gzip_body), headers)
+            self.wfile.write(static_file.gzip_body)
+            return
+
+        code = 200
+        start, stop = 0, static_file.size
+        if byte_range is not None:
+            # Ranges are of the file as it is on disk
+            headers['ETag'] = static_file.etag
+            code = 206
+            start, stop = byte_range
+            headers['Content-Range'] = "bytes {0}-{1}/{2}".format(start, stop - 1, static_file.size)
+
+        if static_file.body is not None:
+            # Text files are stored as utf-8, so the raw bytes can be sent as is.
+            self._send_headers(code, content_type, session, stop - start, headers)
+            self.wfile.write(memoryview(static_file.body)[start:stop])
+            return
+
+        # Too large for the cache, so send it straight from the file
+        try:
+            f = open(real_path, 'rb')
         except IOError as err:
             self.send_error(404, "File Not Available: {0}".format(file_path))
+            return
 
-    def _send_headers(self, code, contentType, session):
-        """Setup and send the headers for a valid 200 text response"""
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_mtime_ns != static_file.mtime_ns or stat.st_size != static_file.size:
+                self.send_error(503, "File changed while being sent: {0}".format(file_path))
+                return
+            self._send_headers(code, content_type, session, stop - start, headers)
+            self._send_file_range(f, start, stop - start)
+
+    def _send_file_range(self, f, offset, count):
+        """Write count bytes of the open file f, starting at offset, after the
+        headers. On a plain socket the kernel copies them straight from the
+        file; under TLS (or with no socket) they are written a chunk at a time
+        from a memory map, so the file is never read into memory as a whole."""
+        if count == 0:
+            return
+
+        if self.connection is not None and not isinstance(self.connection, ssl.SSLSocket):
+            self.wfile.flush()
+            self.connection.sendfile(f, offset, count)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                end = min(offset + count, len(mapped))
+                for position in range(offset, end, HistoriaHTTPHandler.file_chunk_size):
+                    self.wfile.write(view[position:min(position + HistoriaHTTPHandler.file_chunk_size, end)])
+            finally:
+                view.release()
+
+    def _send_headers(self, code, contentType, session, content_length=None,
+                      headers=None):
+        """Setup and send the headers for a valid 200 text response. headers
+        is an optional dict of any others to send."""
         self.send_response(code)
         self.send_header('Set-Cookie', "session={sid}; path=/".format(
                             sid=session.sessionid))
@@ -213,6 +528,11 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
             self.send_header('Set-Cookie',
                              "isadmin={uid}; path=/".format(uid=session._user.admin))
         self.send_header("content-type", contentType)
+        if content_length is not None:
+            self.send_header("content-length", str(content_length))
+        if headers is not None:
+            for name, value in headers.items():
+                self.send_header(name, value)
         self.end_headers()
 
     def _check_file(self, path):
@@ -240,11 +560,32 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
         """ Handle get requests. """
 
         self.log_message("Processing GET request %s", self.path)
+        self._in_request_context(self._process_GET)
 
+    def do_POST(self):
+        """Handle post functions. """
+
+        self.log_message("Processing POST request %s", self.path)
+        self._in_request_context(self._process_POST)
+
+    def _in_request_context(self, process):
+        """Run process inside the controller's request context, answering 503
+        if the controller cannot serve requests right now."""
+        try:
+            with self.controller.request_context():
+                process()
+        except DatabaseNotReady as err:
+            self.send_error(503, "Service temporarily unavailable")
+        except database.exceptions.HistoriaDataException as err:
+            # Changes made after the response was sent, which can't be
+            # reported to the client any more.
+            self.log_error("Unable to save changes at the end of request {0}: {1}".format(self.path, err))
+
+    def _process_GET(self):
         # Split the query string from the path
         query_string = self.path.split('?')[1] if '?' in self.path else ""
         try:
-            path_request = HistoriaHTTPHandler.ValidateURL(self.path)
+            path_request = HistoriaHTTPHandler.ResolveURL(self.path)
         except HTTPException as err:
             self.send_error(err.response_code, str(err))
             return
@@ -261,20 +602,17 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
         else:
             # For all other values we send the request to the controller for
             # handling.
-            self._current_command = ":".join(path_request)
+            self._current_command = ":".join(path_request[:2])
             query_parameters = urllib.parse.parse_qs(self.path.split('?')[1], keep_blank_values=True)\
                 if '?' in self.path else {}
 
             self.controller.process_request(self, session, path_request[0],
-                                            path_request[1], query_parameters)
-
-    def do_POST(self):
-        """Handle post functions. """
-
-        self.log_message("Processing POST request %s", self.path)
+                                            path_request[1], query_parameters,
+                                            path_request[2])
 
+    def _process_POST(self):
         try:
-            path_request = HistoriaHTTPHandler.ValidateURL(self.path)
+            path_request = HistoriaHTTPHandler.ResolveURL(self.path)
         except HTTPException as err:
             self.send_error(err.response_code, str(err))
             return
@@ -288,9 +626,10 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
             self.log_error("Unhandled error processing posted data sent to {0}: {1}".format(self.path, str(err)))
             self.send_error(500, "Error processing posted values.")
             return
-        self._current_command = ":".join(path_request)
+        self._current_command = ":".join(path_request[:2])
         self.controller.process_request(self, session, path_request[0],
-                                        path_request[1], post_parameters)
+                                        path_request[1], post_parameters,
+                                        path_request[2])
 
     def parse_POST(self):
         ctype, pdict = parse_header(self.headers['content-type'])
@@ -337,21 +676,28 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
     @classmethod
     def ValidateURL(cls, path):
         """ValidateURL:  checks to see if the given URL is valid request for
-        Historia's web server. If the URL is valid return a dict with the
+        Historia's web server. If the URL is valid return a tuple with the
         parsed URL.
 
         Valid URLS are defined by the controller and imported into
         HistoriaHTTPHandler.patterns during __init__().
         """
+        return cls.ResolveURL(path)[:2]
 
-        # if there is a trailing slash, remove it
-        if path[-1:] == '/':
-            path = path[:-1]
+    @classmethod
+    def ResolveURL(cls, path):
+        """ResolveURL: as ValidateURL, with the controller's HistoriaRoute
+        for the request (None for home and special cases) as the third item,
+        so the routers aren't searched again to process it."""
 
         # If there is a query string, drop it
         if '?' in path:
             path = path.split('?')[0]
 
+        # if there is a trailing slash, remove it
+        if path[-1:] == '/':
+            path = path[:-1]
+
         # push the URL to lowercase to avoid case issues, and split it into
         # segments:
         segments = path.casefold().split('/')
@@ -375,13 +721,13 @@ class HistoriaHTTPHandler(http.server.BaseHTTPRequestHandler):
 
         # Check for special cases
         if len(segments) == 0:  # site root means we want the home page
-            return ('home', '')
+            return ('home', '', None)
         elif segments[0] in HistoriaHTTPHandler.special_cases:
-            return (segments[0], '/'.join(segments[1:]))
+            return (segments[0], '/'.join(segments[1:]), None)
 
         # Compare remaining segments against the valid patterns
-        request = "/".join(segments)
-        if HistoriaHTTPHandler.patterns.match(request) is None:
+        route = HistoriaHTTPHandler.patterns.match("/".join(segments))
+        if route is None:
             raise HTTPException("Location not found: {0}".format(path), 404)
         else:
-            return (segments[0], '/'.join(segments[1:]))
+            return (route.target, route.request, route)
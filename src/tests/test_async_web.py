@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_async_web.py
+
+Created by Aaron Crosman on 2015-03-09.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import socket
+import unittest
+import unittest.mock
+import threading
+
+from internals import controllers
+from internals import async_web
+
+
+class EchoController(object):
+    """Stands in for HistoriaCoreController, recording the threads the
+    server sets up and tears down."""
+
+    def __init__(self):
+        self.config = {
+            'server': {
+                'port': 0,
+                'cert_file': None,
+                'workers': 2,
+                'keepalive_timeout': 1,
+                'body_timeout': 0.2,
+                'shutdown_timeout': 5
+            }
+        }
+        self.started = []
+        self.stopped = []
+
+    def start_session_reaper(self):
+        pass
+
+    def worker_started(self):
+        self.started.append(threading.current_thread().name)
+
+    def worker_stopped(self):
+        self.stopped.append(threading.current_thread().name)
+
+
+def echo(handler):
+    """Answer with the method, path, body and client port of the request."""
+    length = int(handler.headers.get('Content-Length', 0))
+    body = "{0} {1} {2} {3}".format(handler.command, handler.path,
+                                    handler.rfile.read(length).decode('utf-8'),
+                                    handler.client_address[1]).encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def read_response(f):
+    """Read one response from the file f, returning (code, headers, body) or
+    None if the connection was closed."""
+    status = f.readline()
+    if status == b"":
+        return None
+    headers = {}
+    for line in iter(f.readline, b"\r\n"):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = f.read(int(headers.get('content-length', 0)))
+    return int(status.split()[1]), headers, body.decode('utf-8')
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            unittest.mock.patch.object(async_web.HistoriaAsyncServer, '_ssl_context', return_value=None),
+            unittest.mock.patch.object(async_web.HistoriaHTTPHandler, 'set_controller'),
+            unittest.mock.patch.object(async_web.HistoriaBufferedHandler, 'do_GET', echo, create=True),
+            unittest.mock.patch.object(async_web.HistoriaBufferedHandler, 'do_POST', echo, create=True)
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.controller = EchoController()
+        self.server = async_web.HistoriaAsyncServer()
+        self.serve_thread = threading.Thread(target=self.server.startup, args=(self.controller,))
+        self.serve_thread.start()
+
+        for i in range(50):
+            if self.server.running:
+                break
+            time.sleep(0.1)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        if self.server.running:
+            self.server.stop()
+        self.serve_thread.join(10)
+
+    def connect(self):
+        sock = socket.create_connection(('localhost', self.port), timeout=10)
+        self.addCleanup(sock.close)
+        return sock, sock.makefile('rb')
+
+    def test_00_keepalive(self):
+        """HistoriaAsyncServer: one connection serves several requests"""
+        sock, f = self.connect()
+
+        sock.sendall(b"GET /first HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        code, headers, first = read_response(f)
+        self.assertEqual(code, 200, "First request failed")
+        sock.sendall(b"GET /second HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        code, headers, second = read_response(f)
+        self.assertEqual(code, 200, "Second request failed")
+
+        self.assertTrue(first.startswith("GET /first"), "Wrong response to first request")
+        self.assertTrue(second.startswith("GET /second"), "Wrong response to second request")
+        self.assertEqual(first.split()[-1], second.split()[-1], "Requests came from different connections")
+
+    def test_10_pipelined(self):
+        """HistoriaAsyncServer: pipelined requests are answered in order"""
+        sock, f = self.connect()
+
+        sock.sendall(b"GET /one HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                     b"POST /two HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n\r\nSpam"
+                     b"GET /three HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+
+        bodies = [read_response(f)[2] for i in range(3)]
+        self.assertEqual([b.rsplit(' ', 1)[0] for b in bodies], ["GET /one ", "POST /two Spam", "GET /three "],
+                         "Pipelined requests answered out of order")
+        self.assertIsNone(read_response(f), "Connection not closed when asked")
+
+    def test_20_idle_timeout(self):
+        """HistoriaAsyncServer: idle connections are closed after
+        keepalive_timeout, slow bodies get a 408 after body_timeout"""
+        sock, f = self.connect()
+        started = time.monotonic()
+        self.assertIsNone(read_response(f), "Idle connection sent a response")
+        self.assertLess(time.monotonic() - started, 5, "Idle connection not closed")
+
+        sock, f = self.connect()
+        sock.sendall(b"POST /slow HTTP/1.1\r\nHost: localhost\r\nContent-Length: 10\r\n\r\nSpam")
+        self.assertEqual(read_response(f)[0], 408, "Incomplete body not timed out")
+        self.assertIsNone(read_response(f), "Connection not closed after timeout")
+
+    def test_30_errors(self):
+        """HistoriaAsyncServer: malformed requests get a 400, and bytes past
+        Content-Length are read as the next request"""
+        sock, f = self.connect()
+        sock.sendall(b"NONSENSE\r\n\r\n")
+        self.assertEqual(read_response(f)[0], 400, "Malformed request line accepted")
+        self.assertIsNone(read_response(f), "Connection not closed after a malformed request")
+
+        sock, f = self.connect()
+        sock.sendall(b"POST /echo HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n\r\nSpamEggs\r\n\r\n")
+        code, headers, body = read_response(f)
+        self.assertEqual(body.rsplit(' ', 1)[0], "POST /echo Spam", "Body not cut at Content-Length")
+        self.assertEqual(read_response(f)[0], 400, "Extra bytes not treated as the next request")
+        self.assertIsNone(read_response(f), "Connection not closed after a malformed request")
+
+    def test_40_shutdown(self):
+        """HistoriaAsyncServer: stop() closes idle connections and tears down
+        every worker thread"""
+        sock, f = self.connect()
+        sock.sendall(b"GET /one HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        read_response(f)
+
+        self.server.stop()
+        self.serve_thread.join(10)
+
+        self.assertFalse(self.serve_thread.is_alive(), "Server did not stop")
+        self.assertIsNone(read_response(f), "Idle connection left open")
+        self.assertNotEqual(self.controller.started, [], "No worker threads started")
+        self.assertEqual(sorted(self.controller.started), sorted(self.controller.stopped),
+                         "Every worker that started should have been torn down")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_connection_pool.py
+
+Created by Aaron Crosman on 2015-03-10.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+import unittest.mock
+import threading
+
+import mysql.connector
+
+from database import connection_pool
+from database import core_data_objects
+from database import exceptions
+
+import tests.helper_functions
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    config_location = 'tests/test_config'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config = tests.helper_functions.load_configuration(cls.config_location)
+
+    def setUp(self):
+        self.default_settings = {
+          'user': type(self).config['database']['user'],
+          'password': type(self).config['database']['password'],
+          'host': type(self).config['database']['host'],
+          'database': '',
+          'raise_on_warnings': type(self).config['database']["raise_on_warnings"]
+        }
+        self.pool = connection_pool.HistoriaConnectionPool(self.default_settings,
+                                                           size=2, overflow=1,
+                                                           idle_timeout=300,
+                                                           timeout=0.5)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_00_construct(self):
+        """HistoriaConnectionPool: Constructor"""
+        stats = self.pool.pool_stats()
+
+        self.assertEqual(stats['size'], 2, "Pool size not set")
+        self.assertEqual(stats['overflow'], 1, "Pool overflow not set")
+        self.assertEqual(stats['open'], 0, "Connections should be opened on demand")
+        self.assertEqual(stats['idle'], 0, "Connections should be opened on demand")
+
+    def test_10_reuse(self):
+        """HistoriaConnectionPool: released connections are reused"""
+        first = self.pool.acquire()
+        self.assertTrue(first.is_connected(), "Pool returned a closed connection")
+        self.pool.release(first)
+
+        second = self.pool.acquire()
+        self.assertIs(first, second, "Idle connection was not reused")
+        self.pool.release(second)
+
+        stats = self.pool.pool_stats()
+        self.assertEqual(stats['created'], 1, "Only one connection should have been opened")
+        self.assertEqual(stats['checkouts'], 2, "Checkouts not counted")
+        self.assertEqual(stats['idle'], 1, "Returned connection should be idle")
+        self.assertEqual(stats['in_use'], 0, "No connections should be in use")
+
+    def test_20_overflow(self):
+        """HistoriaConnectionPool: overflow connections are closed and callers time out when exhausted"""
+        connections = [self.pool.acquire() for i in range(3)]
+        self.assertEqual(self.pool.pool_stats()['in_use'], 3, "Overflow connection not opened")
+
+        self.assertRaises(exceptions.DataConnectionError, self.pool.acquire)
+        self.assertEqual(self.pool.pool_stats()['timeouts'], 1, "Timeout not counted")
+
+        for c in connections:
+            self.pool.release(c)
+
+        stats = self.pool.pool_stats()
+        self.assertEqual(stats['idle'], 2, "Only size connections should be kept")
+        self.assertEqual(stats['open'], 2, "Overflow connection should have been closed")
+        self.assertFalse(connections[2].is_connected(), "Overflow connection still open")
+
+    def test_25_wait(self):
+        """HistoriaConnectionPool: waiting callers get the next returned connection"""
+        self.pool.timeout = 5
+        connections = [self.pool.acquire() for i in range(3)]
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.pool.acquire()))
+        waiter.start()
+
+        self.pool.release(connections[0])
+        waiter.join(5)
+
+        self.assertIs(results[0], connections[0], "Waiting caller did not get the returned connection")
+        self.assertEqual(self.pool.pool_stats()['waits'], 1, "Wait not counted")
+
+        for c in results + connections[1:]:
+            self.pool.release(c)
+
+    def test_30_health_check(self):
+        """HistoriaConnectionPool: dead connections are replaced on checkout"""
+        first = self.pool.acquire()
+        self.pool.release(first)
+        first.close()
+
+        second = self.pool.acquire()
+        self.assertIsNot(first, second, "Closed connection handed out again")
+        self.assertTrue(second.is_connected(), "Replacement connection not connected")
+        self.assertEqual(self.pool.pool_stats()['failed_health_checks'], 1, "Failed health check not counted")
+        self.pool.release(second)
+
+    def test_35_idle_timeout(self):
+        """HistoriaConnectionPool: connections idle too long are closed"""
+        first = self.pool.acquire()
+        self.pool.release(first)
+        self.pool.idle_timeout = -1
+
+        second = self.pool.acquire()
+        self.assertIsNot(first, second, "Stale connection handed out again")
+        self.assertFalse(first.is_connected(), "Stale connection not closed")
+        self.pool.release(second)
+
+    def test_40_release_rollback(self):
+        """HistoriaConnectionPool: open transactions are rolled back on release"""
+        connection = self.pool.acquire()
+        connection.start_transaction()
+        self.pool.release(connection)
+
+        connection = self.pool.acquire()
+        self.assertFalse(connection.in_transaction, "Transaction left open on pooled connection")
+        self.pool.release(connection)
+
+    def test_45_checkouts(self):
+        """HistoriaConnectionPool: each connection handed out is one checkout"""
+        connections = [unittest.mock.MagicMock() for i in range(4)]
+        connections[0].is_connected.return_value = False
+
+        with unittest.mock.patch.object(connection_pool.mysql.connector, 'connect', side_effect=connections):
+            first = self.pool.acquire()
+            self.pool.release(first)
+            acquired = [self.pool.acquire() for i in range(3)]  # One replaces first, one is overflow
+            self.assertRaises(exceptions.DataConnectionError, self.pool.acquire)
+
+        stats = self.pool.pool_stats()
+        self.assertEqual(acquired, connections[1:], "Wrong connections handed out")
+        self.assertEqual(stats['checkouts'], 4, "Checkouts miscounted")
+        self.assertEqual((stats['failed_health_checks'], stats['timeouts']), (1, 1), "Failures not counted")
+
+        for c in acquired:
+            self.pool.release(c)
+
+    def test_50_database_borrow(self):
+        """HistoriaConnectionPool: HistoriaDatabase.borrow() binds one pooled connection to the thread"""
+        db = core_data_objects.HistoriaDatabase(None)
+        db.connection_settings = self.default_settings
+        db.pool_settings = {'size': 2, 'overflow': 0}
+        db.connect()
+
+        self.assertTrue(db.pooled, "Database did not create a pool")
+        shared = db.connection
+
+        with db.borrow() as connection:
+            self.assertIsNot(connection, shared, "Borrowed connection should come from the pool")
+            self.assertIs(db.connection, connection, "Borrowed connection not used by the thread")
+            with db.borrow() as inner:
+                self.assertIs(inner, connection, "Nested borrow should share the connection")
+            self.assertEqual(db.pool_stats()['in_use'], 1, "Only one connection should be checked out")
+
+        self.assertIs(db.connection, shared, "Shared connection not restored after borrow")
+        self.assertEqual(db.pool_stats()['in_use'], 0, "Borrowed connection not returned")
+
+        db.execute_select(("SELECT 1", {}))
+        self.assertEqual(db.pool_stats()['checkouts'], 2, "Statements outside borrow() should use the pool")
+
+        db.disconnect()
+        self.assertFalse(db.pooled, "Pool not closed on disconnect")
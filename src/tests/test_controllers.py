@@ -26,6 +26,7 @@ import unittest
 import logging
 import sys
 import re
+import unittest.mock
 
 import mysql.connector
 
@@ -35,6 +36,7 @@ from database import core_data_objects
 from database import system_db
 from database import user_db
 from database import user
+from database import exceptions
 
 import tests.helper_functions
 
@@ -208,6 +210,85 @@ class TestHistoriaCoreController(unittest.TestCase):
 
         obj.database.disconnect()
 
+    def test_35_edit_user(self):
+        """HistoriaCoreController: user_edit() and user_set_password()"""
+        obj = controllers.HistoriaCoreController(config_location = 'tests/test_config')
+        db = obj.create_database(self.testDBName, self.default_settings, db_type="system")
+
+        obj.database = db
+
+        name = "Sir Galahad of Camelot"
+        password = "Blue. No, yel..."
+        u1 = user.HistoriaUser(db)
+        u1.name = name
+        u1.password = password
+        u1.email = "galahad@camelot.gov.uk"
+        u1.enabled = True
+        u1.save()
+        original_hash = u1.password
+
+        sess = obj.start_session("127.0.0.1")
+        sess._user = u1
+
+        # Editing without a password leaves it alone
+        parameters = {'id': u1.id, 'name': name, 'email': "galahad@example.com", 'enabled': 0, 'admin': 0}
+        edited = obj.user_edit(sess, parameters)
+        self.assertEqual(edited.password, original_hash, "Password changed by edit without a password.")
+        self.assertEqual(edited.email, "galahad@example.com", "Email not changed by edit.")
+        self.assertIsInstance(obj.authenticate_user(name, password), user.HistoriaUser, "Old password no longer works.")
+
+        new_password = "Blue!"
+        edited = obj.user_set_password(sess, {'id': u1.id, 'password': new_password})
+        self.assertNotEqual(edited.password, original_hash, "Password not changed.")
+        self.assertFalse(obj.authenticate_user(name, password), "Old password still works.")
+        self.assertIsInstance(obj.authenticate_user(name, new_password), user.HistoriaUser, "New password doesn't work.")
+
+        with self.assertRaises(controllers.InvalidParametersError):
+            obj.user_set_password(sess, {'id': u1.id, 'password': ""})
+
+        obj.database.disconnect()
+
+    def test_37_user_list(self):
+        """HistoriaCoreController: user_list()"""
+        obj = controllers.HistoriaCoreController(config_location = 'tests/test_config')
+        db = obj.create_database(self.testDBName, self.default_settings, db_type="system")
+
+        obj.database = db
+
+        users = []
+        for i in range(5):
+            u = user.HistoriaUser(db)
+            u.name = "Knight {0}".format(i)
+            u.password = "Ni!"
+            u.email = "knight{0}@camelot.gov.uk".format(i)
+            u.enabled = True
+            u.admin = (i == 0)
+            u.save()
+            users.append(u)
+
+        sess = obj.start_session("127.0.0.1")
+        sess._user = users[0]
+
+        # Query string values arrive as lists
+        page = obj.user_list(sess, {'size': ['2']})
+        self.assertEqual([u.id for u in page['users']], [u.id for u in users[:2]], "Wrong users on first page")
+        self.assertIsNotNone(page['next'], "No token for the next page")
+
+        seen = page['users']
+        while page['next'] is not None:
+            page = obj.user_list(sess, {'size': ['2'], 'after': [page['next']]})
+            seen += page['users']
+        self.assertEqual([u.id for u in seen], [u.id for u in users], "Paging didn't return each user once")
+
+        with self.assertRaises(controllers.InvalidParametersError):
+            obj.user_list(sess, {'after': ['junk']})
+
+        sess._user = users[1]
+        with self.assertRaises(controllers.InvalidPermissionsError):
+            obj.user_list(sess, {})
+
+        obj.database.disconnect()
+
     @unittest.expectedFailure
     def test_40_check_access(self):
         """HistoriaCoreController: check_access(self, user, database)"""
@@ -246,3 +327,78 @@ class TestHistoriaCoreController(unittest.TestCase):
         for url in invalid_urls:
             match = pat.match(url)
             self.assertIsNone(match, "Matched: {0}".format(url))
+
+    def test_65_process_request_flush(self):
+        """HistoriaCoreController: process_request() saves changes before
+        answering, and reports a failed save"""
+        obj = controllers.HistoriaCoreController(
+                config_location='tests/test_config')
+        obj.database = unittest.mock.MagicMock()
+        obj.active_users = {}
+        obj.active_user_databases = {}
+        handler = unittest.mock.MagicMock()
+        handler.command = 'GET'
+        session = unittest.mock.MagicMock()
+
+        obj.process_request(handler, session, 'system', 'status/info', {})
+        obj.database.flush.assert_called_once_with()
+        self.assertTrue(handler.send_record.called, "Record not sent")
+
+        obj.database.flush.side_effect = exceptions.DataSaveError("Failed")
+        handler.reset_mock()
+        obj.process_request(handler, session, 'system', 'status/info', {})
+        handler.send_error.assert_called_once_with(500, "General Error processing request")
+        self.assertFalse(handler.send_record.called, "Record sent for a failed save")
+
+    def test_66_worker_unconnected(self):
+        """HistoriaCoreController: a worker that can't connect to the
+        database refuses requests until it can"""
+        obj = controllers.HistoriaCoreController(
+                config_location='tests/test_config')
+        obj.database = unittest.mock.MagicMock()
+        obj.database.pooled = False
+        obj.database.connect_thread.side_effect = exceptions.DataConnectionError("Failed")
+
+        obj.worker_started()
+        with self.assertRaises(controllers.DatabaseNotReady):
+            with obj.request_context():
+                self.fail("Request handled without a connection")
+        self.assertFalse(obj.database.borrow.called, "Shared connection used")
+
+        obj.database.connect_thread.side_effect = None
+        with obj.request_context():
+            pass
+        self.assertEqual(obj.database.connect_thread.call_count, 3, "Connection not retried")
+
+        with obj.request_context():
+            pass
+        self.assertEqual(obj.database.connect_thread.call_count, 3, "Connected again once connected")
+
+    def test_67_process_request_abandon(self):
+        """HistoriaCoreController: changes made by a request that fails are
+        not saved when the request ends"""
+        obj = controllers.HistoriaCoreController(
+                config_location='tests/test_config')
+        obj.database = core_data_objects.HistoriaDatabase('historia_test')
+        obj.database.connection = unittest.mock.MagicMock()
+        obj.database.connection.is_connected.return_value = True
+        handler = unittest.mock.MagicMock()
+        handler.command = 'POST'
+        session = unittest.mock.MagicMock()
+
+        def edit(session, parameters):
+            record = core_data_objects.HistoriaRecord.get(obj.database, 5)
+            record.value = "Changed"
+            int(parameters['admin'])  # TypeError, as for {"admin": null}
+
+        route = unittest.mock.MagicMock()
+        route.entry = {'type': 'POST', 'function': edit}
+        row = [{'id': 5, 'value': "Original"}]
+        with unittest.mock.patch.object(obj.database, 'execute_select', return_value=row), \
+                unittest.mock.patch.object(obj.database, 'execute_update') as update, \
+                unittest.mock.patch.object(obj.database, 'execute_many') as update_many:
+            with obj.request_context():
+                obj.process_request(handler, session, 'system', 'user/edit', {'admin': None}, route)
+
+        handler.send_error.assert_called_once_with(500, "General Error processing request")
+        self.assertFalse(update.called or update_many.called, "Changes saved for a failed request")
@@ -24,7 +24,9 @@ Created by Aaron Crosman on 2015-02-02.
 
 import unittest
 import logging, sys
+import copy
 import json
+import unittest.mock
 
 import mysql.connector
 
@@ -296,6 +298,105 @@ class TestDatabase(unittest.TestCase):
         db.disconnect()
         self.assertRaises(exceptions.DataConnectionError, db.execute_update, update_statement)
 
+    def test_048_iter_select(self):
+        """HistoriaDatabase: iter_select() streams rows"""
+        db = self.prep_execute_test_tables()
+        if not db:
+            self.fail("Unable to create database for testing.")
+
+        values = ["Row {0}".format(i) for i in range(7)]
+        db.execute_many(("INSERT INTO {0} (`val`) VALUES (%s)".format(self.test_table), [[v] for v in values]))
+
+        select = ("SELECT * FROM {0} ORDER BY `id`".format(self.test_table), [])
+        rows = db.iter_select(select, batch_size=3)
+        self.assertNotIsInstance(rows, list, "iter_select() should return a generator")
+        self.assertEqual([row['val'] for row in rows], values, "Incorrect rows streamed")
+
+        # Stopping early leaves the connection usable
+        rows = db.iter_select(select, batch_size=2)
+        self.assertEqual(next(rows)['val'], values[0], "Incorrect first row")
+        rows.close()
+        self.assertEqual(len(db.execute_select(select)), len(values), "Connection unusable after stopping early")
+
+    def test_050_transaction(self):
+        """HistoriaDatabase: transaction() commits once, rolls back on errors"""
+        db = self.prep_execute_test_tables()
+        if not db:
+            self.fail("Unable to create database for testing.")
+
+        # A second connection only sees committed data.
+        observer = core_data_objects.HistoriaDatabase(self.testdb_name)
+        observer.connection_settings = dict(self.default_settings, database=self.testdb_name)
+        observer.connect()
+        count = ("SELECT COUNT(*) AS `total` FROM {0}".format(self.test_table), {})
+        insert = "INSERT INTO {0} (`val`) VALUES (%s)".format(self.test_table)
+
+        with db.transaction():
+            self.assertTrue(db.in_transaction, "Not reporting being in a transaction")
+            db.execute_insert((insert, ['first']))
+            db.execute_insert((insert, ['second']))
+            observer.commit()
+            self.assertEqual(observer.execute_select(count)[0]['total'], 0, "Inserts committed before the transaction ended")
+
+        self.assertFalse(db.in_transaction, "Still reporting being in a transaction")
+        observer.commit()
+        self.assertEqual(observer.execute_select(count)[0]['total'], 2, "Transaction not committed")
+
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.execute_insert((insert, ['rolled back']))
+                raise ValueError("Roll it back")
+
+        self.assertEqual(db.execute_select(count)[0]['total'], 2, "Transaction not rolled back")
+
+        # Nested blocks only undo their own work
+        with db.transaction():
+            db.execute_insert((insert, ['outer']))
+            try:
+                with db.transaction():
+                    db.execute_insert((insert, ['inner']))
+                    raise ValueError("Roll back the inner block")
+            except ValueError:
+                pass
+
+        select = ("SELECT `val` FROM {0} WHERE `id` > 2 ORDER BY `id`".format(self.test_table), {})
+        self.assertEqual([r['val'] for r in db.execute_select(select)], ['outer'], "Savepoint not rolled back on its own")
+
+        observer.disconnect()
+
+    def test_060_prepared(self):
+        """HistoriaDatabase: registered statements run as prepared statements"""
+        db = self.prep_execute_test_tables()
+        if not db:
+            self.fail("Unable to create database for testing.")
+
+        db.prepared_statements = True
+        insert = ("INSERT INTO {0} (`val`) VALUES (%(val)s)".format(self.test_table), {'val': "Spam"})
+        select = ("SELECT * FROM {0} WHERE `val` = %(val)s".format(self.test_table), {'val': "Spam"})
+        update = ("UPDATE {0} SET `val` = %(new)s WHERE `val` = %(val)s".format(self.test_table), {'val': "Spam", 'new': "Eggs"})
+        db._prepared.register(select[0])
+        db._prepared.register(update[0])
+
+        db.execute_insert(insert)
+        for i in range(3):
+            result = db.execute_select(select)
+            self.assertEqual(len(result), 1, "There should be 1 and only 1 record to return")
+            self.assertEqual(result[0]['val'], "Spam", "Incorrect value returned")
+
+        self.assertEqual(db.execute_update(update), 1, "Update should change one row")
+        self.assertEqual(len(db.execute_select(select)), 0, "Update not applied")
+
+        stats = db.prepared_stats()
+        self.assertEqual(stats['registered'], 2, "Wrong number of registered statements")
+        self.assertEqual(stats['prepares'], 2, "Each statement should be prepared once")
+        self.assertEqual(stats['hits'], 3, "Prepared statements weren't reused")
+        self.assertEqual(stats['fallbacks'], 0, "Prepared statements shouldn't have failed")
+
+        # Turned off, the same statements use regular cursors.
+        db.prepared_statements = False
+        db.execute_select(select)
+        self.assertEqual(db.prepared_stats()['hits'], 3, "Prepared statement used while disabled")
+
 
 class TestRecord(unittest.TestCase):
 
@@ -366,6 +467,8 @@ class TestRecord(unittest.TestCase):
         self.assertEqual(len(core_data_objects.HistoriaRecord._table_fields), 2, "There should be two fields on a generic record: id, value")
         self.assertIn('id', core_data_objects.HistoriaRecord._table_fields, "There should be an id field on generic record")
         self.assertIn('value', core_data_objects.HistoriaRecord._table_fields, "There should be a value field on a generic record")
+        self.assertIn('value', core_data_objects.HistoriaRecord.__slots__, "Fields should be stored in slots")
+        self.assertNotIn('id', core_data_objects.HistoriaRecord.__slots__, "The id field shouldn't have a slot")
 
 
     def test_001_construct(self):
@@ -401,6 +504,40 @@ class TestRecord(unittest.TestCase):
             except mysql.connector.Error as err:
                 self.fail("Unable to create testing database: {0} \n while executing: {1}".format(err, state[0]))
 
+    def test_007_compiled_SQL(self):
+        """HistoriaRecord: statements are compiled once per class"""
+        hr = core_data_objects.HistoriaRecord(self.db)
+        hr.value = "Data"
+
+        self.assertEqual(core_data_objects.HistoriaRecord._primary_key, 'id', "Wrong primary key found")
+
+        fields = copy.deepcopy(core_data_objects.HistoriaRecord._table_fields)
+        del fields['value']['default']
+        class Defaultless(core_data_objects.HistoriaRecord):
+            machine_type = "historia_defaultless"
+            _table_fields = copy.deepcopy(fields)
+
+        self.assertEqual(Defaultless._table_fields, fields, "Compiling changed _table_fields")
+        self.assertEqual(Defaultless._sql['insert_fields'][0][:2], ('value', None), "Missing default not read as None")
+
+        statement, values = hr._generate_insert_SQL()
+        self.assertEqual(statement, "INSERT INTO `historia_generic` ( `value` ) VALUES ( %(value)s)", "Incorrect insert statement")
+        self.assertEqual(values, {'value': "Data"}, "Incorrect insert values")
+        self.assertIs(statement, hr._generate_insert_SQL()[0], "Insert statement was not reused")
+
+        hr._id = 5
+        statement, values = hr._generate_update_SQL()
+        self.assertEqual(statement, "UPDATE `historia_generic` SET `value` = %(value)s WHERE `id` = %(id)s", "Incorrect update statement")
+        self.assertEqual(values, {'value': "Data", 'id': 5}, "Incorrect update values")
+
+        statement, values = hr._generate_delete_SQL()
+        self.assertEqual(statement, "DELETE FROM `historia_generic` WHERE `id` = %(id)s", "Incorrect delete statement")
+        self.assertEqual(values, {'id': 5}, "Incorrect delete values")
+
+        statement, values = hr._generate_select_SQL(5)
+        self.assertEqual(statement, "SELECT * FROM `historia_generic` WHERE `id` = %(id)s", "Incorrect select statement")
+        self.assertEqual(values, {'id': 5}, "Incorrect select values")
+
     def test_010_internals(self):
         """HistoriaRecord: __setattr__"""
 
@@ -412,6 +549,15 @@ class TestRecord(unittest.TestCase):
         hr._anything = "ok"
         self.assertEqual(hr._anything, "ok", "Assignment of _ variables works fine.")
 
+        self.assertEqual(core_data_objects.HistoriaRecord._validators['value'][0], str, "Wrong validator for a char field")
+        with self.assertRaises(ValueError):
+            hr.value = 5
+
+        hr._hydrate({'id': 3, 'value': "Row"})
+        self.assertEqual(hr.id, 3, "ID not set from row")
+        self.assertEqual(hr.value, "Row", "Value not set from row")
+        self.assertFalse(hr._dirty, "Record dirty after _hydrate()")
+
     def test_015_internals(self):
         """HistoriaRecord: __eq__ and __ne__"""
 
@@ -434,6 +580,29 @@ class TestRecord(unittest.TestCase):
         # Since machine_type is a class level thing we can't test the conditionals until we have a subclass.
 
 
+    def test_020_dirty_fields(self):
+        """HistoriaRecord: changed fields are tracked and only they are updated"""
+        hr = core_data_objects.HistoriaRecord(self.db)
+        self.assertEqual(hr._dirty_fields, set(), "New record has changed fields")
+
+        hr._anything = "ok"
+        self.assertFalse(hr._dirty, "Setting a non-field attribute marked the record dirty")
+
+        hr.value = None
+        self.assertFalse(hr._dirty, "Setting a field to its current value marked the record dirty")
+
+        hr.value = "Spam"
+        self.assertTrue(hr._dirty, "Dirty bit not set after change")
+        self.assertEqual(hr._dirty_fields, {'value'}, "Wrong changed fields")
+
+        hr._id = 5
+        statement, values = hr._generate_update_SQL()
+        self.assertEqual(statement, "UPDATE `historia_generic` SET `value` = %(value)s WHERE `id` = %(id)s", "Incorrect update statement")
+        self.assertEqual(values, {'value': "Spam", 'id': 5}, "Incorrect update values")
+
+        hr._dirty = False
+        self.assertEqual(hr._dirty_fields, set(), "Changed fields not cleared")
+
     def test_030_save(self):
         """HistoriaRecord: save()"""
 
@@ -490,6 +659,29 @@ class TestRecord(unittest.TestCase):
 
 
 
+    def test_042_load_many(self):
+        """HistoriaRecord: load_many()"""
+
+        self.database_setup(withTables=True)
+        records = [core_data_objects.HistoriaRecord(self.db) for i in range(5)]
+        for i, hr in enumerate(records):
+            hr.value = "R{0}".format(i)
+        core_data_objects.HistoriaRecord.save_many(records)
+
+        ids = [records[3].id, records[0].id, records[4].id + 100, records[1].id]
+        loaded = core_data_objects.HistoriaRecord.load_many(self.db, ids, chunk_size=2)
+
+        self.assertEqual([hr.id for hr in loaded], [records[3].id, records[0].id, records[1].id], "Wrong records or order from load_many()")
+        self.assertEqual(loaded[0].value, "R3", "Value not loaded")
+        for hr in loaded:
+            self.assertFalse(hr._dirty, "Loaded record is dirty")
+
+        with self.db.unit_of_work():
+            first = core_data_objects.HistoriaRecord.get(self.db, records[0].id)
+            loaded = core_data_objects.HistoriaRecord.load_many(self.db, [records[0].id, records[2].id])
+            self.assertIs(loaded[0], first, "load_many() didn't use the identity map")
+            self.assertIs(loaded[1], core_data_objects.HistoriaRecord.get(self.db, records[2].id), "load_many() didn't add to the identity map")
+
     def test_045_load_and_save(self):
         """HistoriaRecord: use load() and save() a couple of times in a row to make sure we don't create extra records."""
 
@@ -507,6 +699,45 @@ class TestRecord(unittest.TestCase):
         self.assertEqual(result[0]['id'], hr2.id, "ID in the table should match the ID on the record.")
 
 
+    def test_047_save_in_transaction(self):
+        """HistoriaRecord: save() and delete() join an open transaction"""
+
+        self.database_setup(withTables=True)
+        hr = core_data_objects.HistoriaRecord(self.db)
+        hr2 = core_data_objects.HistoriaRecord(self.db)
+
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                hr.save()
+                hr2.save()
+                raise ValueError("Roll it back")
+
+        select = ("SELECT * FROM `historia_generic`",{})
+        result = self.db.execute_select(select)
+        self.assertEqual(len(result), 0, "Saves were committed even though the transaction failed.")
+
+    def test_049_save_unchanged(self):
+        """HistoriaRecord: save() skips records that haven't changed"""
+
+        self.database_setup(withTables=True)
+        hr = core_data_objects.HistoriaRecord(self.db)
+        hr.value = "Spam"
+        hr.save()
+
+        # Change the row behind the record's back
+        update = ("UPDATE `historia_generic` SET `value` = 'Eggs' WHERE `id` = %(id)s",{'id': hr.id})
+        self.db.execute_update(update)
+
+        hr.save()
+        select = ("SELECT * FROM `historia_generic`",{})
+        result = self.db.execute_select(select)
+        self.assertEqual(result[0]['value'], "Eggs", "Unchanged record was written.")
+
+        hr.value = "Ham"
+        hr.save()
+        result = self.db.execute_select(select)
+        self.assertEqual(result[0]['value'], "Ham", "Changed record not written.")
+
     def test_050_delete(self):
         """HistoriaRecord: delete()"""
 
@@ -523,6 +754,233 @@ class TestRecord(unittest.TestCase):
         self.assertEqual(len(result), 0, "There should nothing in the table now.")
         self.assertEqual(-1, hr.id, "The ID should reset to -1")
 
+    def test_054_save_rollback(self):
+        """HistoriaRecord: saves undone by a rollback leave the record unsaved"""
+
+        self.db.connection = unittest.mock.MagicMock()
+        self.db.connection.is_connected.return_value = True
+        self.db._consecutive_ids = True
+
+        with unittest.mock.patch.object(self.db, 'execute_insert', side_effect=[7, 8, 9]), \
+                unittest.mock.patch.object(self.db, 'execute_update', return_value=1), \
+                unittest.mock.patch.object(self.db, 'execute_many', return_value=1):
+            hr = core_data_objects.HistoriaRecord(self.db)
+            hr.value = "New"
+            with self.assertRaises(RuntimeError):
+                with self.db.transaction():
+                    hr.save()
+                    self.assertEqual(hr.id, 7, "Id not set by save()")
+                    raise RuntimeError("Failed")
+            self.assertEqual(hr.id, -1, "Id kept after the insert was rolled back")
+            self.assertTrue(hr._dirty, "Record clean after the insert was rolled back")
+
+            with self.db.transaction():
+                hr.save()
+                try:
+                    with self.db.transaction():
+                        hr.value = "Changed"
+                        hr.save()
+                        raise RuntimeError("Failed")
+                except RuntimeError:
+                    pass
+                self.assertEqual(hr.id, 8, "Id lost when only a savepoint was rolled back")
+                self.assertEqual(hr._dirty_fields, frozenset(['value']), "Rolled back update not dirty again")
+            self.assertEqual(hr.id, 8, "Id lost after the transaction committed")
+
+            records = [core_data_objects.HistoriaRecord(self.db), hr]
+            with self.assertRaises(RuntimeError):
+                with self.db.transaction():
+                    core_data_objects.HistoriaRecord.save_many(records)
+                    self.assertEqual(records[0].id, 9, "Id not set by save_many()")
+                    raise RuntimeError("Failed")
+            self.assertEqual(records[0].id, -1, "Id kept after save_many() was rolled back")
+            self.assertEqual(hr.id, 8, "Id of an updated record lost")
+            self.assertTrue(hr._dirty, "Rolled back update not dirty again")
+
+    def test_055_save_many(self):
+        """HistoriaRecord: save_many() inserts and updates in chunks"""
+
+        self.database_setup(withTables=True)
+        records = []
+        for i in range(7):
+            hr = core_data_objects.HistoriaRecord(self.db)
+            hr.value = "Record {0}".format(i)
+            records.append(hr)
+
+        core_data_objects.HistoriaRecord.save_many(records, chunk_size=3)
+
+        ids = [hr.id for hr in records]
+        self.assertNotIn(-1, ids, "Records were not given ids")
+        self.assertEqual(len(set(ids)), len(ids), "Records share ids")
+        for hr in records:
+            self.assertFalse(hr._dirty, "Record still dirty after save_many()")
+
+        select = ("SELECT * FROM `historia_generic` ORDER BY `id`",{})
+        result = self.db.execute_select(select)
+        self.assertEqual(len(result), len(records), "Incorrect number of rows saved")
+        for row, hr in zip(result, records):
+            self.assertEqual(row['id'], hr.id, "Saved ids don't match the database")
+            self.assertEqual(row['value'], hr.value, "Saved value doesn't match")
+
+        # Now mix updates with a new record
+        records[0].value = "Changed"
+        records[5].value = "Also changed"
+        extra = core_data_objects.HistoriaRecord(self.db)
+        extra.value = "Extra"
+        core_data_objects.HistoriaRecord.save_many([records[0], extra, records[5]])
+
+        result = self.db.execute_select(select)
+        self.assertEqual(len(result), len(records) + 1, "Incorrect number of rows after update")
+        self.assertEqual(result[0]['value'], "Changed", "Update not saved")
+        self.assertEqual(result[5]['value'], "Also changed", "Update not saved")
+        self.assertEqual(result[-1]['id'], extra.id, "New record id incorrect")
+
+    def test_056_save_many_ids(self):
+        """HistoriaRecord: save_many() only works out ids from a multi-row
+        INSERT when they are sure to be consecutive"""
+
+        self.db.connection = unittest.mock.MagicMock()
+        self.db.connection.is_connected.return_value = True
+
+        for increment, lock_mode, consecutive in [(1, 1, True), (2, 1, False), (1, 2, False)]:
+            self.db._consecutive_ids = None
+            settings = [{'increment': increment, 'lock_mode': lock_mode}]
+            with unittest.mock.patch.object(self.db, 'execute_select', return_value=settings), \
+                    unittest.mock.patch.object(self.db, 'execute_insert', side_effect=[10, 20, 30]) as insert:
+                records = [core_data_objects.HistoriaRecord(self.db) for i in range(3)]
+                core_data_objects.HistoriaRecord.save_many(records)
+
+            self.assertEqual(self.db.consecutive_insert_ids, consecutive, "Wrong consecutive_insert_ids")
+            if consecutive:
+                self.assertEqual(insert.call_count, 1, "Rows not inserted by one statement")
+                self.assertEqual([hr.id for hr in records], [10, 11, 12], "Wrong ids from a multi-row INSERT")
+            else:
+                self.assertEqual(insert.call_count, 3, "Rows not inserted one at a time")
+                self.assertEqual([hr.id for hr in records], [10, 20, 30], "Ids not taken from each INSERT")
+
+    def test_0565_save_many_failure(self):
+        """HistoriaRecord: save_many() writes each database's records in one
+        transaction and leaves them unsaved if it fails"""
+
+        class OtherRecord(core_data_objects.HistoriaRecord):
+            machine_type = "historia_other"
+
+        other_db = core_data_objects.HistoriaDatabase("historia_other_test")
+        for db in (self.db, other_db):
+            db.connection = unittest.mock.MagicMock()
+            db.connection.is_connected.return_value = True
+            db._consecutive_ids = True
+
+        records = [core_data_objects.HistoriaRecord(self.db), OtherRecord(self.db)]
+        for hr in records:
+            hr.value = "New"
+        with unittest.mock.patch.object(self.db, 'execute_insert', side_effect=[10, exceptions.DataSaveError("Failed")]):
+            self.assertRaises(exceptions.DataSaveError, core_data_objects.HistoriaRecord.save_many, records)
+        self.assertFalse(self.db.connection.commit.called, "First class committed without the second")
+        self.assertEqual(self.db.connection.rollback.call_count, 1, "Transaction not rolled back")
+        for hr in records:
+            self.assertEqual((hr.id, hr._dirty), (-1, True), "Rolled back record looks saved")
+
+        with unittest.mock.patch.object(self.db, 'execute_insert', side_effect=[20, 30]):
+            core_data_objects.HistoriaRecord.save_many(records)
+        self.assertEqual([hr.id for hr in records], [20, 30], "Records not saved on retry")
+        self.assertEqual(self.db.connection.commit.call_count, 1, "Classes not committed together")
+
+        # Databases are committed separately, so those written before a failure stay saved
+        records = [core_data_objects.HistoriaRecord(self.db), core_data_objects.HistoriaRecord(other_db)]
+        for hr in records:
+            hr.value = "New"
+        with unittest.mock.patch.object(self.db, 'execute_insert', return_value=40), \
+                unittest.mock.patch.object(other_db, 'execute_insert', side_effect=exceptions.DataSaveError("Failed")):
+            self.assertRaises(exceptions.DataSaveError, core_data_objects.HistoriaRecord.save_many, records)
+        self.assertEqual((records[0].id, records[0]._dirty), (40, False), "Committed record not marked saved")
+        self.assertEqual((records[1].id, records[1]._dirty), (-1, True), "Failed record looks saved")
+
+    def test_057_delete_many(self):
+        """HistoriaRecord: delete_many()"""
+
+        self.database_setup(withTables=True)
+        records = [core_data_objects.HistoriaRecord(self.db) for i in range(5)]
+        core_data_objects.HistoriaRecord.save_many(records)
+        unsaved = core_data_objects.HistoriaRecord(self.db)
+
+        core_data_objects.HistoriaRecord.delete_many(records[:4] + [unsaved], chunk_size=2)
+
+        select = ("SELECT * FROM `historia_generic`",{})
+        result = self.db.execute_select(select)
+        self.assertEqual(len(result), 1, "Incorrect number of rows left after delete_many()")
+        self.assertEqual(result[0]['id'], records[4].id, "The wrong row was left")
+        for hr in records[:4]:
+            self.assertEqual(-1, hr.id, "The ID should reset to -1")
+
+    def test_058_unit_of_work(self):
+        """HistoriaRecord: get() and the database's unit_of_work()"""
+
+        self.database_setup(withTables=True)
+        hr = core_data_objects.HistoriaRecord(self.db)
+        hr.value = "Original"
+        hr.save()
+
+        # Outside a unit of work every get() loads a new object
+        first = core_data_objects.HistoriaRecord.get(self.db, hr.id)
+        self.assertIsNot(first, core_data_objects.HistoriaRecord.get(self.db, hr.id), "Record reused outside a unit of work")
+        self.assertIsNone(self.db.identity_map, "Identity map present outside a unit of work")
+
+        with self.db.unit_of_work() as identity_map:
+            first = core_data_objects.HistoriaRecord.get(self.db, hr.id)
+            self.assertIs(first, core_data_objects.HistoriaRecord.get(self.db, hr.id), "Record loaded twice in a unit of work")
+            self.assertIs(first, identity_map[(hr.machine_type, hr.id)], "Record missing from the identity map")
+            with self.db.unit_of_work() as inner:
+                self.assertIs(inner, identity_map, "Nested unit of work has its own map")
+            first.value = "Changed"
+
+        self.assertIsNone(self.db.identity_map, "Identity map left after the unit of work")
+        self.assertFalse(first._dirty, "Record still dirty after the unit of work")
+        select = ("SELECT * FROM `historia_generic`",{})
+        self.assertEqual(self.db.execute_select(select)[0]['value'], "Changed", "Change not saved by the unit of work")
+
+        # Nothing is saved if the block fails
+        with self.assertRaises(KeyError):
+            with self.db.unit_of_work():
+                core_data_objects.HistoriaRecord.get(self.db, hr.id).value = "Failed"
+                raise KeyError()
+        self.assertEqual(self.db.execute_select(select)[0]['value'], "Changed", "Change saved from failed unit of work")
+
+        # Deleted records leave the map
+        with self.db.unit_of_work() as identity_map:
+            core_data_objects.HistoriaRecord.get(self.db, hr.id).delete()
+            self.assertEqual(len(identity_map), 0, "Deleted record still in the identity map")
+
+    def test_059_flush(self):
+        """HistoriaRecord: the database's flush() and get() with string ids"""
+
+        self.db.connection = unittest.mock.MagicMock()
+        self.db.connection.is_connected.return_value = True
+        row = [{'id': 5, 'value': "Original"}]
+
+        with unittest.mock.patch.object(self.db, 'execute_select', return_value=row) as select, \
+                unittest.mock.patch.object(self.db, 'execute_many', return_value=1) as update:
+            with self.db.unit_of_work():
+                record = core_data_objects.HistoriaRecord.get(self.db, "5")
+                self.assertIs(core_data_objects.HistoriaRecord.get(self.db, 5), record, "String id loaded a second copy")
+                self.assertEqual(select.call_count, 1, "Record read twice")
+
+                record.value = "Changed"
+                self.db.flush()
+                self.assertEqual(update.call_count, 1, "Changed record not saved by flush()")
+                self.assertFalse(record._dirty, "Record still dirty after flush()")
+            self.assertEqual(update.call_count, 1, "Record saved again at the end of the unit of work")
+
+            self.assertRaises(exceptions.DataLoadError, core_data_objects.HistoriaRecord.get, self.db, "five")
+
+        # A failed flush is reported once, not again when the unit of work ends
+        with unittest.mock.patch.object(self.db, 'execute_select', return_value=row), \
+                unittest.mock.patch.object(self.db, 'execute_many', side_effect=exceptions.DataSaveError("Failed")):
+            with self.db.unit_of_work() as identity_map:
+                core_data_objects.HistoriaRecord.get(self.db, 5).value = "Changed"
+                self.assertRaises(exceptions.DataSaveError, self.db.flush)
+                self.assertEqual(len(identity_map), 0, "Record that failed to save still in the identity map")
+
     def test_060_to_dict(self):
         """HistoriaRecord: to_dict()"""
 
@@ -727,6 +1185,38 @@ class TestSearchObject(unittest.TestCase):
         self.assertEqual('SELECT', sql[0][:6], "SQL doesn't start with SELECT")
 
 
+    def test_85_page_after(self):
+        """HistoriaRecord: page_after() and its SQL"""
+        searcher = core_data_objects.HistoriaDatabaseSearch(self.db, core_data_objects.HistoriaRecord.machine_type)
+
+        self.assertEqual(searcher._generate_sql()[0].strip(), "SELECT * FROM `historia_generic`", "Search without fields or conditions is wrong")
+        with self.assertRaises(exceptions.SearchError):
+            searcher.page_after()
+
+        searcher.add_sort('value')
+        searcher.add_sort('id')
+        sql, values = searcher._generate_sql(["a", 3], 11)
+        self.assertIn("(`value`, `id`) > (%(after_value)s, %(after_id)s)", sql, "Seek condition is wrong")
+        self.assertIn("ORDER BY `value` ASC, `id` ASC LIMIT 11", sql, "Sort or limit is wrong")
+        self.assertEqual(values, {'after_value': "a", 'after_id': 3}, "Seek values are wrong")
+
+        token = searcher.encode_token(["a", 3])
+        self.assertEqual(searcher.decode_token(token), ["a", 3], "Token didn't round trip")
+        with self.assertRaises(ValueError):
+            searcher.decode_token("not a token")
+
+        self.database_setup(withTables=True)
+        records = [core_data_objects.HistoriaRecord(self.db) for i in range(5)]
+        core_data_objects.HistoriaRecord.save_many(records)
+
+        searcher = core_data_objects.HistoriaDatabaseSearch(self.db, core_data_objects.HistoriaRecord.machine_type)
+        searcher.add_sort('id', 'DESC')
+        results, token = searcher.page_after(None, 3)
+        self.assertEqual([r['id'] for r in results], [hr.id for hr in records[:1:-1]], "Wrong first page")
+        results, token = searcher.page_after(token, 3, hydrate=core_data_objects.HistoriaRecord)
+        self.assertEqual([hr.id for hr in results], [hr.id for hr in records[1::-1]], "Wrong last page")
+        self.assertIsNone(token, "Token given for the last page")
+
     def test_90_execute_search(self):
         """HistoriaRecord: execute_search(self)"""
         #def execute_search(self):
@@ -782,3 +1272,39 @@ class TestSearchObject(unittest.TestCase):
         self.assertIsNotNone(results, "None returned from valid search")
         self.assertEqual(len(results), 1,"Wrong number of results")
         self.assertIsNotNone(results[0]['expression_2'], "Expression didn't return")
+
+    def test_95_execute_search_hydrate(self):
+        """HistoriaRecord: execute_search(hydrate=...) returns records"""
+        searcher = core_data_objects.HistoriaDatabaseSearch(self.db, core_data_objects.HistoriaRecord.machine_type)
+        self.database_setup(withTables=True)
+
+        hr = core_data_objects.HistoriaRecord(self.db)
+        hr.value = "Find"
+        hr.save()
+
+        searcher.add_condition('value', "Find")
+        results = searcher.execute_search(hydrate=core_data_objects.HistoriaRecord)
+
+        self.assertEqual(len(results), 1, "Wrong number of results")
+        self.assertIsInstance(results[0], core_data_objects.HistoriaRecord, "Result isn't a record")
+        self.assertEqual(results[0], hr, "Wrong record found")
+        self.assertEqual(results[0].value, "Find", "Record value not filled in")
+        self.assertFalse(results[0]._dirty, "Found record is dirty")
+
+    def test_97_execute_search_stream(self):
+        """HistoriaRecord: execute_search(stream=True) returns a generator"""
+        searcher = core_data_objects.HistoriaDatabaseSearch(self.db, core_data_objects.HistoriaRecord.machine_type)
+        self.database_setup(withTables=True)
+
+        records = [core_data_objects.HistoriaRecord(self.db) for i in range(5)]
+        core_data_objects.HistoriaRecord.save_many(records)
+
+        searcher.add_condition('id', 0, '>')
+        searcher.add_sort('id')
+        results = searcher.execute_search(hydrate=core_data_objects.HistoriaRecord, stream=True, batch_size=2)
+        self.assertNotIsInstance(results, list, "Streamed search should return a generator")
+        self.assertEqual([hr.id for hr in results], [hr.id for hr in records], "Wrong records streamed")
+
+        searcher = core_data_objects.HistoriaDatabaseSearch(self.db, core_data_objects.HistoriaRecord.machine_type)
+        searcher.add_condition('id', 0, '<')
+        self.assertEqual(list(searcher.execute_search(stream=True)), [], "Empty streamed search should be empty")
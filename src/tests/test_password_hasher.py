@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_password_hasher.py
+
+Created by Aaron Crosman on 2015-03-16.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import bcrypt
+
+from database import password_hasher
+from database import exceptions
+
+
+class TestPasswordHasher(unittest.TestCase):
+
+    def test_00_inline(self):
+        """HistoriaPasswordHasher: hash and check on the calling thread"""
+        hasher = password_hasher.HistoriaPasswordHasher(workers=0, rounds=4)
+
+        hashed = hasher.hash(b"Spam")
+        self.assertEqual(hashed, bcrypt.hashpw(b"Spam", hashed), "Password not hashed with bcrypt")
+        self.assertIn(b"$04$", hashed, "Work factor not used")
+        self.assertTrue(hasher.check(b"Spam", hashed), "Matching password rejected")
+        self.assertFalse(hasher.check(b"Eggs", hashed), "Wrong password accepted")
+
+        stats = hasher.stats()
+        self.assertEqual(stats['hashed'], 1, "Incorrect hashed count")
+        self.assertEqual(stats['checked'], 2, "Incorrect checked count")
+
+    def test_10_processes(self):
+        """HistoriaPasswordHasher: hash and check in worker processes"""
+        hasher = password_hasher.HistoriaPasswordHasher(workers=2, rounds=4)
+        try:
+            hashed = hasher.hash(b"Spam")
+            self.assertTrue(hasher.check(b"Spam", hashed), "Matching password rejected")
+            self.assertFalse(hasher.check(b"Eggs", hashed), "Wrong password accepted")
+            self.assertNotEqual(hasher._get_executor()._mp_context.get_start_method(), 'fork',
+                                "Workers forked from a threaded process")
+        finally:
+            hasher.close()
+
+    def test_20_busy(self):
+        """HistoriaPasswordHasher: PasswordHasherBusy when max_pending are waiting"""
+        hasher = password_hasher.HistoriaPasswordHasher(workers=0, rounds=4, max_pending=1)
+
+        hasher._slots.acquire()  # Stand in for a hash that's still running
+        with self.assertRaises(exceptions.PasswordHasherBusy):
+            hasher.hash(b"Spam")
+        self.assertEqual(hasher.stats()['rejected'], 1, "Rejection not counted")
+
+        hasher._slots.release()
+        self.assertTrue(hasher.check(b"Spam", hasher.hash(b"Spam")), "Hasher unusable once free")
+
+    def test_30_script(self):
+        """HistoriaPasswordHasher: worker processes can be used from a script
+        run as __main__, like historia.py"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        script = os.path.join(directory, 'hash_script.py')
+        with open(script, 'w') as f:
+            f.write(SCRIPT.format(source=os.path.dirname(os.path.dirname(os.path.abspath(password_hasher.__file__)))))
+
+        result = subprocess.run([sys.executable, script], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=60, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, "Script failed: {0}".format(result.stderr))
+        self.assertEqual(result.stdout.split(), ["True", "False"], "Wrong results from the worker processes")
+
+
+SCRIPT = """
+import sys
+sys.path.insert(0, {source!r})
+
+from database import password_hasher
+
+if __name__ == '__main__':
+    hasher = password_hasher.HistoriaPasswordHasher(workers=1, rounds=4)
+    try:
+        hashed = hasher.hash(b"Spam")
+        print(hasher.check(b"Spam", hashed), hasher.check(b"Eggs", hashed))
+    finally:
+        hasher.close()
+"""
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_query_diagnostics.py
+
+Created by Aaron Crosman on 2015-03-18.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+from database import query_diagnostics
+
+
+class ExplainingDatabase(object):
+    """Just the part of a database the diagnostics use: answers every
+    EXPLAIN with the same plan."""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.statements = []
+
+    def execute_select(self, prepared_statement):
+        self.statements.append(prepared_statement[0])
+        return self.plan
+
+
+class TestQueryDiagnostics(unittest.TestCase):
+
+    full_scan = [{'id': 1, 'select_type': 'SIMPLE', 'table': 'historia_user', 'type': 'ALL',
+                  'possible_keys': None, 'key': None, 'rows': 5000, 'Extra': 'Using where'}]
+    indexed = [{'id': 1, 'select_type': 'SIMPLE', 'table': 'historia_user', 'type': 'ref',
+                'possible_keys': 'name', 'key': 'name', 'rows': 1, 'Extra': None}]
+
+    def test_00_shape(self):
+        """HistoriaQueryDiagnostics: shape()"""
+        shape = query_diagnostics.HistoriaQueryDiagnostics.shape("SELECT * FROM `t`  WHERE `a` = %(a)s LIMIT 51")
+        self.assertEqual(shape, "SELECT * FROM `t`  WHERE `a` = %(a)s LIMIT ?", "Limit not taken out of the shape")
+
+    def test_10_explain_once(self):
+        """HistoriaQueryDiagnostics: each shape is explained once"""
+        diagnostics = query_diagnostics.HistoriaQueryDiagnostics()
+        db = ExplainingDatabase(self.indexed)
+
+        for limit in (1, 2, 3):
+            statement = ("SELECT * FROM `historia_user` WHERE `name` = %(name)s LIMIT {0}".format(limit), {'name': "x"})
+            diagnostics.observe(db, statement, ['name'], 0.001)
+
+        self.assertEqual(len(db.statements), 1, "Shape explained more than once")
+        self.assertTrue(db.statements[0].startswith("EXPLAIN SELECT"), "EXPLAIN not run")
+        self.assertEqual(diagnostics.plan(statement[0]), self.indexed, "Plan not kept")
+        self.assertEqual(diagnostics.report(), [], "Fast indexed search reported")
+
+    def test_20_full_scan(self):
+        """HistoriaQueryDiagnostics: full scans are warned about and reported"""
+        diagnostics = query_diagnostics.HistoriaQueryDiagnostics()
+        db = ExplainingDatabase(self.full_scan)
+        statement = ("SELECT * FROM `historia_user` WHERE `name` = %(name)s OR `email` = %(email)s", {'name': "x", 'email': "x"})
+
+        with self.assertLogs('historia.db', 'WARNING') as logs:
+            diagnostics.observe(db, statement, ['name', 'email'], 0.001)
+        self.assertIn("historia_user", logs.output[0], "Table missing from warning")
+        self.assertIn("name, email", logs.output[0], "Columns missing from warning")
+
+        report = diagnostics.report()
+        self.assertEqual(len(report), 1, "Full scan not reported")
+        self.assertEqual(report[0]['full_scans'], ['historia_user'], "Scanned table not reported")
+        self.assertEqual(report[0]['count'], 1, "Wrong run count")
+
+    def test_30_slow(self):
+        """HistoriaQueryDiagnostics: slow searches are reported, slowest first"""
+        diagnostics = query_diagnostics.HistoriaQueryDiagnostics(slow_query_time=0.5)
+        db = ExplainingDatabase(self.indexed)
+
+        diagnostics.observe(db, ("SELECT `a` FROM `t`", {}), [], 0.6)
+        diagnostics.observe(db, ("SELECT `b` FROM `t`", {}), [], 0.1)
+        diagnostics.observe(db, ("SELECT `c` FROM `t`", {}), [], 2.0)
+        diagnostics.observe(db, ("SELECT `a` FROM `t`", {}), [], 0.8)
+
+        report = diagnostics.report()
+        self.assertEqual([r['shape'] for r in report], ["SELECT `c` FROM `t`", "SELECT `a` FROM `t`"], "Wrong searches reported")
+        self.assertAlmostEqual(report[1]['mean_time'], 0.7, msg="Wrong mean time")
+        self.assertAlmostEqual(report[1]['max_time'], 0.8, msg="Wrong max time")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_router.py
+
+Created by Aaron Crosman on 2015-03-20.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+from internals import router
+
+
+class TestRouter(unittest.TestCase):
+
+    routers = {
+        'system': {
+            'user': {
+                'login': {'type': 'POST', 'function': 'login'},
+                'list':  {'type': 'GET', 'function': 'list'}
+            }
+        },
+        'database': {
+            '@dbid': {
+                'fetch': {
+                    '@oid': {'type': 'GET'}
+                }
+            }
+        }
+    }
+
+    def test_00_match(self):
+        """HistoriaRouter: match() finds the entry for a path"""
+        r = router.HistoriaRouter(self.routers)
+
+        route = r.match('system/user/login')
+        self.assertEqual(route.target, 'system', "Wrong target")
+        self.assertEqual(route.request, 'user/login', "Wrong request")
+        self.assertIs(route.entry, self.routers['system']['user']['login'], "Wrong entry")
+        self.assertEqual(route.parameters, {}, "Parameters found in a system path")
+
+        route = r.match('database/12/fetch/345')
+        self.assertEqual(route.target, 'database', "Wrong target")
+        self.assertEqual(route.parameters, {'dbid': 12, 'oid': 345}, "IDs not extracted")
+
+    def test_10_no_match(self):
+        """HistoriaRouter: match() rejects paths that don't lead to an entry"""
+        r = router.HistoriaRouter(self.routers)
+
+        for path in ['', 'system', 'system/user', 'system/user/login/extra',
+                     'system/user/loginx', 'system/user/login/../list',
+                     'database/x/fetch/1', 'database/1/fetch/-1', 'database/1/fetch/٣',
+                     'database/1/fetch']:
+            self.assertIsNone(r.match(path), "Matched: {0}".format(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
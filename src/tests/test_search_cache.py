@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_search_cache.py
+
+Created by Aaron Crosman on 2015-03-19.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import time
+import tempfile
+import unittest
+import unittest.mock
+
+from database import search_cache
+from database import core_data_objects
+from database import user_db
+
+
+class TestSearchCache(unittest.TestCase):
+
+    statement = ("SELECT * FROM `historia_user`  WHERE  `name` = %(name)s ", {'name': "Arthur"})
+    rows = [{'id': 1, 'name': "Arthur"}]
+
+    def cache_search(self, cache, tables=('historia_user',)):
+        key = cache.key(self.statement)
+        cache.put(key, cache.versions(tables), self.rows)
+        return key
+
+    def test_00_get_put(self):
+        """HistoriaSearchCache: get() and put()"""
+        cache = search_cache.HistoriaSearchCache(10, 60)
+        key = cache.key(self.statement)
+
+        self.assertIsNone(cache.get(key, ['historia_user']), "Found results that were never added")
+        self.cache_search(cache)
+        results = cache.get(key, ['historia_user'])
+        self.assertEqual(results, self.rows, "Cached results not returned")
+
+        results[0]['name'] = "Changed"
+        self.assertEqual(cache.get(key, ['historia_user']), self.rows, "Changing returned rows changed the cache")
+
+        self.assertIsNone(cache.key(("SELECT 1", {'ids': [1, 2]})), "Unhashable values given a key")
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2, "Incorrect hit count")
+        self.assertEqual(stats['misses'], 1, "Incorrect miss count")
+        self.assertEqual(stats['size'], 1, "Incorrect cache size")
+
+    def test_10_written(self):
+        """HistoriaSearchCache: writes to a table invalidate its results"""
+        cache = search_cache.HistoriaSearchCache(10, 60)
+        key = self.cache_search(cache)
+
+        cache.written("UPDATE `historia_session` SET `last_seen` = %s")
+        self.assertIsNotNone(cache.get(key, ['historia_user']), "Write to another table invalidated results")
+
+        cache.written("UPDATE `historia_user` SET `name` = %(name)s WHERE `id` = %(id)s")
+        self.assertIsNone(cache.get(key, ['historia_user']), "Write to the table didn't invalidate results")
+
+        key = self.cache_search(cache)
+        cache.written("INSERT INTO historia_user (`name`) VALUES (%s)")
+        self.assertIsNone(cache.get(key, ['historia_user']), "Insert didn't invalidate results")
+
+        key = self.cache_search(cache)
+        cache.written("SET @anything = 1")
+        self.assertIsNone(cache.get(key, ['historia_user']), "Unknown write didn't invalidate results")
+
+    def test_20_stale_put(self):
+        """HistoriaSearchCache: results read before a write aren't used after it"""
+        cache = search_cache.HistoriaSearchCache(10, 60)
+        key = cache.key(self.statement)
+
+        versions = cache.versions(['historia_user'])
+        cache.written("DELETE FROM `historia_user` WHERE `id` = %(id)s")
+        cache.put(key, versions, self.rows)
+        self.assertIsNone(cache.get(key, ['historia_user']), "Results older than a write were used")
+
+    def test_30_lru_and_ttl(self):
+        """HistoriaSearchCache: least recently used results are evicted, and
+        results expire"""
+        cache = search_cache.HistoriaSearchCache(2, 60)
+        keys = []
+        for name in ("a", "b", "c"):
+            key = cache.key(("SELECT * FROM `t` WHERE `name` = %(name)s", {'name': name}))
+            cache.put(key, cache.versions(['t']), self.rows)
+            keys.append(key)
+
+        self.assertIsNone(cache.get(keys[0], ['t']), "Oldest results not evicted")
+        self.assertIsNotNone(cache.get(keys[2], ['t']), "Newest results evicted")
+        self.assertEqual(cache.stats()['evictions'], 1, "Incorrect eviction count")
+
+        cache = search_cache.HistoriaSearchCache(2, 0.01)
+        key = self.cache_search(cache)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(key, ['historia_user']), "Expired results returned")
+
+
+class TestSearchCacheInvalidation(unittest.TestCase):
+    """Writes made through HistoriaDatabase reaching its search_cache, with
+    the MySQL connection mocked out."""
+
+    def setUp(self):
+        self.db = core_data_objects.HistoriaDatabase("cache_test")
+        self.db.connection = unittest.mock.MagicMock()
+        self.db.connection.is_connected.return_value = True
+        self.db.search_cache = search_cache.HistoriaSearchCache(10, 60)
+
+    def user_version(self):
+        return self.db.search_cache.versions(['historia_user'])
+
+    def test_00_execute(self):
+        """HistoriaDatabase: execute_insert() and execute_update() raise
+        table versions"""
+        before = self.user_version()
+        self.db.execute_insert(("INSERT INTO `historia_user` (`name`) VALUES (%(name)s)", {'name': "Arthur"}))
+        after_insert = self.user_version()
+        self.assertNotEqual(after_insert, before, "Insert didn't raise the table version")
+
+        self.db.execute_update(("UPDATE `historia_user` SET `name` = %(name)s", {'name': "Ford"}))
+        self.assertNotEqual(self.user_version(), after_insert, "Update didn't raise the table version")
+
+        before = self.user_version()
+        self.db.execute_update(("UPDATE `historia_session` SET `userid` = %(userid)s", {'userid': 1}))
+        self.assertEqual(self.user_version(), before, "Update of another table raised the version")
+
+    def test_10_transaction(self):
+        """HistoriaDatabase: writes in a transaction() raise table versions
+        when it ends"""
+        before = self.user_version()
+        with self.db.transaction():
+            self.db.execute_update(("UPDATE `historia_user` SET `name` = %(name)s", {'name': "Ford"}))
+            self.assertEqual(self.user_version(), before, "Version raised before the transaction ended")
+        committed = self.user_version()
+        self.assertNotEqual(committed, before, "Committed transaction didn't raise the version")
+        self.db.connection.commit.assert_called_with()
+
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.execute_insert(("INSERT INTO `historia_user` (`name`) VALUES (%(name)s)", {'name': "Zaphod"}))
+                raise RuntimeError("Abandon the transaction")
+        self.assertNotEqual(self.user_version(), committed, "Rolled back transaction didn't raise the version")
+        self.db.connection.rollback.assert_called_with()
+
+    def test_20_user_database(self):
+        """HistoriaUserDatabase: search_cache can be set"""
+        with tempfile.NamedTemporaryFile('wb', delete=False) as key_file:
+            key_file.write(os.urandom(32))
+        try:
+            udb = user_db.HistoriaUserDatabase(self.db, "historia_cache_test", key_file.name)
+        finally:
+            os.unlink(key_file.name)
+
+        self.assertIsNone(udb.search_cache, "New database has a search cache")
+        udb.search_cache = self.db.search_cache
+        self.assertIs(udb.search_cache, self.db.search_cache, "Search cache not set")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,7 +23,9 @@ Created by Aaron Crosman on 2015-02-10.
 """
 
 import unittest
+import unittest.mock
 import logging, sys, datetime
+import threading
 
 import bcrypt
 import mysql.connector
@@ -342,6 +344,142 @@ class TestSession(unittest.TestCase):
 
         self.assertEqual(len(result), 0, "There should nothing in the table now.")
         self.assertEqual(-1, sess1.id, "The ID should reset to -1")
-    
+
+    def test_55_delete_one(self):
+        """HistoriaSession: delete() only removes its own session"""
+        self.database_setup(withTables=True)
+        sessions = []
+        for i in range(2):
+            sess = session.HistoriaSession(self.db)
+            sess.new_id()
+            sess.ip = "127.0.0.1"
+            sess.userid = 123
+            sess.save()
+            sessions.append(sess)
+
+        sessions[0].delete()
+
+        select = ("SELECT * FROM `{0}`".format(session.HistoriaSession.machine_type),{})
+        result = self.db.execute_select(select)
+
+        self.assertEqual(len(result), 1, "Only one session should have been deleted.")
+        self.assertEqual(result[0]['sessionid'], sessions[1].sessionid, "The wrong session was deleted.")
+
+    def test_60_flusher(self):
+        """HistoriaSessionFlusher: touches are written together by flush()"""
+        self.database_setup(withTables=True)
+        sessions = []
+        for i in range(3):
+            sess = session.HistoriaSession(self.db)
+            sess.new_id()
+            sess.ip = "127.0.0.1"
+            sess.userid = 123
+            sess.save()
+            sessions.append(sess)
+
+        flusher = session.HistoriaSessionFlusher(self.db, interval=3600, batch_size=2)
+        for sess in sessions + sessions[:1]:
+            flusher.touch(sess)
+
+        self.assertEqual(flusher.stats()['pending'], 3, "A session touched twice should be written once")
+        self.assertEqual(flusher.flush(), 3, "Incorrect number of sessions written")
+        self.assertEqual(flusher.stats()['batches'], 2, "Sessions should be written in batches of 2")
+
+        for sess in sessions:
+            stored = session.HistoriaSession(self.db)
+            stored.load(sess.sessionid)
+            self.assertEqual(stored.last_seen.replace(microsecond=0),
+                             sess.last_seen.replace(microsecond=0),
+                             "last_seen not written")
+
+        flusher.close()
+
+    def test_65_task(self):
+        """HistoriaSessionTask: subclasses have to provide run_once()"""
+        self.assertRaises(TypeError, session.HistoriaSessionTask, self.db, 3600)
+
+        class Incomplete(session.HistoriaSessionTask):
+            pass
+
+        self.assertRaises(TypeError, Incomplete, self.db, 3600)
+
+    def test_67_task_connect(self):
+        """HistoriaSessionTask: cycles are skipped until the thread has its own connection"""
+        ran = threading.Event()
+
+        class Task(session.HistoriaSessionTask):
+            def run_once(self):
+                ran.set()
+
+        failed = exceptions.DataConnectionError("Unable to establish thread database connection")
+        with unittest.mock.patch.object(self.db, 'connect_thread', side_effect=[failed, failed, True]) as connect, \
+                unittest.mock.patch.object(self.db, 'disconnect_thread'):
+            task = Task(self.db, 0.01)
+            task.start()
+            self.assertTrue(ran.wait(5), "Task never ran")
+            task.close()
+
+        self.assertEqual(connect.call_count, 3, "Connection should be retried each cycle until it works")
+
+    def test_70_reaper(self):
+        """HistoriaSessionReaper: expired sessions are deleted in batches"""
+        self.database_setup(withTables=True)
+        sessions = []
+        for i in range(3):
+            sess = session.HistoriaSession(self.db)
+            sess.new_id()
+            sess.ip = "127.0.0.1"
+            sess.userid = 123
+            sess.save()
+            sessions.append(sess)
+
+        # Age two of the sessions past the ttl
+        old = datetime.datetime.now() - datetime.timedelta(hours=2)
+        for sess in sessions[:2]:
+            age = ("UPDATE `{0}` SET `last_seen` = %(old)s WHERE `sessionid` = %(sid)s".format(session.HistoriaSession.machine_type),
+                   {'old': old, 'sid': sess.sessionid})
+            self.db.execute_update(age)
+
+        reaper = session.HistoriaSessionReaper(self.db, 3600, interval=3600, batch_size=1, pause=0)
+        self.assertEqual(reaper.reap(), 2, "Incorrect number of sessions reaped")
+
+        stats = reaper.stats()
+        self.assertEqual(stats['reaped'], 2, "Incorrect reaped count")
+        self.assertEqual(stats['cycles'], 1, "Incorrect cycle count")
+
+        select = ("SELECT * FROM `{0}`".format(session.HistoriaSession.machine_type),{})
+        result = self.db.execute_select(select)
+        self.assertEqual(len(result), 1, "Only the current session should be left.")
+        self.assertEqual(result[0]['sessionid'], sessions[2].sessionid, "The wrong session was reaped.")
+
+    def test_75_prepared_update(self):
+        """HistoriaSession: updates of the changed fields run as prepared statements"""
+        self.db.connection = unittest.mock.MagicMock()
+        self.db.connection.is_connected.return_value = True
+        self.db.prepared_statements = True
+
+        sess = session.HistoriaSession(self.db)
+        sess.new_id()
+        sess.ip = "127.0.0.1"
+        sess.userid = 123
+        sess._dirty = False
+        sess.last_seen = datetime.datetime.now()
+
+        update = sess._generate_update_SQL()
+        self.assertNotEqual(update[0], session.HistoriaSession._sql['update'][0], "Update should only cover last_seen")
+        self.assertTrue(self.db._prepared.registered(update[0]), "Partial update not prepared")
+
+        for i in range(2):
+            self.db.execute_update(update)
+        stats = self.db.prepared_stats()
+        self.assertEqual(stats['prepares'], 1, "Update should be prepared once")
+        self.assertEqual(stats['hits'], 1, "Prepared update wasn't reused")
+
+        # Without prepared statements nothing is registered
+        db = core_data_objects.HistoriaDatabase(self.testdb_name)
+        sess.database = db
+        sess.ip = "127.0.0.2"
+        self.assertFalse(db._prepared.registered(sess._generate_update_SQL()[0]), "Update prepared while disabled")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_session_cache.py
+
+Created by Aaron Crosman on 2015-03-14.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import unittest
+
+from internals import session_cache
+
+
+class CachedSession(object):
+    """Just the parts of a session the cache looks at."""
+
+    def __init__(self, sessionid, userid=0):
+        self.sessionid = sessionid
+        self.userid = userid
+
+
+class TestSessionCache(unittest.TestCase):
+
+    def test_00_get_put(self):
+        """HistoriaSessionCache: get() and put()"""
+        cache = session_cache.HistoriaSessionCache(10, 300)
+        sess = CachedSession('abc')
+
+        self.assertIsNone(cache.get('abc'), "Found a session that was never added")
+        cache.put(sess)
+        self.assertIs(cache.get('abc'), sess, "Cached session not returned")
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1, "Incorrect hit count")
+        self.assertEqual(stats['misses'], 1, "Incorrect miss count")
+        self.assertEqual(stats['size'], 1, "Incorrect cache size")
+
+    def test_10_lru(self):
+        """HistoriaSessionCache: least recently used sessions are evicted"""
+        cache = session_cache.HistoriaSessionCache(2, 300)
+        cache.put(CachedSession('a'))
+        cache.put(CachedSession('b'))
+        cache.get('a')
+        cache.put(CachedSession('c'))
+
+        self.assertIsNotNone(cache.get('a'), "Recently used session evicted")
+        self.assertIsNone(cache.get('b'), "Least recently used session kept")
+        self.assertIsNotNone(cache.get('c'), "Newest session evicted")
+        self.assertEqual(cache.stats()['evictions'], 1, "Incorrect eviction count")
+
+    def test_20_ttl(self):
+        """HistoriaSessionCache: sessions expire after ttl seconds"""
+        cache = session_cache.HistoriaSessionCache(10, 0.1)
+        cache.put(CachedSession('abc'))
+        time.sleep(0.2)
+
+        self.assertIsNone(cache.get('abc'), "Expired session returned")
+        self.assertEqual(cache.stats()['size'], 0, "Expired session not removed")
+
+    def test_30_invalidate(self):
+        """HistoriaSessionCache: invalidate() and invalidate_user()"""
+        cache = session_cache.HistoriaSessionCache(10, 300)
+        cache.put(CachedSession('a', 1))
+        cache.put(CachedSession('b', 1))
+        cache.put(CachedSession('c', 2))
+
+        cache.invalidate('c')
+        self.assertIsNone(cache.get('c'), "Invalidated session returned")
+
+        cache.invalidate_user(1)
+        self.assertIsNone(cache.get('a'), "Session for invalidated user returned")
+        self.assertIsNone(cache.get('b'), "Session for invalidated user returned")
+
+
+if __name__ == '__main__':
+    unittest.main()
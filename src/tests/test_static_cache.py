@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_static_cache.py
+
+Created by Aaron Crosman on 2015-03-21.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from internals import static_cache
+
+
+class TestStaticCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, body, mtime=1420070400):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(body)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_00_get(self):
+        """HistoriaStaticCache: get() reads a file once and notices changes"""
+        cache = static_cache.HistoriaStaticCache()
+        path = self.write_file('page.css', b"body {}")
+
+        first = cache.get(path)
+        self.assertEqual(first.body, b"body {}", "Wrong body")
+        self.assertIs(cache.get(path), first, "Unchanged file read again")
+        self.assertEqual(first.last_modified, "Thu, 01 Jan 2015 00:00:00 GMT", "Wrong Last-Modified")
+
+        self.write_file('page.css', b"body {}", mtime=1420070401)
+        second = cache.get(path)
+        self.assertIsNot(second, first, "Touched file not read again")
+        self.assertEqual(second.etag, first.etag, "ETag changed without the content changing")
+
+        self.write_file('page.css', b"p {}", mtime=1420070401)
+        third = cache.get(path)
+        self.assertEqual(third.body, b"p {}", "Edited file not read again")
+        self.assertNotEqual(third.etag, second.etag, "ETag not changed with the content")
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3), "Incorrect hit and miss counts")
+        self.assertRaises(OSError, cache.get, os.path.join(self.directory, 'missing.css'))
+
+    def test_10_limits(self):
+        """HistoriaStaticCache: large files aren't kept, and the least recently
+        used files are dropped"""
+        cache = static_cache.HistoriaStaticCache(max_size=10, max_file_size=6)
+
+        large = cache.get(self.write_file('large.png', b"x" * 7))
+        self.assertIsNone(large.body, "Large file cached")
+        self.assertEqual(large.size, 7, "Wrong size for large file")
+        self.assertIsNotNone(large.etag, "No ETag for large file")
+
+        cache.get(self.write_file('a.js', b"a" * 5))
+        cache.get(self.write_file('b.js', b"b" * 5))
+        cache.get(self.write_file('c.js', b"c" * 5))
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['bytes'], stats['evictions']), (2, 10, 1), "Oldest file not dropped")
+
+    def test_15_compress(self):
+        """HistoriaStaticCache: get() keeps gzip copies of files worth
+        compressing"""
+        cache = static_cache.HistoriaStaticCache(compress_level=6, min_compress_size=100)
+        body = b"body { margin: 0; }\n" * 50
+
+        compressed = cache.get(self.write_file('page.css', body), compress=True)
+        self.assertEqual(gzip.decompress(compressed.gzip_body), body, "Wrong compressed body")
+        self.assertNotEqual(compressed.gzip_etag, compressed.etag, "Compressed body has the same ETag")
+        self.assertTrue(compressed.not_modified({'If-None-Match': compressed.gzip_etag}, compressed.gzip_etag),
+                        "Compressed ETag not matched")
+        self.assertFalse(compressed.not_modified({'If-None-Match': compressed.gzip_etag}),
+                         "Compressed ETag matched for the uncompressed body")
+        self.assertFalse(compressed.not_modified({'If-None-Match': compressed.etag}, compressed.gzip_etag),
+                         "Uncompressed ETag matched for the compressed body")
+        self.assertEqual(cache.stats()['bytes'], len(body) + len(compressed.gzip_body), "Compressed body not counted")
+
+        self.assertIsNone(cache.get(self.write_file('page.png', body), compress=False).gzip_body, "Compressed without asking")
+        self.assertIsNone(cache.get(self.write_file('small.css', b"p {}"), compress=True).gzip_body, "Small file compressed")
+        self.assertIsNone(cache.get(self.write_file('random.js', os.urandom(1000)), compress=True).gzip_body,
+                          "Compressed body kept when larger")
+
+    def test_20_not_modified(self):
+        """HistoriaStaticFile: not_modified() checks If-None-Match and
+        If-Modified-Since"""
+        cache = static_cache.HistoriaStaticCache()
+        static_file = cache.get(self.write_file('page.js', b"var x;"))
+
+        self.assertFalse(static_file.not_modified({}), "Unconditional request not modified")
+        self.assertTrue(static_file.not_modified({'If-None-Match': static_file.etag}), "Matching ETag")
+        self.assertTrue(static_file.not_modified({'If-None-Match': '"other", W/' + static_file.etag}), "ETag in a list")
+        self.assertTrue(static_file.not_modified({'If-None-Match': '*'}), "Any ETag")
+        self.assertFalse(static_file.not_modified({'If-None-Match': '"other"'}), "Different ETag")
+        self.assertFalse(static_file.not_modified({'If-None-Match': '"other"',
+                                                   'If-Modified-Since': static_file.last_modified}),
+                         "If-Modified-Since used along with If-None-Match")
+
+        self.assertTrue(static_file.not_modified({'If-Modified-Since': static_file.last_modified}), "Same date")
+        self.assertTrue(static_file.not_modified({'If-Modified-Since': "Fri, 02 Jan 2015 00:00:00 GMT"}), "Later date")
+        self.assertFalse(static_file.not_modified({'If-Modified-Since': "Wed, 31 Dec 2014 23:59:59 GMT"}), "Earlier date")
+        self.assertFalse(static_file.not_modified({'If-Modified-Since': "yesterday"}), "Invalid date")
+
+    def test_30_byte_range(self):
+        """HistoriaStaticFile: byte_range() reads the Range header"""
+        cache = static_cache.HistoriaStaticCache()
+        static_file = cache.get(self.write_file('scan.jpg', b"x" * 100))
+
+        self.assertIsNone(static_file.byte_range({}), "Range found without a header")
+        self.assertEqual(static_file.byte_range({'Range': "bytes=0-9"}), (0, 10), "Wrong first bytes")
+        self.assertEqual(static_file.byte_range({'Range': "bytes=90-"}), (90, 100), "Wrong open range")
+        self.assertEqual(static_file.byte_range({'Range': "bytes=-5"}), (95, 100), "Wrong suffix range")
+        self.assertEqual(static_file.byte_range({'Range': "bytes=-500"}), (0, 100), "Suffix not limited to the file")
+        self.assertEqual(static_file.byte_range({'Range': "bytes=50-500"}), (50, 100), "Range not limited to the file")
+
+        for value in ["bytes=0-1,5-6", "bytes=9-1", "items=0-1", "bytes=a-b", "bytes=1"]:
+            self.assertIsNone(static_file.byte_range({'Range': value}), "Range used: {0}".format(value))
+
+        for value in ["bytes=100-", "bytes=-0"]:
+            with self.assertRaises(static_cache.HTTPException) as cm:
+                static_file.byte_range({'Range': value})
+            self.assertEqual(cm.exception.response_code, 416, "Wrong response code")
+
+        self.assertEqual(static_file.byte_range({'Range': "bytes=0-9", 'If-Range': static_file.etag}), (0, 10),
+                         "Range not used with a matching If-Range")
+        self.assertIsNone(static_file.byte_range({'Range': "bytes=0-9", 'If-Range': '"old"'}),
+                          "Range used with a stale If-Range")
+
+
+if __name__ == '__main__':
+    unittest.main()
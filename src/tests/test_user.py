@@ -273,6 +273,27 @@ class TestUser(unittest.TestCase):
         self.assertEqual(result[0]['enabled'], 1, "enabled in the table should match the one on the record.")        
         self.assertEqual(result[0]['admin'], 0, "admin in the table should match the one on the record.")        
         
+    def test_35_partial_update(self):
+        """HistoriaUser: save() only writes the fields that changed"""
+        self.database_setup(withTables=True)
+        hu = user.HistoriaUser(self.db)
+        hu.name = "Tim"
+        hu.email = "tim@example.com"
+        hu.password = "Enchanter"
+        hu.save()
+
+        hu.email = "tim@enchanter.org"
+        statement, values = hu._generate_update_SQL()
+        self.assertEqual(statement, "UPDATE `historia_user` SET `email` = %(email)s WHERE `id` = %(id)s", "Update not limited to changed fields")
+        self.assertEqual(values, {'email': "tim@enchanter.org", 'id': hu.id}, "Incorrect update values")
+
+        hu.save()
+        hu2 = user.HistoriaUser(self.db)
+        hu2.load(hu.id)
+        self.assertEqual(hu2.email, "tim@enchanter.org", "Change not saved")
+        self.assertEqual(hu2.name, "Tim", "Unchanged field lost")
+        self.assertTrue(hu2.checkPassword("Enchanter"), "Unchanged password lost")
+
     def test_40_load(self):
         """HistoriaUser: load()"""
         self.database_setup(withTables=True)
@@ -23,6 +23,7 @@ Created by Aaron Crosman on 2015-02-18.
 """
 
 import unittest
+import unittest.mock
 import logging, sys, datetime
 
 import mysql.connector
@@ -234,6 +235,33 @@ class TestUserDatabase(unittest.TestCase):
         self.assertEqual(result[0]['enabled'], udb.enabled, "enabled in the table should match the one on the record.")        
         self.assertEqual(result[0]['db_address'], udb.db_address, "db_address in the table should match the one on the record.")
 
+    def test_35_failed_save(self):
+        """UserDatabase: a failed save() leaves the record unsaved"""
+        udb = user_db.HistoriaUserDatabase(self.db, self.test_user_db_name, self.key_file)
+        udb.name = "monty_db"
+        udb.db_user = "monty"
+        udb.db_address = "127.0.0.1"
+        udb.db_password = "Plain text password"
+        udb.uid = 1
+
+        with unittest.mock.patch.object(self.db, 'execute_insert', side_effect=exceptions.DataSaveError("Failed")):
+            self.assertRaises(exceptions.DataSaveError, udb.save)
+        self.assertEqual(udb.id, -1, "Record given an id by a failed save")
+        self.assertTrue(udb._dirty, "Record clean after a failed save")
+        self.assertEqual(udb.db_password, "Plain text password", "Plain text password not restored")
+
+        with unittest.mock.patch.object(self.db, 'execute_insert', return_value=5) as insert:
+            udb.save()
+        self.assertEqual(insert.call_count, 1, "Record not written again")
+        self.assertFalse(udb._dirty, "Record dirty after save")
+        self.assertEqual(udb.db_password, "Plain text password", "Plain text password not restored")
+
+        udb.db_password = "New password"
+        with unittest.mock.patch.object(self.db, 'execute_update', side_effect=exceptions.DataSaveError("Failed")):
+            self.assertRaises(exceptions.DataSaveError, udb.save)
+        self.assertIn('db_password', udb._dirty_fields, "Changed password clean after a failed save")
+        self.assertEqual(udb.db_password, "New password", "Plain text password not restored")
+
     def test_40_load(self):
         """UserDatabase: load()"""
         self.create_record_table()
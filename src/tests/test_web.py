@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+test_web.py
+
+Created by Aaron Crosman on 2015-03-08.
+
+    This file is part of historia.
+
+    historia is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    historia is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with historia.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import gzip
+import json
+import shutil
+import socket
+import tempfile
+import unittest
+import unittest.mock
+import threading
+import http.client
+import http.server
+
+from internals import controllers
+from internals import web
+from internals import async_web
+from internals import static_cache
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal handler that holds each request until released so tests can
+    see how many are in flight at once."""
+
+    release = threading.Event()
+    lock = threading.Lock()
+    in_flight = 0
+    peak = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.peak = max(cls.peak, cls.in_flight)
+        cls.release.wait(5)
+        with cls.lock:
+            cls.in_flight -= 1
+        body = threading.current_thread().name.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestThreadPoolServer(unittest.TestCase):
+
+    def setUp(self):
+        SlowHandler.release.clear()
+        SlowHandler.in_flight = 0
+        SlowHandler.peak = 0
+        self.started = []
+        self.stopped = []
+        self.server = web.HistoriaThreadPoolServer(('localhost', 0), SlowHandler,
+                                                   workers=3,
+                                                   worker_setup=lambda: self.started.append(threading.current_thread().name),
+                                                   worker_teardown=lambda: self.stopped.append(threading.current_thread().name))
+        self.server.start_workers()
+        self.serve_thread = threading.Thread(target=self.server.serve_forever)
+        self.serve_thread.start()
+
+    def tearDown(self):
+        SlowHandler.release.set()
+        self.server.shutdown()
+        self.server.drain(5)
+        self.server.server_close()
+        self.serve_thread.join(5)
+
+    def fetch(self, results):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+        conn.request('GET', '/')
+        results.append(conn.getresponse().read().decode('utf-8'))
+        conn.close()
+
+    def test_10_concurrent(self):
+        """HistoriaThreadPoolServer: requests are served concurrently by the pool"""
+        results = []
+        clients = [threading.Thread(target=self.fetch, args=(results,)) for i in range(3)]
+        for c in clients:
+            c.start()
+
+        # Give all three requests time to reach the workers before releasing them.
+        for i in range(50):
+            if SlowHandler.in_flight == 3:
+                break
+            threading.Event().wait(0.1)
+
+        self.assertEqual(SlowHandler.peak, 3, "Requests were not handled in parallel")
+        SlowHandler.release.set()
+        for c in clients:
+            c.join(10)
+
+        self.assertEqual(len(results), 3, "Not all requests completed")
+        self.assertEqual(len(set(results)), 3, "Requests should have been spread over all three workers")
+        for name in results:
+            self.assertTrue(name.startswith('historia-worker-'), "Request not handled by a pool worker: {0}".format(name))
+
+    def test_20_drain(self):
+        """HistoriaThreadPoolServer: drain() waits for in-flight requests and runs worker teardown"""
+        results = []
+        client = threading.Thread(target=self.fetch, args=(results,))
+        client.start()
+
+        for i in range(50):
+            if SlowHandler.in_flight == 1:
+                break
+            threading.Event().wait(0.1)
+
+        self.server.shutdown()
+        SlowHandler.release.set()
+        self.server.drain(5)
+        client.join(10)
+
+        self.assertEqual(len(results), 1, "In-flight request was dropped during shutdown")
+        self.assertEqual(sorted(self.started), sorted(self.stopped), "Every worker that started should have been torn down")
+        self.assertEqual(len(self.stopped), 3, "Worker teardown did not run for every worker")
+
+    def test_30_queue_full(self):
+        """HistoriaThreadPoolServer: connections are answered with a 503 once the queue is full"""
+        server = web.HistoriaThreadPoolServer(('localhost', 0), SlowHandler, workers=1, queue_size=1)
+        server.start_workers()
+        serve_thread = threading.Thread(target=server.serve_forever)
+        serve_thread.start()
+
+        def fetch(results):
+            conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+            conn.request('GET', '/')
+            results.append(conn.getresponse().status)
+            conn.close()
+
+        results = []
+        clients = [threading.Thread(target=fetch, args=(results,)) for i in range(2)]
+        try:
+            # One request with the worker, one waiting in the queue
+            clients[0].start()
+            for i in range(50):
+                if SlowHandler.in_flight == 1:
+                    break
+                threading.Event().wait(0.1)
+            clients[1].start()
+            for i in range(50):
+                if server._requests.qsize() == 1:
+                    break
+                threading.Event().wait(0.1)
+
+            refused = []
+            fetch(refused)
+            self.assertEqual(refused, [503], "Connection should be refused while the queue is full")
+        finally:
+            SlowHandler.release.set()
+            for c in clients:
+                c.join(10)
+            server.shutdown()
+            server.drain(5)
+            server.server_close()
+            serve_thread.join(5)
+
+        self.assertEqual(results, [200, 200], "Queued requests should still be served")
+
+
+class TestHTTPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.session = unittest.mock.Mock(sessionid="spam", userid=-1)
+
+        patches = [
+            unittest.mock.patch.object(web.HistoriaHTTPHandler, 'file_base_path', self.directory),
+            unittest.mock.patch.object(web.HistoriaHTTPHandler, 'compress_level', 6),
+            unittest.mock.patch.object(web.HistoriaHTTPHandler, 'compress_min_size', 200),
+            unittest.mock.patch.object(web.HistoriaHTTPHandler, 'static_cache',
+                                       static_cache.HistoriaStaticCache(max_file_size=4096, min_compress_size=200))
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def write_file(self, name, body):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(body)
+
+    @staticmethod
+    def make_handler(headers=None):
+        """A handler that has read a GET request with the given headers and
+        collects its response in wfile."""
+        lines = ["GET /historia/files/test HTTP/1.1"]
+        lines.extend("{0}: {1}".format(name, value) for name, value in (headers or {}).items())
+        raw_request = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+        handler = async_web.HistoriaBufferedHandler(raw_request, ('127.0.0.1', 0), None)
+        handler.raw_requestline = handler.rfile.readline()
+        handler.parse_request()
+        handler._current_command = "test"
+        return handler
+
+    @staticmethod
+    def parse_response(response):
+        """Split a response into its code, headers (with lower case names)
+        and body."""
+        head, sep, body = response.partition(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return int(lines[0].split()[1]), headers, body
+
+    def test_00_accepts_gzip(self):
+        """HistoriaHTTPHandler: _accepts_gzip() reads Accept-Encoding"""
+        accepted = ["gzip", "deflate, gzip", "GZIP", "gzip;q=0.5", "gzip; q=1.0", "x-gzip", "*", "br, *;q=0.1"]
+        refused = ["", "deflate", "identity", "gzip;q=0", "gzip;q=0.000", "*;q=0", "gzip;q=0, *", "gzip;q=spam"]
+
+        for value in accepted:
+            self.assertTrue(self.make_handler({'Accept-Encoding': value})._accepts_gzip(),
+                            "gzip not accepted: {0}".format(value))
+        for value in refused:
+            self.assertFalse(self.make_handler({'Accept-Encoding': value})._accepts_gzip(),
+                             "gzip accepted: {0}".format(value))
+        self.assertFalse(self.make_handler()._accepts_gzip(), "gzip accepted without Accept-Encoding")
+
+    def test_10_send_record(self):
+        """HistoriaHTTPHandler: send_record() compresses large responses for
+        clients that accept gzip"""
+        record = {'text': "Spam and eggs. " * 20}
+
+        for request_headers, message in [({}, "Compressed without Accept-Encoding"),
+                                         ({'Accept-Encoding': "gzip;q=0"}, "Compressed when refused")]:
+            handler = self.make_handler(request_headers)
+            handler.send_record(self.session, record)
+            code, headers, plain = self.parse_response(handler.wfile.getvalue())
+            self.assertNotIn('content-encoding', headers, message)
+            self.assertIn(json.dumps(record).encode('utf-8'), plain, message)
+
+        handler = self.make_handler({'Accept-Encoding': "gzip"})
+        handler.send_record(self.session, record)
+        code, headers, body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(headers.get('content-encoding'), "gzip", "Large response not compressed")
+        self.assertEqual(headers['vary'], "Accept-Encoding", "Vary header missing")
+        self.assertEqual(int(headers['content-length']), len(body), "Wrong Content-Length")
+        self.assertEqual(gzip.decompress(body), plain, "Wrong compressed body")
+
+        handler = self.make_handler({'Accept-Encoding': "gzip"})
+        handler.send_record(self.session, {'text': "Spam"})
+        code, headers, body = self.parse_response(handler.wfile.getvalue())
+        self.assertNotIn('content-encoding', headers, "Response below compress_min_size compressed")
+        self.assertEqual(headers['vary'], "Accept-Encoding", "Vary header missing from small response")
+
+        with unittest.mock.patch.object(web.HistoriaHTTPHandler, 'compress_level', 0):
+            handler = self.make_handler({'Accept-Encoding': "gzip"})
+            handler.send_record(self.session, record)
+            self.assertNotIn('content-encoding', self.parse_response(handler.wfile.getvalue())[1],
+                             "Compressed with compression turned off")
+
+    def test_20_send_file_etag(self):
+        """HistoriaHTTPHandler: send_file() only answers 304 for the ETag of
+        the body it would send"""
+        body = b"body { margin: 0; }\n" * 50
+        self.write_file('page.css', body)
+        static_file = web.HistoriaHTTPHandler.static_cache.get(os.path.join(self.directory, 'page.css'), True)
+
+        handler = self.make_handler({'Accept-Encoding': "gzip", 'If-None-Match': static_file.gzip_etag})
+        handler.send_file(self.session, 'page.css')
+        code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(code, 304, "Compressed body sent to a client that has it")
+        self.assertEqual(headers['etag'], static_file.gzip_etag, "Wrong ETag")
+        self.assertEqual(response_body, b"", "Body sent with a 304")
+
+        handler = self.make_handler({'If-None-Match': static_file.gzip_etag})
+        handler.send_file(self.session, 'page.css')
+        code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(code, 200, "Compressed ETag matched for an uncompressed response")
+        self.assertEqual((headers['etag'], response_body), (static_file.etag, body), "Wrong uncompressed response")
+
+        handler = self.make_handler({'Accept-Encoding': "gzip", 'If-None-Match': static_file.etag})
+        handler.send_file(self.session, 'page.css')
+        code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(code, 200, "Uncompressed ETag matched for a compressed response")
+        self.assertEqual(headers['content-encoding'], "gzip", "Response not compressed")
+        self.assertEqual(gzip.decompress(response_body), body, "Wrong compressed body")
+
+    def test_30_send_file_cached(self):
+        """HistoriaHTTPHandler: send_file() sends validators and answers
+        conditional requests with a 304"""
+        self.write_file('page.js', b"var spam = 1;")
+
+        handler = self.make_handler()
+        handler.send_file(self.session, 'page.js')
+        code, headers, body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual((code, body), (200, b"var spam = 1;"), "Wrong response")
+        self.assertEqual(headers['cache-control'], web.HistoriaHTTPHandler.cache_control['js'], "Wrong Cache-Control")
+        etag, last_modified = headers['etag'], headers['last-modified']
+
+        for request_headers in [{'If-None-Match': etag},
+                                {'If-None-Match': '"other", ' + etag},
+                                {'If-Modified-Since': last_modified}]:
+            handler = self.make_handler(request_headers)
+            handler.send_file(self.session, 'page.js')
+            code, headers, body = self.parse_response(handler.wfile.getvalue())
+            self.assertEqual(code, 304, "Not modified for {0}".format(request_headers))
+            self.assertEqual((headers['etag'], body), (etag, b""), "Wrong 304 for {0}".format(request_headers))
+
+        handler = self.make_handler({'If-None-Match': '"other"'})
+        handler.send_file(self.session, 'page.js')
+        self.assertEqual(self.parse_response(handler.wfile.getvalue())[0], 200, "304 for a different ETag")
+        self.assertEqual(web.HistoriaHTTPHandler.static_cache.stats()['misses'], 1, "Unchanged file read again")
+
+        handler = self.make_handler()
+        handler.send_file(self.session, 'missing.js')
+        self.assertEqual(self.parse_response(handler.wfile.getvalue())[0], 404, "Missing file found")
+
+    def test_40_send_file_range(self):
+        """HistoriaHTTPHandler: send_file() answers Range requests with a 206,
+        or a 416 past the end of the file"""
+        body = bytes(range(256)) * 40
+        self.write_file('small.jpg', body[:1000])
+        self.write_file('large.jpg', body)
+
+        for name, size in [('small.jpg', 1000), ('large.jpg', len(body))]:
+            handler = self.make_handler({'Range': "bytes=100-199"})
+            handler.send_file(self.session, name)
+            code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+            self.assertEqual(code, 206, "Range not sent for {0}".format(name))
+            self.assertEqual(headers['content-range'], "bytes 100-199/{0}".format(size), "Wrong Content-Range")
+            self.assertEqual(response_body, body[100:200], "Wrong bytes for {0}".format(name))
+
+            handler = self.make_handler({'Range': "bytes={0}-".format(size)})
+            handler.send_file(self.session, name)
+            code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+            self.assertEqual(code, 416, "Range past the end accepted for {0}".format(name))
+            self.assertEqual(headers['content-range'], "bytes */{0}".format(size), "Wrong Content-Range for 416")
+            self.assertEqual(response_body, b"", "Body sent with a 416")
+
+    def test_50_sendfile(self):
+        """HistoriaHTTPHandler: large files are sent with socket.sendfile() on
+        a plain socket"""
+        body = os.urandom(10000)
+        self.write_file('large.jpg', body)
+        server_end, client_end = socket.socketpair()
+        self.addCleanup(server_end.close)
+        self.addCleanup(client_end.close)
+
+        handler = self.make_handler({'Range': "bytes=5000-"})
+        handler.connection = server_end
+        handler.wfile = server_end.makefile('wb')
+        with unittest.mock.patch.object(socket.socket, 'sendfile', autospec=True,
+                                        side_effect=socket.socket.sendfile) as sendfile:
+            handler.send_file(self.session, 'large.jpg')
+        handler.wfile.close()
+        server_end.shutdown(socket.SHUT_WR)
+
+        response = b"".join(iter(lambda: client_end.recv(65536), b""))
+        code, headers, response_body = self.parse_response(response)
+        self.assertEqual(code, 206, "Range not sent")
+        self.assertEqual(response_body, body[5000:], "Wrong bytes sent")
+        self.assertEqual(sendfile.call_args[0][2:], (5000, 5000), "Wrong offset and count given to sendfile")
+
+    def test_60_mmap(self):
+        """HistoriaHTTPHandler: without a socket large files are written in
+        chunks from a memory map"""
+        body = os.urandom(10000)
+        self.write_file('large.jpg', body)
+
+        with unittest.mock.patch.object(web.HistoriaHTTPHandler, 'file_chunk_size', 1024):
+            handler = self.make_handler()
+            self.assertIsNone(handler.connection, "Buffered handler has a connection")
+            with unittest.mock.patch.object(web.mmap, 'mmap', wraps=web.mmap.mmap) as mapped:
+                handler.send_file(self.session, 'large.jpg')
+
+        code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(code, 200, "File not sent")
+        self.assertEqual(int(headers['content-length']), len(body), "Wrong Content-Length")
+        self.assertEqual(response_body, body, "Wrong bytes sent")
+        self.assertEqual(mapped.call_count, 1, "File not memory mapped")
+
+    def test_70_changed_file(self):
+        """HistoriaHTTPHandler: a 503 is sent if a large file changes between
+        being checked and sent"""
+        self.write_file('large.jpg', b"x" * 10000)
+        old = web.HistoriaHTTPHandler.static_cache.get(os.path.join(self.directory, 'large.jpg'))
+        self.write_file('large.jpg', b"y" * 20000)
+
+        handler = self.make_handler()
+        with unittest.mock.patch.object(web.HistoriaHTTPHandler.static_cache, 'get', return_value=old):
+            handler.send_file(self.session, 'large.jpg')
+        code, headers, response_body = self.parse_response(handler.wfile.getvalue())
+        self.assertEqual(code, 503, "Changed file sent")
+        self.assertNotIn(b"y" * 100, response_body, "Part of the changed file sent")
+
+
+class TestHistoriaServer(unittest.TestCase):
+
+    def test_00_prefork_reaper(self):
+        """HistoriaServer: the session reaper is started in the parent after
+        every worker has been forked"""
+        server = web.HistoriaServer()
+        server.workers = 2
+        calls = unittest.mock.Mock()
+        server.controller = calls.controller
+        calls.fork.side_effect = [101, 102]
+
+        with unittest.mock.patch.object(web.os, 'fork', calls.fork), \
+                unittest.mock.patch.object(web.os, 'waitpid', calls.waitpid):
+            server._serve_prefork()
+
+        names = [name for name, args, kwargs in calls.mock_calls]
+        self.assertEqual(names[:3], ['fork', 'fork', 'controller.start_session_reaper'],
+                         "Reaper not started after the workers were forked")
+        self.assertEqual(names.count('controller.start_session_reaper'), 1, "Reaper started more than once")
+        self.assertEqual(server._children, [101, 102], "Children not recorded")